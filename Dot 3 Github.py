@@ -1,11 +1,12 @@
 import nextcord
 from nextcord.ext import commands, tasks
 import json
-import time
 import os
-import asyncio
 from datetime import datetime, timedelta, timezone
 #from datetime import timedelta
+from townsquare_spy.scanner import LinkScanner
+from queue_policy import MergeSplitPolicy, QueueTimings, Snapshot, SystemClock, game_types, handoff_action, next_turn, should_skip
+from queue_policy import is_active_storyteller as storyteller_is_active
 
 # Load DISCORD_TOKEN etc from .env if it exists.
 # Alternatively, these can be put in environment variables.
@@ -22,21 +23,38 @@ cooldowns_file_path = os.path.join(os.path.dirname(__file__), "Cooldowns.json")
 pings_file_path = os.path.join(os.path.dirname(__file__), "Pings.json")
 active_st_file_path = os.path.join(os.path.dirname(__file__), "ActiveStorytellers.json")
 New_ST_Exceptions_path = os.path.join(os.path.dirname(__file__), "NewSTExceptions.json")
+queue_policy_file_path = os.path.join(os.path.dirname(__file__), "QueuePolicy.json")
+
+# The time is read from a clock which the queue simulator replaces (see queue_simulator.py)
+clock = SystemClock()
+
+# Timings are shared with the queue simulator, so changes to them can be tried out there first (see queue_policy.QueueTimings)
+timings = QueueTimings()
 
 # Define global cooldown durations (40 hours in seconds)
-BEGINNER_COOLDOWN_DURATION = 144000
-PICKUP_COOLDOWN_DURATION = 144000
-ANY_COOLDOWN_DURATION = 144000
-REMOVECOOLDOWN_COOLDOWN_DURATION = 5184000 # 60 Days
-RE_RACK_TIMER_DURATION = 2400  # 40 minutes
+BEGINNER_COOLDOWN_DURATION = timings.cooldown
+PICKUP_COOLDOWN_DURATION = timings.cooldown
+ANY_COOLDOWN_DURATION = timings.cooldown
+REMOVECOOLDOWN_COOLDOWN_DURATION = timings.remove_cooldown_cooldown # 60 Days
+RE_RACK_TIMER_DURATION = timings.re_rack  # 40 minutes
 
 # Define cooldown duration for leaving the queue (1 hour in seconds)
-LEAVE_COOLDOWN_DURATION = 3600
+LEAVE_COOLDOWN_DURATION = timings.leave_cooldown
 
 # Define global merged status, games running status, and timer
 MERGED = True
 GAMES_RUNNING = False
-TIMEOUT_TIMER = 300  # 5 minutes
+TIMEOUT_TIMER = timings.start_timeout  # 5 minutes
+
+# Once the spy sees an active ST's game end, they have this long to answer before being finished automatically
+HANDOFF_TIMEOUT = 600  # 10 minutes
+# How long to wait before asking again, if the ST says they're still playing
+HANDOFF_SNOOZE_DURATION = 1800  # 30 minutes
+
+# Whether the queue is merged and split automatically ("apply"), only suggested ("recommend"), or left to mods ("off")
+QUEUE_POLICY = os.environ.get("QUEUE_POLICY", "off")
+
+FEEDBACK_FORM_URL = "https://docs.google.com/forms/d/e/1FAIpQLSduvl3LXwlenwc-uomQhiMY4iKOtjvSEF4jVezQMJGvATltQQ/viewform"
 
 # Channel IDs
 BEGINNER_CHANNEL_ID = int(os.environ['BEGINNER_CHANNEL_ID'])
@@ -67,11 +85,13 @@ pings = load_json(pings_file_path)
 active_storytellers = load_json(active_st_file_path)
 New_ST_Exceptions = load_json(New_ST_Exceptions_path)
 
+# The merge/split policy learns how many players there usually are at each hour
+queue_policy = MergeSplitPolicy(merged=MERGED, hourly_players=load_json(queue_policy_file_path).get("Hourly_Players", [None] * 24))
+last_policy_decision = None
+
 def is_active_storyteller(user_id):
     # Return false if all active STs are of queue type "Extra"
-    if all(st["QueueType"] == "Extra" for st in active_storytellers.values()):
-        return False
-    return str(user_id) in active_storytellers
+    return storyteller_is_active(active_storytellers, user_id)
 
 def add_active_storyteller(user, queue_type):
     if queue_type == "Any":
@@ -96,7 +116,7 @@ def update_queue_positions():
     save_json(livequeue_file_path, queue)
 
 async def remove_queue(user_id):
-    current_time = int(time.time())
+    current_time = int(clock.time())
 
     if str(user_id) in queue:
         if str(user_id) not in cooldowns:
@@ -120,6 +140,9 @@ async def on_ready():
     for g in bot.guilds:
         print(f'* {g.name}')
     check_queue.start()
+    check_handoffs.start()
+    if QUEUE_POLICY != "off":
+        check_merge_split.start()
 
 @bot.slash_command(name="join", description="Join the Live Queue")
 async def join(
@@ -137,8 +160,8 @@ async def join(
     )
 ):
     user = interaction.user
-    current_time = time.time()
-    join_threshold = datetime.now(timezone.utc) - timedelta(weeks=2)
+    current_time = clock.time()
+    join_threshold = datetime.fromtimestamp(clock.time(), timezone.utc) - timedelta(weeks=2)
     
     if user.joined_at > join_threshold and user.id not in New_ST_Exceptions:
         await interaction.response.send_message(f"{user.display_name} you must be on the server for more than 2 weeks to storytell on the server.")
@@ -239,7 +262,7 @@ async def list_queue(interaction: nextcord.Interaction):
 async def leave_queue(interaction: nextcord.Interaction):
     user = interaction.user
             
-    current_time = int(time.time())
+    current_time = int(clock.time())
 
     if str(user.id) in queue:
         queue_type = queue[str(user.id)]["QueueType"]
@@ -267,7 +290,7 @@ async def leave_queue(interaction: nextcord.Interaction):
 
 @bot.slash_command(name="removefromqueue", description="Removes player from queue")
 async def removefromqueue(interaction: nextcord.Interaction, user: nextcord.Member):
-    current_time = int(time.time())
+    current_time = int(clock.time())
 
     if str(user.id) in queue:
         queue_type = queue[str(user.id)]["QueueType"]
@@ -301,7 +324,7 @@ async def debug(interaction: nextcord.Interaction, member: nextcord.Member):
 @bot.slash_command(name="check", description="Check your cooldown status")
 async def check_cooldown(interaction: nextcord.Interaction):
     user = interaction.user
-    current_time = int(time.time())
+    current_time = int(clock.time())
 
     if str(user.id) in cooldowns and cooldowns[str(user.id)]["Cooldown"] > current_time:
         timestamp = cooldowns[str(user.id)]["Cooldown"]
@@ -333,26 +356,35 @@ async def load(interaction: nextcord.Interaction):
     New_ST_Exceptions = load_json(New_ST_Exceptions_path)
     await interaction.response.send_message("The queue, cooldowns, and active storytellers have been loaded from the JSON files.")
 
-@bot.slash_command(name="split", description="Split the merged queue into Beginner / Pickup Games")
-async def split(interaction: nextcord.Interaction):
+async def set_merged(merged):
+    # Merges or splits the queue, letting anyone who asked know
     global MERGED
-    MERGED = False
+    MERGED = merged
+    queue_policy.record_change(merged, clock.time())
     for userID in queue:
-            if pings[userID]["Merge_Split"] == "Yes":
-                member = bot.fetch_user(userID)
-                await member.send("The Queue has been Split, please check how this effects your ability to ST")
+        if pings.get(userID, {}).get("Merge_Split") == "Yes":
+            member = await bot.fetch_user(userID)
+            await member.send(f"The Queue has been {'Merged' if merged else 'Split'}, please check how this effects your ability to ST")
+
+@bot.slash_command(name="split", description="Split the merged queue into Beginner / Pickup Games")
+async def split(interaction: nextcord.Interaction):
+    await set_merged(False)
     await interaction.response.send_message("The queue has been split into Beginner / Pickup Games.")
 
 @bot.slash_command(name="merge", description="Merge Beginner / Pickup Games into one Queue")
 async def merge(interaction: nextcord.Interaction):
-    global MERGED
-    MERGED = True
-    for userID in queue:
-            if pings[userID]["Merge_Split"] == "Yes":
-                member = bot.fetch_user(userID)
-                await member.send("The Queue has been Merged, please check how this effects your ability to ST")
+    await set_merged(True)
     await interaction.response.send_message("The queue has been merged into one Queue.")
 
+@bot.slash_command(name="queuepolicy", description="Show whether the queue should be merged or split right now")
+async def queuepolicy(interaction: nextcord.Interaction):
+    if last_policy_decision is None:
+        await interaction.response.send_message(f"The merge/split policy hasn't run yet (QUEUE_POLICY is {QUEUE_POLICY}).")
+        return
+    advice = "merged" if last_policy_decision.merged else "split"
+    current = "merged" if MERGED else "split"
+    await interaction.response.send_message(f"The queue is {current}, and should be {advice}: {last_policy_decision.reason}. (QUEUE_POLICY is {QUEUE_POLICY}.)")
+
 @bot.slash_command(name="pause", description="Pause the queue if there aren't enough players")
 async def pause(interaction: nextcord.Interaction):
     global GAMES_RUNNING
@@ -365,44 +397,43 @@ async def resume(interaction: nextcord.Interaction):
     GAMES_RUNNING = True
     await interaction.response.send_message("The games have been resumed.")
 
-@bot.slash_command(name="finish", description="Finish your turn and leave the queue")
-async def finish(interaction: nextcord.Interaction):
+def finish_storyteller(user_id, channel_id):
+    # Ends an ST's turn, so check_queue alerts the next ST (in the channel the game was finished from)
     global BEGINNER_CHANNEL_ID
     global PICKUP_CHANNEL_ID
     global MERGED_CHANNEL_ID
+    QueueType = active_storytellers[str(user_id)]["QueueType"]
+    remove_active_storyteller(user_id)
+    update_queue_positions()
+    if QueueType == "Beginner":
+        BEGINNER_CHANNEL_ID = channel_id
+        MERGED_CHANNEL_ID = channel_id
+    elif QueueType == "Pickup":
+        PICKUP_CHANNEL_ID = channel_id
+        MERGED_CHANNEL_ID = channel_id
+
+def queue_channel_id(queue_type):
+    # The channel the queue for an ST's QueueType currently alerts in
+    if MERGED:
+        return MERGED_CHANNEL_ID
+    if queue_type == "Beginner":
+        return BEGINNER_CHANNEL_ID
+    return PICKUP_CHANNEL_ID
+
+@bot.slash_command(name="finish", description="Finish your turn and leave the queue")
+async def finish(interaction: nextcord.Interaction):
     user = interaction.user
-    QueueType = active_storytellers[str(user.id)]["QueueType"]
     if is_active_storyteller(user.id):
-        remove_active_storyteller(user.id)
-        await interaction.response.send_message(f"{user.display_name} has finished their game, please wait whilst the next ST is alerted. Feedback Form: https://docs.google.com/forms/d/e/1FAIpQLSduvl3LXwlenwc-uomQhiMY4iKOtjvSEF4jVezQMJGvATltQQ/viewform")
-        update_queue_positions()
-        if QueueType == "Beginner":
-            BEGINNER_CHANNEL_ID = interaction.channel.id 
-            MERGED_CHANNEL_ID = interaction.channel.id  
-        elif QueueType == "Pickup":
-            PICKUP_CHANNEL_ID = interaction.channel.id
-            MERGED_CHANNEL_ID = interaction.channel.id 
-        return BEGINNER_CHANNEL_ID, PICKUP_CHANNEL_ID, MERGED_CHANNEL_ID
+        finish_storyteller(user.id, interaction.channel.id)
+        await interaction.response.send_message(f"{user.display_name} has finished their game, please wait whilst the next ST is alerted. Feedback Form: {FEEDBACK_FORM_URL}")
     else:
         await interaction.response.send_message("You are not active in the queue.")
 
 @bot.slash_command(name="forcefinish", description="Force finish a user's turn")
 async def forcefinish(interaction: nextcord.Interaction, player: nextcord.Member):
-    global BEGINNER_CHANNEL_ID
-    global PICKUP_CHANNEL_ID
-    global MERGED_CHANNEL_ID
-    QueueType = active_storytellers[str(player.id)]["QueueType"]
     if is_active_storyteller(player.id):
-        remove_active_storyteller(player.id)
-        await interaction.response.send_message(f"{player.display_name} has been force finished and removed from the queue. Feedback Form: https://docs.google.com/forms/d/e/1FAIpQLSduvl3LXwlenwc-uomQhiMY4iKOtjvSEF4jVezQMJGvATltQQ/viewform")
-        update_queue_positions()
-        if QueueType == "Beginner":
-            BEGINNER_CHANNEL_ID = interaction.channel.id 
-            MERGED_CHANNEL_ID = interaction.channel.id  
-        elif QueueType == "Pickup":
-            PICKUP_CHANNEL_ID = interaction.channel.id
-            MERGED_CHANNEL_ID = interaction.channel.id 
-        return BEGINNER_CHANNEL_ID, PICKUP_CHANNEL_ID, MERGED_CHANNEL_ID
+        finish_storyteller(player.id, interaction.channel.id)
+        await interaction.response.send_message(f"{player.display_name} has been force finished and removed from the queue. Feedback Form: {FEEDBACK_FORM_URL}")
     else:
         await interaction.response.send_message(f"{player.display_name} is not active in the queue.")
 
@@ -415,7 +446,7 @@ async def active_sts(interaction: nextcord.Interaction):
 
 @bot.slash_command(name="adminremovecooldown", description="Remove a user's cooldown")
 async def removecooldown(interaction: nextcord.Interaction, player: nextcord.Member = None):
-    current_time = int(time.time())
+    current_time = int(clock.time())
     if player is None:
         player = interaction.user
 
@@ -427,7 +458,7 @@ async def removecooldown(interaction: nextcord.Interaction, player: nextcord.Mem
 
 @bot.slash_command(name="removecooldown", description="Remove a your cooldown if you missed your turn (Usable once per 60 days)")
 async def removecooldown(interaction: nextcord.Interaction):
-    current_time = int(time.time())
+    current_time = int(clock.time())
 
     player = interaction.user
 
@@ -440,7 +471,7 @@ async def removecooldown(interaction: nextcord.Interaction):
 
 @bot.slash_command(name="addcooldown", description="Add a cooldown to a user")
 async def addcooldown(interaction: nextcord.Interaction, player: nextcord.Member, hours: int):
-    current_time = int(time.time())
+    current_time = int(clock.time())
 
     if str(player.id) in cooldowns:
         cooldowns[str(player.id)]["Cooldown"] = current_time + hours * 3600
@@ -472,7 +503,7 @@ async def addcooldown(interaction: nextcord.Interaction, player: nextcord.Member
 
 @bot.slash_command(name="removeremovecooldowncooldown", description="Remove a user's removeCooldown_Cooldown")
 async def removeremovecooldowncooldown(interaction: nextcord.Interaction, player: nextcord.Member):
-    current_time = int(time.time())
+    current_time = int(clock.time())
 
     if str(player.id) in cooldowns:
         cooldowns[str(player.id)]["removeCooldown_Cooldown"] = current_time
@@ -507,7 +538,7 @@ async def startextra(interaction: nextcord.Interaction):
         await interaction.response.send_message(f"{user.display_name} is now active and has been removed from the queue.")
 
         # Notify user after 40 minutes
-        await asyncio.sleep(RE_RACK_TIMER_DURATION)
+        await clock.sleep(RE_RACK_TIMER_DURATION)
         await interaction.channel.send(f"{user.mention}, the Re-rack timer has expired.")
     else:
         await interaction.response.send_message("You are not eligible to start extra.")
@@ -598,7 +629,7 @@ async def start_user(interaction, user):
     #await check_queue()
 
     # Notify user after 40 minutes
-    await asyncio.sleep(RE_RACK_TIMER_DURATION)
+    await clock.sleep(RE_RACK_TIMER_DURATION)
     await interaction.channel.send(f"{user.mention}, the Re-rack timer has expired.")
 
 @bot.slash_command(name="start", description="Start a game if you're next to ST")
@@ -614,221 +645,202 @@ async def forcestart(interaction: nextcord.Interaction, player: nextcord.Member)
 async def check_queue():
     if not GAMES_RUNNING:
         return
+    # Who is asked to start is decided in queue_policy, so the queue simulator follows the same rules
+    for game_type in game_types(MERGED):
+        turn = next_turn(queue, active_storytellers, MERGED, game_type)
+        if turn is not None and not await ask_to_start(turn):
+            return
+
+async def ask_to_start(turn):
+    # Asks the ST at the front of the queue to start, and skips them if they don't in time.
+    # Returns False if they started or left.
+    user_id = turn.entry["Discord_ID"]
+    user = await bot.fetch_user(user_id)
+    channel = bot.get_channel(queue_channel_id(turn.game_type))
+    initial_merged_state = MERGED
+
+    queue[str(user.id)]["QueueType"] = turn.game_type
+
+    embed = nextcord.Embed(title=f"Game Notification for {queue[str(user_id)]['QueueType']} Queue", description=f"{user.mention}, it's your turn!")
+    embed.set_thumbnail(url=user.display_avatar.url)
+    timeout_timestamp = int(clock.time()) + TIMEOUT_TIMER
+    embed.add_field(name="Notes:", value=f"{queue[str(user_id)]['Notes']}", inline=False)
+    embed.add_field(name="Action Required", value=f"Please choose to start or leave the queue. Timeout <t:{timeout_timestamp}:R>", inline=False)
+    view = nextcord.ui.View()
+    start_button = nextcord.ui.Button(label="Start", style=nextcord.ButtonStyle.green)
+    leave_button = nextcord.ui.Button(label="Leave", style=nextcord.ButtonStyle.red)
+
+    async def start_callback(interaction: nextcord.Interaction):
+        if interaction.user.id == user.id and str(user.id) in queue:
+            await start_user(interaction, user)
+            #await interaction.message.edit(view=None)
+        else:
+            await interaction.response.send_message("You are not authorized to use this button.", ephemeral=True)
 
-    if MERGED:
-        # Check for Active_ST in the merged queue
-        for entry in active_storytellers.values():
-            if is_active_storyteller(entry["Discord_ID"]):
-                return
+    async def leave_callback(interaction: nextcord.Interaction):
+        if interaction.user.id == user.id and str(user.id) in queue:
+            await leave_queue(interaction, user_id=user.id)
+            #await check_queue()
+            await interaction.message.edit(view=None)
+        else:
+            await interaction.response.send_message("You are not authorized to use this button.", ephemeral=True)
 
-        # Find the first user in the merged queue
-        sorted_queue = sorted(queue.values(), key=lambda x: x["Merged_Queue_Position"])
-        if sorted_queue:
-            user_id = sorted_queue[0]["Discord_ID"]
-
-            if str(user_id) in queue:
-                user = await bot.fetch_user(user_id)
-                channel = bot.get_channel(MERGED_CHANNEL_ID)
-                initial_merged_state = MERGED
-
-                queue[str(user.id)]["QueueType"] = "Pickup"
-
-                embed = nextcord.Embed(title=f"Game Notification for {queue[str(user_id)]['QueueType']} Queue", description=f"{user.mention}, it's your turn!")
-                embed.set_thumbnail(url=user.display_avatar.url)
-                timeout_timestamp = int(time.time()) + TIMEOUT_TIMER
-                embed.add_field(name="Notes:", value=f"{queue[str(user_id)]['Notes']}", inline=False)
-                embed.add_field(name="Action Required", value=f"Please choose to start or leave the queue. Timeout <t:{timeout_timestamp}:R>", inline=False)
-                view = nextcord.ui.View()
-                start_button = nextcord.ui.Button(label="Start", style=nextcord.ButtonStyle.green)
-                leave_button = nextcord.ui.Button(label="Leave", style=nextcord.ButtonStyle.red)
-
-                async def start_callback(interaction: nextcord.Interaction):
-                    if interaction.user.id == user.id and str(user.id) in queue:
-                        await start_user(interaction, user)
-                        #await interaction.message.edit(view=None)
-                    else:
-                        await interaction.response.send_message("You are not authorized to use this button.", ephemeral=True)
-
-                async def leave_callback(interaction: nextcord.Interaction):
-                    if interaction.user.id == user.id and str(user.id) in queue:
-                        await leave_queue(interaction, user_id=user.id)
-                        #await check_queue()
-                        await interaction.message.edit(view=None)
-                    else:
-                        await interaction.response.send_message("You are not authorized to use this button.", ephemeral=True)
-
-                start_button.callback = start_callback
-                leave_button.callback = leave_callback
-
-                view.add_item(start_button)
-                view.add_item(leave_button)
-
-                await channel.send(embed=embed, view=view)
-                await channel.send(f"{user.mention}, it's your turn!")
-                if pings[str(user.id)]['Next_in_Queue'] == "Yes":
-                            await user.send("You are now the required ST on the unofficial, Please ensure you press the START Button to begin")
-                try:
-                    next_user_id = sorted_queue[1]["Discord_ID"]
-                    next_user = await bot.fetch_user(next_user_id)
-                    await channel.send(f"{next_user.mention}, You are 2nd in the queue!")
-                    if pings[str(next_user.id)]['2nd_in_Queue'] == "Yes":
-                            await next_user.send("You are 2nd in the queue on the unofficial, please be ready for your turn")
-                except:
-                    await channel.send("Queue is empty after you.")
-
-                for i in range(100):
-                    if str(user.id) in queue and not is_active_storyteller(user.id):
-                        await asyncio.sleep(TIMEOUT_TIMER/100)  # Wait for 5 minutes
-                    else:
-                        return
-
-                # Check if the user is still first in queue and the merge state has not changed
-                if MERGED == initial_merged_state and str(user.id) in queue and not is_active_storyteller(user.id) and GAMES_RUNNING is True:
-                    await channel.send(f"{user.mention}, You did not reply in time, your space has been skipped")
-                    await remove_queue(user_id=user.id)
-                    #await check_queue()
-    else:
-        # Check for Active_ST in the beginner queue
-        beginner_active_sts = [st for st in active_storytellers.values() if st["QueueType"] in ["Beginner", "Any"]]
-        if not beginner_active_sts:
-            beginner_queue = [entry for entry in queue.values() if entry["QueueType"] in ["Beginner", "Any"]]
-            sorted_beginner_queue = sorted(beginner_queue, key=lambda x: x["Merged_Queue_Position"])
-            if sorted_beginner_queue:
-                user_id = sorted_beginner_queue[0]["Discord_ID"]
-                if str(user_id) in queue:
-                    user = await bot.fetch_user(user_id)
-                    channel = bot.get_channel(BEGINNER_CHANNEL_ID)
-                    initial_merged_state = MERGED
-
-                    queue[str(user.id)]["QueueType"] = "Beginner"
-
-                    embed = nextcord.Embed(title=f"Game Notification for {queue[str(user_id)]['QueueType']} Queue", description=f"{user.mention}, it's your turn!")
-                    embed.set_thumbnail(url=user.display_avatar.url)
-                    timeout_timestamp = int(time.time()) + TIMEOUT_TIMER
-                    embed.add_field(name="Notes:", value=f"{queue[str(user_id)]['Notes']}", inline=False)
-                    embed.add_field(name="Action Required", value=f"Please choose to start or leave the queue. Timeout at <t:{timeout_timestamp}:R>", inline=False)
-
-                    view = nextcord.ui.View()
-                    start_button = nextcord.ui.Button(label="Start", style=nextcord.ButtonStyle.green)
-                    leave_button = nextcord.ui.Button(label="Leave", style=nextcord.ButtonStyle.red)
-
-                    async def start_callback(interaction: nextcord.Interaction):
-                        if interaction.user.id == user.id and str(user.id) in queue:
-                            await start_user(interaction, user)
-                            #await interaction.message.edit(view=None)
-                        else:
-                            await interaction.response.send_message("You are not authorized to use this button.", ephemeral=True)
-
-                    async def leave_callback(interaction: nextcord.Interaction):
-                        if interaction.user.id == user.id and str(user.id) in queue:
-                            await leave_queue(interaction, user_id=user.id)
-                            #await interaction.message.edit(view=None)
-                            #await check_queue()
-                        else:
-                            await interaction.response.send_message("You are not authorized to use this button.", ephemeral=True)
-
-                    start_button.callback = start_callback
-                    leave_button.callback = leave_callback
-
-                    view.add_item(start_button)
-                    view.add_item(leave_button)
-
-                    await channel.send(embed=embed, view=view)
-                    await channel.send(f"{user.mention}, it's your turn!")
-                    if pings[str(user.id)]['Next_in_Queue'] == "Yes":
-                            await user.send("You are now the required ST on the unofficial, Please ensure you press the START Button to begin")
-
-                    try:
-                        next_user_id = sorted_beginner_queue[1]["Discord_ID"]
-                        next_user = await bot.fetch_user(next_user_id)
-                        await channel.send(f"{next_user.mention}, You are 2nd in the queue!")
-                        if pings[str(next_user.id)]['2nd_in_Queue'] == "Yes":
-                            await next_user.send("You are 2nd in the queue on the unofficial, please be ready for your turn")
-                    except:
-                        await channel.send("Queue is empty after you.")
-
-                    for i in range(100):
-                        if str(user.id) in queue and not is_active_storyteller(user.id):
-                            await asyncio.sleep(TIMEOUT_TIMER/100)  # Wait for 5 minutes
-                        else:
-                            return
-
-                    # Check if the user is still first in queue and the merge state has not changed
-                    if MERGED == initial_merged_state and str(user.id) in queue and not is_active_storyteller(user.id) and GAMES_RUNNING is True:
-                        await channel.send(f"{user.mention}, You did not reply in time, your space has been skipped")
-                        await remove_queue(user_id=user.id)
-                        #await check_queue()
-
-        # Check for Active_ST in the pickup queue
-        pickup_active_sts = [st for st in active_storytellers.values() if st["QueueType"] in ["Pickup", "Any"]]
-        if not pickup_active_sts:
-            pickup_queue = [entry for entry in queue.values() if entry["QueueType"] in ["Pickup", "Any"]]
-            sorted_pickup_queue = sorted(pickup_queue, key=lambda x: x["Merged_Queue_Position"])
-            if sorted_pickup_queue:
-                user_id = sorted_pickup_queue[0]["Discord_ID"]
-                if str(user_id) in queue:
-                    user = await bot.fetch_user(user_id)
-                    channel = bot.get_channel(PICKUP_CHANNEL_ID)
-                    initial_merged_state = MERGED
-
-                    queue[str(user.id)]["QueueType"] = "Pickup"
-
-                    embed = nextcord.Embed(title=f"Game Notification for {queue[str(user_id)]['QueueType']} Queue", description=f"{user.mention}, it's your turn!")
-                    embed.set_thumbnail(url=user.display_avatar.url)
-                    timeout_timestamp = int(time.time()) + TIMEOUT_TIMER
-                    embed.add_field(name="Notes:", value=f"{queue[str(user_id)]['Notes']}", inline=False)
-                    embed.add_field(name="Action Required", value=f"Please choose to start or leave the queue. Timeout at <t:{timeout_timestamp}:R>", inline=False)
-
-                    view = nextcord.ui.View()
-                    start_button = nextcord.ui.Button(label="Start", style=nextcord.ButtonStyle.green)
-                    leave_button = nextcord.ui.Button(label="Leave", style=nextcord.ButtonStyle.red)
-
-                    async def start_callback(interaction: nextcord.Interaction):
-                        if interaction.user.id == user.id and str(user.id) in queue:
-                            await start_user(interaction, user)
-                            #await interaction.message.edit(view=None)
-                        else:
-                            await interaction.response.send_message("You are not authorized to use this button.", ephemeral=True)
-
-                    async def leave_callback(interaction: nextcord.Interaction):
-                        if interaction.user.id == user.id and str(user.id) in queue:
-                            await leave_queue(interaction, user_id=user.id)
-                            #await interaction.message.edit(view=None)
-                            #await check_queue()
-                        else:
-                            await interaction.response.send_message("You are not authorized to use this button.", ephemeral=True)
-
-                    start_button.callback = start_callback
-                    leave_button.callback = leave_callback
-
-                    view.add_item(start_button)
-                    view.add_item(leave_button)
-
-                    await channel.send(embed=embed, view=view)
-                    await channel.send(f"{user.mention}, it's your turn!")
-                    if pings[str(user.id)]['Next_in_Queue'] == "Yes":
-                            await user.send("You are now the required ST on the unofficial, Please ensure you press the START Button to begin")
-
-                    try:
-                        next_user_id = sorted_pickup_queue[1]["Discord_ID"]
-                        next_user = await bot.fetch_user(next_user_id)
-                        await channel.send(f"{next_user.mention}, You are 2nd in the queue!")
-                        if pings[str(next_user.id)]['2nd_in_Queue'] == "Yes":
-                            await next_user.send("You are 2nd in the queue on the unofficial, please be ready for your turn")
-                    except:
-                        await channel.send("Queue is empty after you.")
-
-                    for i in range(100):
-                        if str(user.id) in queue and not is_active_storyteller(user.id):
-                            await asyncio.sleep(TIMEOUT_TIMER/100)  # Wait for 5 minutes  
-                        else:
-                            return
-
-                    # Check if the user is still first in queue and the merge state has not changed
-                    if MERGED == initial_merged_state and str(user.id) in queue and not is_active_storyteller(user.id) and GAMES_RUNNING is True:
-                        await channel.send(f"{user.mention}, You did not reply in time, your space has been skipped")
-                        await remove_queue(user_id=user.id)
-                        #await check_queue()
+    start_button.callback = start_callback
+    leave_button.callback = leave_callback
+
+    view.add_item(start_button)
+    view.add_item(leave_button)
+
+    await channel.send(embed=embed, view=view)
+    await channel.send(f"{user.mention}, it's your turn!")
+    if pings[str(user.id)]['Next_in_Queue'] == "Yes":
+        await user.send("You are now the required ST on the unofficial, Please ensure you press the START Button to begin")
+    try:
+        next_user_id = turn.next_entry["Discord_ID"]
+        next_user = await bot.fetch_user(next_user_id)
+        await channel.send(f"{next_user.mention}, You are 2nd in the queue!")
+        if pings[str(next_user.id)]['2nd_in_Queue'] == "Yes":
+            await next_user.send("You are 2nd in the queue on the unofficial, please be ready for your turn")
+    except:
+        await channel.send("Queue is empty after you.")
+
+    for i in range(100):
+        if str(user.id) in queue and not is_active_storyteller(user.id):
+            await clock.sleep(TIMEOUT_TIMER/100)  # Wait for 5 minutes
+        else:
+            return False
+
+    # Check if the user is still first in queue and the merge state has not changed
+    if should_skip(user.id, queue, active_storytellers, initial_merged_state, MERGED, GAMES_RUNNING):
+        await channel.send(f"{user.mention}, You did not reply in time, your space has been skipped")
+        await remove_queue(user_id=user.id)
+        #await check_queue()
+    return True
+
+@bot.listen("on_message")
+async def link_storyteller_game(message: nextcord.Message):
+    # An active ST posting a townsquare link is taken to be running that game, so the spy can tell when it ends
+    if message.guild is None:
+        return
+    entry = active_storytellers.get(str(message.author.id))
+    # Most messages aren't from an active ST or don't mention a game, so the regex is only run when needed
+    if entry is None or LinkScanner.marker not in message.content:
+        return
+    urls = LinkScanner.pattern.findall(message.content)
+    if not urls or entry.get("Game_URL") == urls[-1]:
+        return
+    entry["Game_URL"] = urls[-1]
+    # Only used to send the prompt; the queue's alerts stay where they were
+    entry["Game_Channel_ID"] = message.channel.id
+    entry.pop("Handoff_Prompted", None)
+    entry.pop("Handoff_Snoozed_Until", None)
+    save_json(active_st_file_path, active_storytellers)
+    spy = bot.get_cog("TownsquareSpyCog")
+    if spy is not None:
+        spy.storyteller_game_end(urls[-1], message.channel.id)
+
+def prompted_entry(user_id, prompted_at):
+    # An active ST's entry, if they still have to answer the prompt sent at prompted_at
+    entry = active_storytellers.get(str(user_id))
+    if entry is None or entry.get("Handoff_Prompted") != prompted_at:
+        return None
+    return entry
+
+@tasks.loop(minutes=1)
+async def check_handoffs():
+    # Prompts active STs whose games look over to finish, and finishes them if they don't answer in time
+    spy = bot.get_cog("TownsquareSpyCog")
+    if spy is None:
+        return
+    current_time = int(clock.time())
+    for user_id, entry in list(active_storytellers.items()):
+        if "Game_URL" not in entry:
+            continue
+        channel = bot.get_channel(entry["Game_Channel_ID"])
+        if channel is None:
+            continue
+        reason = spy.storyteller_game_end(entry["Game_URL"], entry["Game_Channel_ID"])
+        action = handoff_action(entry, reason, current_time, HANDOFF_TIMEOUT)
+        if action == "withdraw":
+            # The game picked up again, so the prompt no longer stands
+            del entry["Handoff_Prompted"]
+            save_json(active_st_file_path, active_storytellers)
+        elif action == "finish":
+            finish_storyteller(user_id, queue_channel_id(entry["QueueType"]))
+            try:
+                await channel.send(f"{entry['DisplayName']}'s game has ended ({reason}), so they have been finished automatically, please wait whilst the next ST is alerted. Feedback Form: {FEEDBACK_FORM_URL}")
+            except nextcord.HTTPException as e:
+                print(f"Couldn't announce that {entry['DisplayName']} was finished automatically: {e}")
+        elif action == "prompt":
+            try:
+                await prompt_handoff(user_id, entry, channel, reason, current_time)
+            except nextcord.HTTPException as e:
+                # They'll be asked again next time, rather than being finished without having been asked
+                print(f"Couldn't ask {entry['DisplayName']} whether their game is over: {e}")
+                continue
+            entry["Handoff_Prompted"] = current_time
+            save_json(active_st_file_path, active_storytellers)
+
+async def prompt_handoff(user_id, entry, channel, reason, current_time):
+    # Asks an ST whether their game is over, with buttons to finish or keep playing
+    user = await bot.fetch_user(entry["Discord_ID"])
+    timeout_timestamp = current_time + HANDOFF_TIMEOUT
+    embed = nextcord.Embed(title="Is your game over?", description=f"{user.mention}, it looks like your game has ended: {reason}.")
+    embed.add_field(name="Action Required", value=f"Please finish so the next ST can start, or let us know you're still playing. You will be finished automatically <t:{timeout_timestamp}:R>", inline=False)
+    view = nextcord.ui.View(timeout=HANDOFF_TIMEOUT)
+    finish_button = nextcord.ui.Button(label="Finish", style=nextcord.ButtonStyle.green)
+    continue_button = nextcord.ui.Button(label="Still Playing", style=nextcord.ButtonStyle.grey)
+
+    async def finish_callback(interaction: nextcord.Interaction):
+        entry = prompted_entry(user_id, current_time)
+        if interaction.user.id == int(user_id) and entry is not None:
+            finish_storyteller(user_id, queue_channel_id(entry["QueueType"]))
+            await interaction.response.send_message(f"{interaction.user.display_name} has finished their game, please wait whilst the next ST is alerted. Feedback Form: {FEEDBACK_FORM_URL}")
+            await interaction.message.edit(view=None)
+        else:
+            await interaction.response.send_message("You are not authorized to use this button.", ephemeral=True)
+
+    async def continue_callback(interaction: nextcord.Interaction):
+        entry = prompted_entry(user_id, current_time)
+        if interaction.user.id == int(user_id) and entry is not None:
+            del entry["Handoff_Prompted"]
+            entry["Handoff_Snoozed_Until"] = int(clock.time()) + HANDOFF_SNOOZE_DURATION
+            save_json(active_st_file_path, active_storytellers)
+            await interaction.response.send_message(f"Enjoy the rest of your game! You won't be asked again for {HANDOFF_SNOOZE_DURATION // 60} minutes.", ephemeral=True)
+            await interaction.message.edit(view=None)
+        else:
+            await interaction.response.send_message("You are not authorized to use this button.", ephemeral=True)
+
+    finish_button.callback = finish_callback
+    continue_button.callback = continue_callback
+
+    view.add_item(finish_button)
+    view.add_item(continue_button)
+
+    await channel.send(f"{user.mention}, is your game over?", embed=embed, view=view)
+
+@tasks.loop(minutes=5)
+async def check_merge_split():
+    # Merges or splits the queue (or suggests it) depending on how many players are seated and which STs are waiting
+    global last_policy_decision
+    spy = bot.get_cog("TownsquareSpyCog")
+    if spy is None:
+        return
+    queue_lengths = {"Beginner": 0, "Pickup": 0, "Any": 0}
+    for entry in queue.values():
+        queue_lengths[entry["QueueType"]] = queue_lengths.get(entry["QueueType"], 0) + 1
+    decision = queue_policy.decide(Snapshot(spy.seated_players(), queue_lengths, clock.time()))
+    save_json(queue_policy_file_path, {"Hourly_Players": queue_policy.hourly_players})
+    is_new_advice = decision.changed and (last_policy_decision is None or last_policy_decision.merged != decision.merged)
+    last_policy_decision = decision
+    if not decision.changed or not GAMES_RUNNING:
+        return
+    channel = bot.get_channel(MERGED_CHANNEL_ID)
+    if QUEUE_POLICY == "apply":
+        await set_merged(decision.merged)
+        await channel.send(f"The queue has been {'merged into one Queue' if decision.merged else 'split into Beginner / Pickup Games'}: {decision.reason}.")
+    elif is_new_advice:
+        await channel.send(f"The queue could be {'merged' if decision.merged else 'split'} (with /{'merge' if decision.merged else 'split'}): {decision.reason}.")
 
 bot.load_extension("townsquare_spy.discord", extras=dict(db_path="townsquare.db"))
 
@@ -0,0 +1,4 @@
+"""
+Puts the repository on the path, so that tests can import townsquare_spy as
+a package, for the modules which use relative imports (like monitor.py).
+"""
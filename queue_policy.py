@@ -0,0 +1,234 @@
+"""
+This module decides when the live queue should be merged or split, from how
+many players are seated in games being monitored, how many storytellers are
+waiting for each kind of game, and the time of day.
+
+Splitting runs a Beginner and a Pickup game at once, so it is only worth it
+when there are enough players to fill two games and storytellers waiting to
+run both. To avoid flapping between the two, splitting needs more players
+than merging back does, and the queue is left alone for a while after each
+change. The number of players usually seated in each hour of the day is
+learned as the policy runs, so that the queue isn't split just before players
+usually drift away (or merged just before they usually arrive).
+
+Who is asked to start next, and when they are skipped (see next_turn and
+should_skip), and how storytellers whose games seem to be over are handed off
+(see handoff_action) are decided here too. The queue's timings (cooldowns and
+timeouts) are also kept here, along with the clock the bot reads the time
+from.
+
+Nothing here depends on Discord, so that it can be tested alone, and so that
+queue_simulator.py can run the same rules as the bot to try out other timings
+and policies.
+"""
+
+import asyncio
+import time
+
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Optional
+
+
+class SystemClock(object):
+    """
+    The real time, in seconds since the epoch, and a way to wait for it to
+    pass. The bot reads the time from this (rather than the time module), so
+    that it can be given another clock. The simulator doesn't run the bot, so
+    it schedules events on a clock of its own (queue_simulator.VirtualClock)
+    instead.
+    """
+    def time(self) -> float:
+        return time.time()
+
+    async def sleep(self, seconds: float):
+        await asyncio.sleep(seconds)
+
+
+@dataclass
+class QueueTimings:
+    """
+    How long things take in the queue, in whole seconds (as they are shown
+    as Discord timestamps).
+    """
+    # How long after starting a game (or being skipped) before joining again.
+    cooldown: int = 144000  # 40 hours
+    # How long after leaving the queue before joining again.
+    leave_cooldown: int = 3600
+    # How long the storyteller at the front has to start before being skipped.
+    start_timeout: int = 300
+    # When storytellers are reminded to re-rack, after starting.
+    re_rack: int = 2400
+    # How often storytellers can remove their own cooldown.
+    remove_cooldown_cooldown: int = 5184000  # 60 days
+
+
+# The kinds of game check_queue asks storytellers to start, in order. Merged
+# queues run Pickup games.
+def game_types(merged: bool) -> list[str]:
+    return ["Pickup"] if merged else ["Beginner", "Pickup"]
+
+
+@dataclass
+class Turn:
+    # The kind of game to be started ("Beginner" or "Pickup").
+    game_type: str
+    # The queue entries (from LiveQueue.json) of who is asked to start, and who is after them.
+    entry: dict
+    next_entry: Optional[dict]
+
+
+def is_active_storyteller(active_storytellers: dict, user_id) -> bool:
+    # "Extra" storytellers alone don't hold up the queue.
+    if all(st["QueueType"] == "Extra" for st in active_storytellers.values()):
+        return False
+    return str(user_id) in active_storytellers
+
+
+def next_turn(queue: dict, active_storytellers: dict, merged: bool, game_type: str) -> Optional[Turn]:
+    """
+    Who should be asked to start a game_type game, given the queue and active
+    storytellers (from LiveQueue.json and ActiveStorytellers.json), if anyone.
+    While the queue is merged, nobody is asked while anyone is running a game;
+    otherwise, only while nobody is running a game of that kind.
+    """
+    if merged:
+        if any(is_active_storyteller(active_storytellers, st["Discord_ID"]) for st in active_storytellers.values()):
+            return None
+        waiting = list(queue.values())
+    else:
+        kinds = [game_type, "Any"]
+        if any(st["QueueType"] in kinds for st in active_storytellers.values()):
+            return None
+        waiting = [entry for entry in queue.values() if entry["QueueType"] in kinds]
+    waiting.sort(key=lambda entry: entry["Merged_Queue_Position"])
+    if not waiting:
+        return None
+    return Turn(game_type, waiting[0], waiting[1] if len(waiting) > 1 else None)
+
+
+def should_skip(user_id, queue: dict, active_storytellers: dict, merged_when_asked: bool, merged: bool,
+                games_running: bool) -> bool:
+    """
+    Whether a storyteller who was asked to start should be skipped, once the
+    start timeout is up: they haven't started or left, and the queue hasn't
+    been merged, split or stopped since they were asked.
+    """
+    return (merged == merged_when_asked and str(user_id) in queue
+            and not is_active_storyteller(active_storytellers, user_id) and games_running)
+
+
+def handoff_action(entry: dict, end: Optional[str], now: float, timeout: float) -> Optional[str]:
+    """
+    What to do about an active storyteller's entry (from ActiveStorytellers.json),
+    given why their game seems to be over, if it does: "prompt" them to finish,
+    "finish" them for not answering a prompt within timeout seconds, "withdraw"
+    a prompt now that the game has picked up again, or nothing (None).
+    """
+    if end is None:
+        return "withdraw" if "Handoff_Prompted" in entry else None
+    if "Handoff_Prompted" in entry:
+        return "finish" if now >= entry["Handoff_Prompted"] + timeout else None
+    if now < entry.get("Handoff_Snoozed_Until", 0):
+        return None
+    return "prompt"
+
+
+@dataclass
+class PolicyConfig:
+    # Splitting needs enough seated players to fill two games of this size.
+    players_per_game: int = 12
+    # Once split, the queue is merged when this many fewer players are seated.
+    merge_margin: int = 5
+    # Seconds after a change (automatic or by hand) before another is made.
+    min_dwell: float = 1800
+    # How quickly the usual number of players in each hour follows what is seen.
+    hourly_smoothing: float = 0.2
+
+    @property
+    def split_at(self) -> int:
+        return 2 * self.players_per_game
+
+    @property
+    def merge_below(self) -> int:
+        return self.split_at - self.merge_margin
+
+
+@dataclass
+class Snapshot:
+    # Players seated in the games being monitored.
+    seated_players: int
+    # Storytellers waiting in the queue, by QueueType ("Beginner", "Pickup" or "Any").
+    queue_lengths: dict[str, int]
+    # Seconds since the epoch.
+    time: float
+
+
+@dataclass
+class Decision:
+    merged: bool
+    reason: str
+    # Whether this differs from the queue's current mode.
+    changed: bool = False
+
+
+@dataclass
+class MergeSplitPolicy:
+    config: PolicyConfig = field(default_factory=PolicyConfig)
+    merged: bool = True
+    # When the queue was last merged or split, in seconds since the epoch.
+    last_change: Optional[float] = None
+    # The usual number of players seated in each hour of the day (UTC), once seen.
+    hourly_players: list[Optional[float]] = field(default_factory=lambda: [None] * 24)
+
+    def record_change(self, merged: bool, now: float):
+        """
+        Records that the queue was merged or split, whether or not on this policy's advice.
+        """
+        if merged != self.merged:
+            self.merged = merged
+            self.last_change = now
+
+    def observe(self, snapshot: Snapshot):
+        hour = datetime.fromtimestamp(snapshot.time, timezone.utc).hour
+        usual = self.hourly_players[hour]
+        if usual is None:
+            self.hourly_players[hour] = float(snapshot.seated_players)
+        else:
+            self.hourly_players[hour] = usual + self.config.hourly_smoothing * (snapshot.seated_players - usual)
+
+    def decide(self, snapshot: Snapshot) -> Decision:
+        """
+        Whether the queue should be merged, given a snapshot (which is also learned from).
+        The decision isn't applied until record_change is called.
+        """
+        self.observe(snapshot)
+        config = self.config
+        seated = snapshot.seated_players
+        if self.last_change is not None and snapshot.time - self.last_change < config.min_dwell:
+            minutes = (snapshot.time - self.last_change) / 60
+            return Decision(self.merged, f"the queue was {'merged' if self.merged else 'split'} {minutes:.0f} minutes ago")
+
+        next_hour = (datetime.fromtimestamp(snapshot.time, timezone.utc).hour + 1) % 24
+        expected = self.hourly_players[next_hour]
+        lengths = snapshot.queue_lengths
+        beginner_sts = lengths.get("Beginner", 0) + lengths.get("Any", 0)
+        pickup_sts = lengths.get("Pickup", 0) + lengths.get("Any", 0)
+        both_waiting = beginner_sts > 0 and pickup_sts > 0 and sum(lengths.values()) >= 2
+
+        if self.merged:
+            if seated < config.split_at:
+                return Decision(True, f"{seated} players are seated, and two games need {config.split_at}")
+            if not both_waiting:
+                return Decision(True, "there aren't storytellers waiting to run both Beginner and Pickup games")
+            if expected is not None and expected < config.merge_below:
+                return Decision(True, f"{seated} players are seated, but there are usually about "
+                                      f"{expected:.0f} in the next hour")
+            return Decision(False, f"{seated} players are seated, enough for two games", changed=True)
+
+        if not both_waiting:
+            return Decision(True, "there aren't storytellers waiting to run both Beginner and Pickup games",
+                            changed=True)
+        if seated < config.merge_below and (expected is None or expected < config.split_at):
+            return Decision(True, f"only {seated} players are seated, fewer than {config.merge_below}", changed=True)
+        return Decision(False, f"{seated} players are seated")
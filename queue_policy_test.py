@@ -0,0 +1,82 @@
+"""
+Unit tests for the merge/split policy.
+"""
+
+from datetime import datetime, timezone
+
+from queue_policy import *
+
+def at(hour, minute=0):
+    return datetime(2024, 1, 1, hour, minute, tzinfo=timezone.utc).timestamp()
+
+BOTH_WAITING = {"Beginner": 1, "Pickup": 1, "Any": 0}
+
+def test_split_needs_players_and_storytellers():
+    policy = MergeSplitPolicy()
+    assert not policy.decide(Snapshot(23, BOTH_WAITING, at(20))).changed
+    assert not policy.decide(Snapshot(30, {"Pickup": 3}, at(20))).changed
+    # One storyteller can't run both games, even if they'd take either.
+    assert not policy.decide(Snapshot(30, {"Any": 1}, at(20))).changed
+    decision = policy.decide(Snapshot(24, {"Any": 2}, at(20)))
+    assert decision.changed and not decision.merged
+
+def test_hysteresis():
+    policy = MergeSplitPolicy()
+    policy.record_change(False, at(20))
+    # Too soon after the last change, however few players there are.
+    assert not policy.decide(Snapshot(5, BOTH_WAITING, at(20, 10))).changed
+    # Between the thresholds, the queue stays split.
+    assert not policy.decide(Snapshot(20, BOTH_WAITING, at(21))).changed
+    decision = policy.decide(Snapshot(18, BOTH_WAITING, at(21, 5)))
+    assert decision.changed and decision.merged
+    policy.record_change(True, at(21, 5))
+    # And once merged, it stays merged in between too.
+    assert not policy.decide(Snapshot(20, BOTH_WAITING, at(22))).changed
+
+def test_time_of_day():
+    policy = MergeSplitPolicy()
+    # Players usually leave around midnight.
+    for day in range(3):
+        policy.observe(Snapshot(8, BOTH_WAITING, at(0) + day * 86400))
+    decision = policy.decide(Snapshot(26, BOTH_WAITING, at(23)))
+    assert not decision.changed and "usually" in decision.reason
+    assert policy.decide(Snapshot(26, BOTH_WAITING, at(19))).changed
+
+def test_handoff_action():
+    entry = {"Game_URL": "https://clocktower.online/#game"}
+    assert handoff_action(entry, None, 0, 600) is None
+    assert handoff_action(entry, "everyone left their seats", 0, 600) == "prompt"
+    entry["Handoff_Prompted"] = 0
+    assert handoff_action(entry, "everyone left their seats", 599, 600) is None
+    assert handoff_action(entry, "everyone left their seats", 600, 600) == "finish"
+    # Activity resuming withdraws the prompt, rather than finishing anyone.
+    assert handoff_action(entry, None, 600, 600) == "withdraw"
+    del entry["Handoff_Prompted"]
+    entry["Handoff_Snoozed_Until"] = 1800
+    assert handoff_action(entry, "nothing has happened for 20 minutes", 1000, 600) is None
+    assert handoff_action(entry, "nothing has happened for 20 minutes", 1800, 600) == "prompt"
+
+def entry(user, queue_type, position):
+    return {"Discord_ID": user, "QueueType": queue_type, "Merged_Queue_Position": position}
+
+def test_next_turn():
+    queue = {"1": entry(1, "Pickup", 2), "2": entry(2, "Beginner", 3), "3": entry(3, "Any", 1)}
+    turn = next_turn(queue, {}, True, "Pickup")
+    assert turn.entry["Discord_ID"] == 3 and turn.next_entry["Discord_ID"] == 1
+    # Storytellers who'd take either kind of game are asked for both.
+    assert [next_turn(queue, {}, False, t).entry["Discord_ID"] for t in game_types(False)] == [3, 3]
+    active = {"4": entry(4, "Beginner", 0)}
+    assert next_turn(queue, active, True, "Pickup") is None
+    assert next_turn(queue, active, False, "Beginner") is None
+    del queue["3"]
+    turn = next_turn(queue, active, False, "Pickup")
+    assert turn.entry["Discord_ID"] == 1 and turn.next_entry is None
+    # Extra storytellers alone don't hold up a merged queue.
+    assert next_turn(queue, {"4": entry(4, "Extra", 0)}, True, "Pickup") is not None
+
+def test_should_skip():
+    queue = {"1": entry(1, "Pickup", 1)}
+    assert should_skip(1, queue, {}, True, True, True)
+    assert not should_skip(1, queue, {}, True, False, True)
+    assert not should_skip(1, queue, {}, True, True, False)
+    assert not should_skip(2, queue, {}, True, True, True)
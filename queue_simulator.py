@@ -0,0 +1,415 @@
+"""
+A discrete-event simulator for the live queue, for trying out its timings
+(see queue_policy.QueueTimings) and merge/split policies without running
+them live for weeks.
+
+Who is asked to start, and whether they are skipped, is decided by the same
+functions in queue_policy as the bot's check_queue uses, on a queue and
+active storytellers kept the way the bot keeps them: whenever nobody is
+running a game of some kind (or any game, while the queue is merged), the
+first storyteller in the queue who can run one is asked to start, one at a
+time. They're skipped, with a full cooldown, if they don't start within the
+start timeout; starting a game puts them on cooldown too. Games only start
+while enough players are online to fill them. The rest of the bot (Discord,
+and its clock) isn't run: events are scheduled on a virtual clock instead, so
+months of traffic take seconds.
+
+How storytellers and players behave is synthetic (see Traffic), although
+when storytellers join can instead be replayed from a file of JSON lines
+like {"time": 1704067200, "user": "123", "queue_type": "Pickup"}. For each
+configuration, it reports how many games were run, how long storytellers
+waited, how often they were skipped or gave up waiting, and how fairly
+games were shared between them. It can be run as:
+
+    python queue_simulator.py --days 90 --policy merged,split,auto --cooldown-hours 40,24
+"""
+
+import argparse
+import functools
+import heapq
+import itertools
+import json
+import math
+import random
+import statistics
+import time
+
+from collections import Counter
+from collections.abc import Callable
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timezone
+from typing import Optional
+
+from queue_policy import MergeSplitPolicy, PolicyConfig, QueueTimings, Snapshot, Turn, game_types, next_turn, should_skip
+
+QUEUE_TYPES = ["Beginner", "Pickup", "Any"]
+
+# Simulations start at midnight UTC, so that the time of day lines up.
+START_TIME = datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
+
+# How often the merge/split policy runs, as check_merge_split does.
+POLICY_INTERVAL = 300
+
+
+class VirtualClock(object):
+    """
+    A clock which only moves on when run() gets to the next thing scheduled.
+    Like queue_policy.SystemClock, time() is in seconds since the epoch.
+    """
+    now: float
+    scheduled: list[tuple[float, int, Callable[[], None]]]
+    counter: itertools.count
+
+    def __init__(self, start: float = START_TIME):
+        self.now = start
+        self.scheduled = []
+        self.counter = itertools.count()
+
+    def time(self) -> float:
+        return self.now
+
+    def call_at(self, when: float, callback: Callable[[], None]):
+        # Ties are broken by the order things were scheduled in.
+        heapq.heappush(self.scheduled, (max(when, self.now), next(self.counter), callback))
+
+    def call_later(self, delay: float, callback: Callable[[], None]):
+        self.call_at(self.now + delay, callback)
+
+    def run(self, until: float):
+        while self.scheduled and self.scheduled[0][0] <= until:
+            when, _, callback = heapq.heappop(self.scheduled)
+            self.now = when
+            callback()
+        self.now = until
+
+
+@dataclass
+class Traffic:
+    """
+    How storytellers and players behave. Times are in seconds.
+    """
+    storytellers: int = 60
+    # How likely a storyteller is to sign up for each QueueType.
+    queue_type_weights: dict[str, float] = field(default_factory=lambda: {"Beginner": 1, "Pickup": 3, "Any": 2})
+    # Once they can, storytellers join again after about this long.
+    mean_rejoin_delay: float = 7 * 86400
+    # How likely storytellers are to answer when it's their turn, and how quickly they do.
+    answer_probability: float = 0.85
+    mean_answer_time: float = 120
+    # Games last between these, plus however long their storyteller takes to finish.
+    game_length: tuple[float, float] = (75 * 60, 150 * 60)
+    mean_finish_delay: float = 600
+    # Storytellers stop waiting after about this long.
+    mean_patience: float = 6 * 3600
+    # Players online follow the time of day, peaking at this many at this hour (UTC).
+    peak_players: int = 40
+    peak_hour: int = 20
+    # Each game needs this many players, and games only run while there are enough.
+    players_per_game: int = 12
+
+    def players_online(self, now: float) -> int:
+        hour = now / 3600 % 24
+        level = 0.5 + 0.5 * math.cos(2 * math.pi * (hour - self.peak_hour) / 24)
+        return round(self.peak_players * level)
+
+
+@dataclass
+class SimulationConfig:
+    # "merged" or "split" always, or "auto" to follow MergeSplitPolicy.
+    policy: str = "merged"
+    timings: QueueTimings = field(default_factory=QueueTimings)
+    policy_config: PolicyConfig = field(default_factory=PolicyConfig)
+
+    def describe(self) -> str:
+        description = (f"{self.policy:<6} cooldown {self.timings.cooldown / 3600:g}h, "
+                       f"timeout {self.timings.start_timeout / 60:g}m")
+        if self.policy == "auto":
+            description += f", split at {self.policy_config.split_at}"
+        return description
+
+
+@dataclass
+class Results:
+    days: float
+    games: int = 0
+    joins: int = 0
+    notified: int = 0
+    skipped: int = 0
+    gave_up: int = 0
+    # Joins turned away, because the storyteller was already queued or on cooldown.
+    rejected: int = 0
+    merges_and_splits: int = 0
+    # How long each storyteller who started a game waited, in seconds.
+    waits: list[float] = field(default_factory=list)
+    games_by_storyteller: Counter = field(default_factory=Counter)
+    joined: set = field(default_factory=set)
+
+    @property
+    def fairness(self) -> float:
+        """
+        Jain's fairness index of games run by each storyteller who joined:
+        1 if they ran as many games as each other, down to 1/n if one ran them all.
+        """
+        games = [self.games_by_storyteller[user] for user in self.joined]
+        total = sum(games)
+        return total * total / (len(games) * sum(g * g for g in games)) if total else 0.0
+
+    def summary(self) -> dict[str, float]:
+        quantiles = statistics.quantiles(self.waits, n=10) if len(self.waits) >= 2 else [0.0] * 9
+        return dict(
+            games_per_day=self.games / self.days,
+            median_wait_hours=statistics.median(self.waits) / 3600 if self.waits else 0.0,
+            p90_wait_hours=quantiles[8] / 3600,
+            skip_rate=self.skipped / self.notified if self.notified else 0.0,
+            gave_up_rate=self.gave_up / self.joins if self.joins else 0.0,
+            fairness=self.fairness,
+            merges_and_splits=self.merges_and_splits,
+        )
+
+
+class Simulation(object):
+    """
+    The queue and everyone in it, following the bot's rules on a virtual clock.
+    """
+    config: SimulationConfig
+    traffic: Traffic
+    rng: random.Random
+    clock: VirtualClock
+    replaying: bool
+    queue_types: dict[object, str]
+    # Storytellers waiting and running games, keyed and laid out as in the
+    # bot's LiveQueue.json and ActiveStorytellers.json.
+    queue: dict[str, dict]
+    active_storytellers: dict[str, dict]
+    positions: itertools.count
+    joined_at: dict[object, float]
+    cooldowns: dict[object, float]
+    # Who has been asked to start, and whether the queue was merged then, if anyone.
+    notified: Optional[tuple[Turn, bool]]
+    merged: bool
+    policy: MergeSplitPolicy
+    results: Results
+
+    def __init__(self, config: SimulationConfig, traffic: Traffic, days: float, seed: int = 0,
+                 joins: Optional[list[tuple[float, object, str]]] = None, start: float = START_TIME):
+        self.config = config
+        self.traffic = traffic
+        self.rng = random.Random(seed)
+        self.clock = VirtualClock(start)
+        self.replaying = joins is not None
+        self.queue_types = dict()
+        self.queue = dict()
+        self.active_storytellers = dict()
+        self.positions = itertools.count(1)
+        self.joined_at = dict()
+        self.cooldowns = dict()
+        self.notified = None
+        self.merged = config.policy != "split"
+        self.policy = MergeSplitPolicy(config.policy_config, merged=self.merged)
+        self.results = Results(days=days)
+
+        if joins is not None:
+            for when, user, queue_type in joins:
+                self.clock.call_at(when, functools.partial(self.join, user, queue_type))
+        else:
+            weights = traffic.queue_type_weights
+            for user in range(traffic.storytellers):
+                self.queue_types[user] = self.rng.choices(list(weights), weights=list(weights.values()))[0]
+                self.clock.call_later(self.rng.uniform(0, traffic.mean_rejoin_delay),
+                                      functools.partial(self.join, user, self.queue_types[user]))
+        self.clock.call_later(0, self.run_policy)
+
+    def run(self) -> Results:
+        self.clock.run(self.clock.now + self.results.days * 86400)
+        return self.results
+
+    # What's going on
+
+    def players_online(self) -> int:
+        return self.traffic.players_online(self.clock.now)
+
+    def is_running(self) -> bool:
+        # Mods pause the queue while there aren't enough players for a game.
+        return self.players_online() >= self.traffic.players_per_game
+
+    def free_players(self) -> int:
+        return self.players_online() - len(self.active_storytellers) * self.traffic.players_per_game
+
+    def queue_lengths(self) -> dict[str, int]:
+        lengths = dict.fromkeys(QUEUE_TYPES, 0)
+        for entry in self.queue.values():
+            lengths[entry["QueueType"]] += 1
+        return lengths
+
+    def is_notified(self, user: object) -> bool:
+        return self.notified is not None and self.notified[0].entry["Discord_ID"] == user
+
+    # Things storytellers do
+
+    def join(self, user: object, queue_type: str):
+        now = self.clock.now
+        if str(user) in self.queue or str(user) in self.active_storytellers or self.cooldowns.get(user, 0) > now:
+            self.results.rejected += 1
+            return
+        if not self.replaying and not self.is_running():
+            # Storytellers only sign up while games are being run.
+            self.clock.call_later(1800, functools.partial(self.join, user, queue_type))
+            return
+        self.queue[str(user)] = {"Discord_ID": user, "QueueType": queue_type,
+                                 "Merged_Queue_Position": next(self.positions)}
+        self.joined_at[user] = now
+        self.results.joins += 1
+        self.results.joined.add(user)
+        self.clock.call_later(self.rng.expovariate(1 / self.traffic.mean_patience),
+                              functools.partial(self.give_up, user, now))
+        self.check_queue()
+
+    def rejoin_later(self, user: object):
+        if not self.replaying:
+            delay = self.cooldowns[user] - self.clock.now + self.rng.expovariate(1 / self.traffic.mean_rejoin_delay)
+            self.clock.call_later(delay, functools.partial(self.join, user, self.queue_types[user]))
+
+    def give_up(self, user: object, joined_at: float):
+        if str(user) not in self.queue or self.joined_at[user] != joined_at or self.is_notified(user):
+            return
+        del self.queue[str(user)]
+        self.cooldowns[user] = self.clock.now + self.config.timings.leave_cooldown
+        self.results.gave_up += 1
+        self.rejoin_later(user)
+
+    def start(self, turn: Turn):
+        if self.notified is None or self.notified[0] is not turn:
+            return
+        self.notified = None
+        user = turn.entry["Discord_ID"]
+        # As start_user does, which puts them on cooldown as it removes them from the queue.
+        entry = self.queue.pop(str(user))
+        self.active_storytellers[str(user)] = {"Discord_ID": user, "QueueType": entry["QueueType"]}
+        now = self.clock.now
+        self.cooldowns[user] = now + self.config.timings.cooldown
+        self.results.games += 1
+        self.results.games_by_storyteller[user] += 1
+        self.results.waits.append(now - self.joined_at[user])
+        low, high = self.traffic.game_length
+        length = self.rng.uniform(low, high) + self.rng.expovariate(1 / self.traffic.mean_finish_delay)
+        self.clock.call_later(length, functools.partial(self.finish, user))
+        self.check_queue()
+
+    def finish(self, user: object):
+        del self.active_storytellers[str(user)]
+        self.rejoin_later(user)
+        self.check_queue()
+
+    def time_out(self, turn: Turn):
+        if self.notified is None or self.notified[0] is not turn:
+            return
+        merged_when_asked = self.notified[1]
+        self.notified = None
+        user = turn.entry["Discord_ID"]
+        if should_skip(user, self.queue, self.active_storytellers, merged_when_asked, self.merged,
+                       self.is_running()):
+            del self.queue[str(user)]
+            self.cooldowns[user] = self.clock.now + self.config.timings.cooldown
+            self.results.skipped += 1
+            self.rejoin_later(user)
+        self.check_queue()
+
+    # What the bot does
+
+    def check_queue(self):
+        """
+        Asks the next storyteller to start, if a game can be started.
+        """
+        if self.notified is not None or not self.is_running() or self.free_players() < self.traffic.players_per_game:
+            return
+        for game_type in game_types(self.merged):
+            turn = next_turn(self.queue, self.active_storytellers, self.merged, game_type)
+            if turn is not None:
+                self.notify(turn)
+                return
+
+    def notify(self, turn: Turn):
+        # As check_queue does, which settles which kind of game an "Any" storyteller runs.
+        turn.entry["QueueType"] = turn.game_type
+        self.notified = (turn, self.merged)
+        self.results.notified += 1
+        timeout = self.config.timings.start_timeout
+        answer_time = math.inf
+        if self.rng.random() < self.traffic.answer_probability:
+            answer_time = self.rng.expovariate(1 / self.traffic.mean_answer_time)
+        if answer_time <= timeout:
+            self.clock.call_later(answer_time, functools.partial(self.start, turn))
+        else:
+            self.clock.call_later(timeout, functools.partial(self.time_out, turn))
+
+    def run_policy(self):
+        if self.config.policy == "auto" and self.is_running():
+            decision = self.policy.decide(Snapshot(self.players_online(), self.queue_lengths(), self.clock.now))
+            if decision.changed:
+                self.policy.record_change(decision.merged, self.clock.now)
+                self.merged = decision.merged
+                self.results.merges_and_splits += 1
+        self.check_queue()
+        self.clock.call_later(POLICY_INTERVAL, self.run_policy)
+
+
+def read_joins(path: str) -> list[tuple[float, object, str]]:
+    joins = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                joins.append((float(row["time"]), row["user"], row["queue_type"]))
+    return sorted(joins, key=lambda join: join[0])
+
+
+def simulate(config: SimulationConfig, traffic: Traffic, days: float, seed: int = 0,
+             joins: Optional[list[tuple[float, object, str]]] = None) -> Results:
+    start = START_TIME if not joins else joins[0][0] - joins[0][0] % 86400
+    return Simulation(config, traffic, days, seed, joins, start).run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=float, default=90)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--joins', help='replay when storytellers joined from this file, rather than making it up')
+    parser.add_argument('--storytellers', type=int, default=Traffic.storytellers)
+    parser.add_argument('--peak-players', type=int, default=Traffic.peak_players)
+    parser.add_argument('--policy', default='merged,split,auto', help='comma-separated: merged, split or auto')
+    parser.add_argument('--cooldown-hours', default=str(QueueTimings.cooldown / 3600), help='comma-separated')
+    parser.add_argument('--start-timeout-minutes', default=str(QueueTimings.start_timeout / 60), help='comma-separated')
+    parser.add_argument('--players-per-game', default=str(PolicyConfig.players_per_game),
+                        help='comma-separated; the auto policy splits once there are enough for two games')
+    args = parser.parse_args()
+
+    joins = read_joins(args.joins) if args.joins else None
+    days = args.days
+    if joins:
+        days = min(days, (joins[-1][0] - joins[0][0]) / 86400 + 1)
+    traffic = Traffic(storytellers=args.storytellers, peak_players=args.peak_players)
+    configs = []
+    for policy, cooldown, timeout, players in itertools.product(
+            args.policy.split(','), args.cooldown_hours.split(','), args.start_timeout_minutes.split(','),
+            args.players_per_game.split(',')):
+        if policy != "auto" and players != args.players_per_game.split(',')[0]:
+            continue
+        timings = replace(QueueTimings(), cooldown=round(float(cooldown) * 3600),
+                          start_timeout=round(float(timeout) * 60))
+        configs.append(SimulationConfig(policy, timings, PolicyConfig(players_per_game=int(players))))
+
+    print(f"{days:g} days, {'replayed' if joins else f'{traffic.storytellers} synthetic'} storytellers, "
+          f"up to {traffic.peak_players} players")
+    print(f"{'configuration':<44} {'games/day':>9} {'wait p50':>8} {'wait p90':>8} {'skipped':>7} "
+          f"{'gave up':>7} {'fairness':>8} {'changes':>7}")
+    for config in configs:
+        start = time.perf_counter()
+        s = simulate(config, traffic, days, args.seed, joins).summary()
+        elapsed = time.perf_counter() - start
+        print(f"{config.describe():<44} {s['games_per_day']:>9.2f} {s['median_wait_hours']:>7.1f}h "
+              f"{s['p90_wait_hours']:>7.1f}h {s['skip_rate']:>7.1%} {s['gave_up_rate']:>7.1%} "
+              f"{s['fairness']:>8.3f} {s['merges_and_splits']:>7} ({elapsed:.2f} s)")
+
+
+if __name__ == '__main__':
+    main()
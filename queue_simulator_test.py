@@ -0,0 +1,46 @@
+"""
+Unit tests for the queue simulator.
+"""
+
+from dataclasses import replace
+
+from queue_policy import QueueTimings
+from queue_simulator import *
+
+def test_virtual_clock():
+    clock = VirtualClock(start=0)
+    seen = []
+    clock.call_later(10, lambda: seen.append(("b", clock.time())))
+    clock.call_later(5, lambda: clock.call_later(5, lambda: seen.append(("c", clock.time()))))
+    clock.call_at(1, lambda: seen.append(("a", clock.time())))
+    clock.call_later(30, lambda: seen.append(("late", clock.time())))
+    clock.run(until=20)
+    # Ties go in the order they were scheduled.
+    assert seen == [("a", 1), ("b", 10), ("c", 10)]
+    assert clock.time() == 20
+
+def test_repeatable():
+    first = simulate(SimulationConfig("auto"), Traffic(), days=14, seed=3).summary()
+    second = simulate(SimulationConfig("auto"), Traffic(), days=14, seed=3).summary()
+    assert first == second
+    assert first["games_per_day"] > 0
+
+def test_timings_and_policies():
+    traffic = Traffic(peak_players=60)
+    merged = simulate(SimulationConfig("merged"), traffic, days=28).summary()
+    split = simulate(SimulationConfig("split"), traffic, days=28).summary()
+    # With players for two games, splitting runs more of them.
+    assert split["games_per_day"] > merged["games_per_day"]
+    # Nobody can answer in time when there isn't any.
+    impatient = SimulationConfig("merged", replace(QueueTimings(), start_timeout=0))
+    skipped = simulate(impatient, traffic, days=7).summary()
+    assert skipped["games_per_day"] == 0 and skipped["skip_rate"] == 1
+
+def test_replay_joins():
+    joins = [(START_TIME + 20 * 3600, "alpha", "Pickup"), (START_TIME + 20 * 3600 + 60, "bravo", "Beginner"),
+             (START_TIME + 21 * 3600, "alpha", "Pickup")]
+    config = SimulationConfig("split", replace(QueueTimings(), start_timeout=10 ** 6))
+    results = simulate(config, Traffic(answer_probability=1), days=1, joins=joins)
+    # Both run a game at once, and alpha can't join again while on cooldown.
+    assert results.games == 2 and sorted(results.games_by_storyteller) == ["alpha", "bravo"]
+    assert results.rejected == 1
@@ -3,28 +3,124 @@ import asyncio
 import sys
 
 from datetime import datetime, timezone
+from .dashboard import Dashboard, GameLogWriter
+from .database import strip_ansi
 from .spy import *
+from .supervisor import MonitoredSessionState
 
-async def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('url')
-    args = parser.parse_args()
+def read_urls(args):
+    urls = list(args.url)
+    if args.file:
+        with open(args.file) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    urls.append(line)
+    # Watching the same game twice would only duplicate its log.
+    return list(dict.fromkeys(urls))
 
-    def print_ts(message):
-        ts = datetime.now(timezone.utc).strftime('\x1b[0;30m[%Y-%m-%d %H:%M:%S %Z]\x1b[0m')
-        print(ts, message)
+def timestamp():
+    return datetime.now(timezone.utc).strftime('[%Y-%m-%d %H:%M:%S %Z]')
+
+async def connect_via_hub_decoded(hub, url):
+    async for raw in connect_via_hub(hub, url):
+        m = None if is_ping(raw) else decode(raw)
+        if m is not None:
+            yield m
 
+async def watch(url, monitored, log, hub=None):
+    """
+    Follows one game (through a hub, if given), passing each line it logs to log.
+    """
     player_id = random_player_id()
-    socket_url, app_origin = interpret_url(args.url, player_id)
+    socket_url, app_origin = interpret_url(url, player_id)
     session = Session()
-    session.log = print_ts
-
-    socket = connect_to_session(socket_url, origin=app_origin, player_id=player_id)
+    session.log = log
+    monitored.session = session
+    if hub is not None:
+        socket = connect_via_hub_decoded(hub, url)
+    else:
+        socket = connect_to_session(socket_url, origin=app_origin, player_id=player_id, skip=is_ping)
     async for m in socket:
         try:
             receive(session, m)
         except Exception as e:
-            print('While processing', m, file=sys.stderr)
+            e.add_note(f'While processing {m!r:.200}')
             raise
+        monitored.record_message()
+
+async def scroll(url, writer, hub):
+    """
+    Prints one game's log as it happens.
+    """
+    def print_ts(message):
+        print(f'\x1b[0;30m{timestamp()}\x1b[0m', message)
+        if writer:
+            writer.write(url, f'{timestamp()} {strip_ansi(message)}')
+    await watch(url, MonitoredSessionState(), print_ts, hub)
+
+async def dashboard(urls, writer, interval, hub):
+    """
+    Shows a line for each game, with their logs only written to disk.
+    """
+    board = Dashboard(interval=interval)
+    async def watch_game(url):
+        monitored = MonitoredSessionState()
+        board.add(url, monitored)
+        def log(message):
+            line = strip_ansi(message)
+            board.changed(url, line)
+            if writer:
+                writer.write(url, f'{timestamp()} {line}')
+        try:
+            await watch(url, monitored, log, hub)
+        except Exception as e:
+            # One game failing shouldn't stop the others being watched.
+            monitored.last_error = e
+            board.changed(url)
+    drawing = asyncio.create_task(board.run())
+    try:
+        await asyncio.gather(*(watch_game(url) for url in urls))
+    finally:
+        drawing.cancel()
+        board.draw()
+        await asyncio.gather(drawing, return_exceptions=True)
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('url', nargs='*')
+    parser.add_argument('--file', '-f', help='read more URLs from a file, one per line')
+    parser.add_argument('--dashboard', action='store_true',
+                        help='show a line for each game, even if only watching one (the default for several)')
+    parser.add_argument('--log-dir', help='append each game\'s log to a file in this directory')
+    parser.add_argument('--hub', help='follow games through the hub listening on this Unix socket')
+    parser.add_argument('--refresh', type=float, default=0.5,
+                        help='redraw the dashboard at most this often, in seconds')
+    parser.add_argument('--stats', action='store_true',
+                        help='report time spent handling each message type on exit')
+    args = parser.parse_args()
+    urls = read_urls(args)
+    if not urls:
+        parser.error('no URLs to watch')
+
+    if args.stats:
+        stats = HandlerStats()
+        handler_observers.append(stats)
+
+    writer = GameLogWriter(args.log_dir) if args.log_dir else None
+    try:
+        if len(urls) == 1 and not args.dashboard:
+            await scroll(urls[0], writer, args.hub)
+        else:
+            await dashboard(urls, writer, args.refresh, args.hub)
+    finally:
+        if writer:
+            writer.close()
+        if args.stats:
+            print('Message handling:', file=sys.stderr)
+            for line in stats.summary():
+                print(f'* {line}', file=sys.stderr)
+            for elapsed, m in stats.slow_samples:
+                print(f'Slow ({elapsed * 1000:.2f} ms): {m!r:.200}', file=sys.stderr)
 
-asyncio.run(main())
\ No newline at end of file
+asyncio.run(main())
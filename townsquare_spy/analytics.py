@@ -0,0 +1,257 @@
+"""
+This module exports the spy's history into columns of NumPy arrays, one file
+per column, and computes statistics about many games at once from them.
+
+Exporting summarizes each session (and each nomination which went to a vote)
+in a single pass over the database, on its maintenance thread. The files are
+then memory-mapped, so the statistics only read the columns they need, and
+are computed without looping over games in Python.
+
+NumPy is only needed here, so the bot imports this module when it is used.
+"""
+
+import functools
+import json
+import os
+import shutil
+import sqlite3
+
+from collections.abc import Callable
+from datetime import datetime, timezone
+from typing import Any, Optional
+
+import numpy as np
+
+# Bumped whenever the columns change, so that older exports are rebuilt.
+EXPORT_VERSION = 2
+
+# The columns of each table, in the order they are selected.
+SESSION_COLUMNS = np.dtype([
+    ("session_id", np.int64),
+    ("start", np.float64),      # Seconds since the epoch.
+    ("end", np.float64),        # When the last message was logged.
+    ("messages", np.int32),
+    ("players", np.int16),      # The most players seated at once.
+    ("script", np.int32),       # An index into the manifest's scripts, or -1.
+    ("deaths", np.int16),
+    ("nominations", np.int16),  # Those which went to a vote.
+    ("executions", np.int16),   # Players still marked for execution when night fell.
+])
+NOMINATION_COLUMNS = np.dtype([
+    ("session_id", np.int64),
+    ("time", np.float64),
+    ("votes", np.int16),
+    ("living_players", np.int16),
+    ("on_the_block", np.bool_),
+    ("tied", np.bool_),
+])
+
+# SQLite's times are converted to seconds since the epoch, to the millisecond.
+# (Going through julianday would put times on the hour a little before it.)
+EPOCH_SECONDS = "(CAST(strftime('%s', {0}) AS INTEGER) + (strftime('%f', {0}) - strftime('%S', {0})))"
+
+# Game lengths are counted in these ranges, in minutes.
+LENGTH_BINS = [0, 30, 60, 90, 120, 180, 240, np.inf]
+
+
+def export_columns(conn: sqlite3.Connection, directory: str, sources: list[Optional[str]] = [None],
+                   attach: Callable[[Optional[str]], str] = lambda name: "main"):
+    """
+    Summarizes the sessions in each of the partitions in sources (attached by
+    attach) into columns, replacing any export already in directory.
+    The new export is written alongside and then moved into place, so that
+    anything reading the old one isn't left with a mixture.
+    """
+    scripts = dict()
+    session_chunks = []
+    nomination_chunks = []
+    for name in sources:
+        schema = attach(name)
+        cur = conn.execute(
+            f"""
+                WITH
+                    log AS (
+                        SELECT session_id, MAX(timestamp) AS last, COUNT(*) AS messages,
+                            MAX(json_array_length(log_text(state), '$.players')) AS players
+                        FROM {schema}.session_log
+                        GROUP BY session_id),
+                    events AS (
+                        SELECT session_id, SUM(kind = 'death') AS deaths, SUM(kind = 'execution') AS executions
+                        FROM {schema}.session_events
+                        GROUP BY session_id),
+                    -- SQLite takes the target from the row with the highest seq.
+                    editions AS (
+                        SELECT session_id, target, MAX(seq)
+                        FROM {schema}.session_events
+                        WHERE kind = 'edition'
+                        GROUP BY session_id),
+                    nominations AS (
+                        SELECT session_id, COUNT(*) AS nominations
+                        FROM {schema}.session_nominations
+                        GROUP BY session_id)
+                SELECT sessions.id, {EPOCH_SECONDS.format("sessions.session_start")},
+                    {EPOCH_SECONDS.format("log.last")}, log.messages, IFNULL(log.players, 0),
+                    editions.target, IFNULL(events.deaths, 0), IFNULL(nominations.nominations, 0),
+                    IFNULL(events.executions, 0)
+                FROM main.sessions
+                JOIN log ON log.session_id = sessions.id
+                LEFT JOIN events ON events.session_id = sessions.id
+                LEFT JOIN editions ON editions.session_id = sessions.id
+                LEFT JOIN nominations ON nominations.session_id = sessions.id
+                WHERE sessions.partition_name IS ?
+            """,
+            (name,))
+        session_chunks.append(np.fromiter(
+            ((*row[:5], -1 if row[5] is None else scripts.setdefault(row[5], len(scripts)), *row[6:]) for row in cur),
+            dtype=SESSION_COLUMNS))
+        cur = conn.execute(
+            f"""
+                SELECT session_id, {EPOCH_SECONDS.format("session_log.timestamp")}, votes,
+                    IFNULL(living_players, 0), on_the_block, tied
+                FROM {schema}.session_nominations
+                JOIN {schema}.session_log USING (session_id, seq)
+                JOIN main.sessions ON sessions.id = session_id
+                WHERE sessions.partition_name IS ?
+            """,
+            (name,))
+        nomination_chunks.append(np.fromiter(cur, dtype=NOMINATION_COLUMNS))
+
+    sessions = np.sort(np.concatenate(session_chunks), order="session_id")
+    nominations = np.sort(np.concatenate(nomination_chunks), order=["session_id", "time"])
+    temp_directory = directory + ".tmp"
+    shutil.rmtree(temp_directory, ignore_errors=True)
+    for table, rows in [("sessions", sessions), ("nominations", nominations)]:
+        os.makedirs(os.path.join(temp_directory, table))
+        for column in rows.dtype.names:
+            np.save(os.path.join(temp_directory, table, f"{column}.npy"), np.ascontiguousarray(rows[column]))
+    with open(os.path.join(temp_directory, "manifest.json"), "w") as f:
+        json.dump(dict(version=EXPORT_VERSION, exported_at=datetime.now(timezone.utc).isoformat(),
+                       scripts=list(scripts)), f)
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.replace(temp_directory, directory)
+
+
+async def export(db_thread: Any, directory: str):
+    """
+    Exports a DatabaseThread's sessions (other than archived ones) on its maintenance thread.
+    """
+    def export_on_thread(conn: sqlite3.Connection):
+        export_columns(conn, directory, db_thread.sources(conn), functools.partial(db_thread.attach, conn))
+    await db_thread.maintain(export_on_thread)
+
+
+class Columns(object):
+    """
+    An export, with each column memory-mapped as it is first used.
+    """
+    directory: str
+    exported_at: datetime
+    scripts: list[str]
+    loaded: dict[tuple[str, str], np.ndarray]
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, "manifest.json")) as f:
+            manifest = json.load(f)
+        if manifest["version"] != EXPORT_VERSION:
+            raise ValueError(f"{directory} was exported by another version and must be exported again")
+        self.directory = directory
+        self.exported_at = datetime.fromisoformat(manifest["exported_at"])
+        self.scripts = manifest["scripts"]
+        self.loaded = dict()
+
+    def column(self, table: str, name: str) -> np.ndarray:
+        if (table, name) not in self.loaded:
+            self.loaded[table, name] = np.load(os.path.join(self.directory, table, f"{name}.npy"), mmap_mode="r")
+        return self.loaded[table, name]
+
+    def sessions(self, name: str) -> np.ndarray:
+        return self.column("sessions", name)
+
+    def nominations(self, name: str) -> np.ndarray:
+        return self.column("nominations", name)
+
+
+def game_lengths(columns: Columns) -> dict[str, Any]:
+    """
+    The distribution of how long games lasted, in minutes: a count for each
+    of LENGTH_BINS, and the median and 90th percentile.
+    """
+    minutes = (columns.sessions("end") - columns.sessions("start")) / 60
+    counts, _ = np.histogram(minutes, bins=LENGTH_BINS)
+    median, p90 = np.percentile(minutes, [50, 90]) if len(minutes) else (0.0, 0.0)
+    return dict(counts=counts.tolist(), median=float(median), p90=float(p90))
+
+
+def executions_by_script(columns: Columns, min_games: int = 1) -> list[tuple[str, int, float]]:
+    """
+    For each script played at least min_games times, the number of games and
+    the average number of executions (marks still standing when night fell)
+    in each, most played first.
+    """
+    script = columns.sessions("script")
+    known = script >= 0
+    games = np.bincount(script[known], minlength=len(columns.scripts))
+    executions = np.bincount(script[known], weights=columns.sessions("executions")[known],
+                             minlength=len(columns.scripts))
+    order = np.argsort(-games, kind="stable")
+    return [(columns.scripts[i], int(games[i]), float(executions[i] / games[i]))
+            for i in order if games[i] >= min_games]
+
+
+def nomination_patterns(columns: Columns) -> dict[str, float]:
+    """
+    How nominations which went to a vote tend to go: how many there are in
+    each game, the share of the living players who vote, and how often the
+    nominee goes on the block or ties.
+    """
+    votes = columns.nominations("votes")
+    living = columns.nominations("living_players")
+    count = len(votes)
+    games = len(columns.sessions("session_id"))
+    share = np.divide(votes, living, out=np.zeros(count), where=living > 0)
+    return dict(
+        nominations=count,
+        per_game=count / games if games else 0.0,
+        mean_votes=float(votes.mean()) if count else 0.0,
+        vote_share=float(share.mean()) if count else 0.0,
+        on_the_block=float(columns.nominations("on_the_block").mean()) if count else 0.0,
+        tied=float(columns.nominations("tied").mean()) if count else 0.0,
+    )
+
+
+def players_by_hour(columns: Columns) -> list[tuple[int, int, float]]:
+    """
+    For each hour of the day (UTC) in which games started, the number of
+    games and the average number of players in them.
+    """
+    hours = (columns.sessions("start") // 3600 % 24).astype(np.int64)
+    games = np.bincount(hours, minlength=24)
+    players = np.bincount(hours, weights=columns.sessions("players"), minlength=24)
+    return [(hour, int(games[hour]), float(players[hour] / games[hour])) for hour in range(24) if games[hour]]
+
+
+def summary(columns: Columns) -> list[str]:
+    """
+    A summary of all of the statistics, as lines of text.
+    """
+    games = len(columns.sessions("session_id"))
+    lines = [f"{games} games, exported {columns.exported_at:%Y-%m-%d %H:%M} UTC."]
+    if not games:
+        return lines
+    lengths = game_lengths(columns)
+    ranges = [f"{low:g}-{high:g}" if np.isfinite(high) else f"{low:g}+"
+              for low, high in zip(LENGTH_BINS, LENGTH_BINS[1:])]
+    lines.append(f"Game length: median {lengths['median']:.0f} min, 90% within {lengths['p90']:.0f} min "
+                 f"({', '.join(f'{r}: {c}' for r, c in zip(ranges, lengths['counts']))})")
+    noms = nomination_patterns(columns)
+    lines.append(f"Nominations: {noms['per_game']:.1f} per game, {noms['mean_votes']:.1f} votes each "
+                 f"({noms['vote_share']:.0%} of the living), {noms['on_the_block']:.0%} put someone on the block, "
+                 f"{noms['tied']:.0%} tied")
+    by_script = executions_by_script(columns)[:10]
+    if by_script:
+        lines.append("Executions per game by script:")
+        lines += [f"  {name}: {rate:.2f} ({count} games)" for name, count, rate in by_script]
+    lines.append("Games and players by starting hour (UTC):")
+    lines += [f"  {hour:02}:00 {count} games, {players:.1f} players" for hour, count, players in players_by_hour(columns)]
+    return lines
@@ -0,0 +1,54 @@
+"""
+Unit tests for the columnar export and the statistics computed from it.
+"""
+
+import asyncio
+import json
+
+from datetime import datetime, timedelta, timezone
+
+from analytics import *
+from database import DatabaseThread
+
+def state(players):
+    return json.dumps(dict(players=[dict(name=f"Player {i}") for i in range(players)], fabled=[]))
+
+async def log_game(db_thread, url, start, minutes, edition, players, executed):
+    session_id = await db_thread.start_session(url, start)
+    messages = [dict(session_id=session_id, seq=1, timestamp=start, message="The script was changed.",
+                     state=state(players)),
+                dict(session_id=session_id, seq=2, timestamp=start + timedelta(minutes=minutes),
+                     message="The following players voted: ...", state=None)]
+    events = [dict(session_id=session_id, seq=1, kind="edition", player=None, target=edition)]
+    # Marks which were moved or cleared don't count as executions.
+    events += [dict(session_id=session_id, seq=2, kind=kind, player=f"Player {i}", target=None)
+               for i in range(executed) for kind in ["marked", "marked", "execution"]]
+    nominations = [dict(session_id=session_id, seq=2, nominator="Player 0", nominee="Player 1", votes=players // 2,
+                        voters="[]", dead_voters="[]", living_players=players, on_the_block=True, tied=False)]
+    await db_thread.log(messages, events, nominations=nominations)
+
+def test_export_and_stats(tmp_path):
+    start = datetime(2024, 3, 1, 19, tzinfo=timezone.utc)
+    async def run():
+        db_thread = DatabaseThread(":memory:")
+        await log_game(db_thread, "https://clocktower.online/#a", start, 75, "TB", 10, 3)
+        await log_game(db_thread, "https://clocktower.online/#b", start + timedelta(hours=1), 150, "TB", 12, 1)
+        await log_game(db_thread, "https://clocktower.online/#c", start, 20, "BMR", 8, 0)
+        await export(db_thread, str(tmp_path / "columns"))
+        db_thread.close()
+    asyncio.run(run())
+
+    columns = Columns(str(tmp_path / "columns"))
+    assert columns.scripts == ["TB", "BMR"]
+    assert columns.sessions("session_id").tolist() == [1, 2, 3]
+    assert columns.sessions("start")[0] == start.timestamp()
+    assert columns.sessions("players").tolist() == [10, 12, 8]
+    assert columns.nominations("votes").tolist() == [5, 6, 4]
+
+    lengths = game_lengths(columns)
+    assert lengths["counts"] == [1, 0, 1, 0, 1, 0, 0]
+    assert round(lengths["median"]) == 75
+    assert executions_by_script(columns) == [("TB", 2, 2.0), ("BMR", 1, 0.0)]
+    assert nomination_patterns(columns)["vote_share"] == 0.5
+    assert players_by_hour(columns) == [(19, 2, 9.0), (20, 1, 12.0)]
+    assert summary(columns)[0].startswith("3 games")
@@ -0,0 +1,144 @@
+"""
+Reprocesses the spy's history: every session's log, events, nominations,
+checkpoints and search index are derived again from the frames it received,
+as the current version of spy.py would have logged them. Sessions logged
+before frames were kept can't be, and are left alone.
+
+Sessions are replayed in parallel by a pool of processes, each reading from
+the database itself, and their rows are written through the same group
+commit as the monitors' (see DatabaseThread.rewrite). Each session is marked
+as done for the run in the same transaction as its rows, so an interrupted
+run picks up where it left off when started again with the same name.
+Lines the monitor added itself, such as noting that activity resumed after a
+quiet period, aren't recreated. It can be invoked as:
+
+    python -m townsquare_spy.backfill townsquare.db --run organ-grinder
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from urllib.request import pathname2url
+
+from .database import DatabaseThread, TUNING_PROFILES, attach_partition, partition_path
+from .monitor import SessionRecorder
+from .spy import Session
+
+# Sessions which received a frame more recently than this may still be being
+# monitored, so are skipped unless asked otherwise.
+QUIET_MINUTES = 60
+
+# Each worker process opens the database once.
+worker_conn: Optional[sqlite3.Connection] = None
+
+
+def derive_session(path: str, session_id: int) -> Optional[tuple[list[dict], ...]]:
+    """
+    Replays a session's frames, returning the messages, events, checkpoints,
+    nominations and scripts it logs (without the session_id), or None if it
+    has no frames. Runs in a worker process.
+    """
+    global worker_conn
+    if worker_conn is None:
+        worker_conn = sqlite3.connect(f"file:{pathname2url(path)}?mode=ro", uri=True)
+    row = worker_conn.execute("SELECT partition_name FROM sessions WHERE id = ?", (session_id,)).fetchone()
+    name = row and row[0]
+    schema = "main" if name is None else attach_partition(worker_conn, partition_path(path, name), name)
+    cur = worker_conn.execute(
+        f"SELECT timestamp, frame FROM {schema}.session_frames WHERE session_id = ? ORDER BY seq",
+        (session_id,))
+    # Everything is timestamped as of the frame which caused it.
+    timestamp = None
+    recorder = SessionRecorder(Session(), clock=lambda: timestamp, record_frames=False)
+    for timestamp, frame in cur:
+        recorder.receive(json.loads(frame))
+    if recorder.frame_seq == 0:
+        return None
+    messages, events, frames, checkpoints, nominations, scripts = recorder.take(session_id)
+    return messages, events, checkpoints, nominations, scripts
+
+
+async def backfill(path: str, run: str, workers: int, restart: bool, quiet_minutes: float,
+                   profile: str, compress_log: bool):
+    db_thread = DatabaseThread(path, profile=profile, compress_log=compress_log)
+    loop = asyncio.get_running_loop()
+    if restart:
+        def restart_on_thread():
+            db_thread.conn.execute("DELETE FROM backfill_progress WHERE run = ?", (run,))
+            db_thread.conn.commit()
+        await loop.run_in_executor(db_thread.executor, restart_on_thread)
+
+    cutoff = datetime.now(timezone.utc) - timedelta(minutes=quiet_minutes)
+    def list_on_thread(conn: sqlite3.Connection):
+        session_ids = []
+        for name in db_thread.sources(conn):
+            session_ids += [session_id for (session_id,) in conn.execute(
+                f"""
+                    SELECT id FROM main.sessions
+                    WHERE partition_name IS :name
+                        AND id NOT IN (SELECT session_id FROM main.backfill_progress WHERE run = :run)
+                        AND (SELECT MAX(timestamp) FROM {db_thread.attach(conn, name)}.session_frames
+                             WHERE session_id = sessions.id) < :cutoff
+                """,
+                dict(name=name, run=run, cutoff=cutoff))]
+        return sorted(session_ids)
+    session_ids = await db_thread.read(list_on_thread)
+    print(f"{len(session_ids)} sessions to rewrite for {run!r}, with {workers} workers")
+
+    done = failed = rows = 0
+    start = last_report = time.monotonic()
+    remaining = iter(session_ids)
+    async def lane(pool: ProcessPoolExecutor):
+        # Each lane handles one session at a time. There are twice as many as
+        # workers, so that the pool is kept busy while rows are being written.
+        nonlocal done, failed, rows, last_report
+        for session_id in remaining:
+            try:
+                derived = await loop.run_in_executor(pool, derive_session, path, session_id)
+            except Exception as e:
+                failed += 1
+                print(f"Session {session_id} couldn't be replayed: {e!r}")
+                continue
+            if derived is None:
+                continue
+            await db_thread.rewrite(session_id, *derived, backfill_run=run)
+            done += 1
+            rows += len(derived[0])
+            if time.monotonic() - last_report >= 10:
+                last_report = time.monotonic()
+                print(f"{done}/{len(session_ids)} sessions, {rows / (last_report - start):.0f} rows/s")
+
+    with ProcessPoolExecutor(workers) as pool:
+        await asyncio.gather(*(lane(pool) for i in range(workers * 2)))
+    db_thread.close()
+    elapsed = time.monotonic() - start
+    print(f"Rewrote {done} sessions ({rows} log rows) in {elapsed:.1f} s "
+          f"({db_thread.transactions} transactions), {failed} failed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='the database to reprocess, such as townsquare.db')
+    parser.add_argument('--run', default='backfill',
+                        help='a name for this run; sessions it has already rewritten are skipped')
+    parser.add_argument('--restart', action='store_true', help='rewrite every session again, even if done in this run')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--quiet-minutes', type=float, default=QUIET_MINUTES,
+                        help='skip sessions which received anything more recently than this')
+    parser.add_argument('--profile', choices=TUNING_PROFILES.keys(), default='wal')
+    parser.add_argument('--compress-log', action='store_true',
+                        help='compress rewritten rows with the latest log dictionary, as the bot would')
+    args = parser.parse_args()
+    asyncio.run(backfill(args.path, args.run, args.workers, args.restart, args.quiet_minutes,
+                         args.profile, args.compress_log))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Unit tests for reprocessing sessions from their frames.
+"""
+
+import asyncio
+import os
+import random
+import sqlite3
+import tempfile
+
+from datetime import datetime, timedelta, timezone
+
+from townsquare_spy import backfill
+from townsquare_spy.database import DatabaseThread
+from townsquare_spy.monitor import SessionRecorder
+from townsquare_spy.spy import Session
+from townsquare_spy.synthetic import SyntheticGame
+
+async def record_game(db_thread, url, start, seed=0, messages=300):
+    """
+    Records a synthetic game as a monitor would, a second per message, returning its ID and log rows.
+    """
+    game = SyntheticGame(random.Random(seed), player_count=7)
+    session_id = await db_thread.start_session(url, start)
+    timestamp = start
+    recorder = SessionRecorder(Session(), clock=lambda: timestamp)
+    for i, m in enumerate([game.edition(), game.game_state()] + [game.next_message() for i in range(messages)]):
+        timestamp = start + timedelta(seconds=i)
+        recorder.receive(m)
+    rows = recorder.take(session_id)
+    await db_thread.log(*rows)
+    return session_id, rows
+
+def summarize(messages, events):
+    return ([(row["seq"], row["message"]) for row in messages],
+            [(row["seq"], row["kind"], row["player"], row["target"]) for row in events])
+
+def test_derive_session():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "townsquare.db")
+        async def run():
+            db_thread = DatabaseThread(path)
+            recorded = await record_game(db_thread, "https://clocktower.online/#game",
+                                         datetime(2024, 3, 1, 19, tzinfo=timezone.utc))
+            db_thread.close()
+            return recorded
+        session_id, (messages, events, frames, checkpoints, nominations, scripts) = asyncio.run(run())
+        try:
+            derived = backfill.derive_session(path, session_id)
+        finally:
+            backfill.worker_conn.close()
+            backfill.worker_conn = None
+    assert events and nominations
+    assert summarize(derived[0], derived[1]) == summarize(messages, events)
+    assert len(derived[3]) == len(nominations)
+
+def test_backfill_resumes(capsys):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "townsquare.db")
+        now = datetime.now(timezone.utc)
+        async def record():
+            db_thread = DatabaseThread(path)
+            old, (messages, events, *rest) = await record_game(
+                db_thread, "https://clocktower.online/#old", now - timedelta(hours=3))
+            # Received something just now, so may still be being monitored.
+            await record_game(db_thread, "https://clocktower.online/#recent", now - timedelta(minutes=5), seed=1)
+            db_thread.close()
+            return old, messages
+        old, messages = asyncio.run(record())
+
+        def run_backfill():
+            asyncio.run(backfill.backfill(path, "nominations", workers=1, restart=False,
+                                          quiet_minutes=backfill.QUIET_MINUTES, profile="wal", compress_log=False))
+            return capsys.readouterr().out
+        first = run_backfill()
+        second = run_backfill()
+
+        conn = sqlite3.connect(path)
+        done = conn.execute("SELECT session_id FROM backfill_progress WHERE run = 'nominations'").fetchall()
+        partition = conn.execute("SELECT partition_name FROM sessions WHERE id = ?", (old,)).fetchone()[0]
+        conn.execute("ATTACH ? AS p", (os.path.join(temp_dir, f"townsquare-{partition}.db"),))
+        rewritten = conn.execute("SELECT seq, message FROM p.session_log WHERE session_id = ? ORDER BY seq",
+                                 (old,)).fetchall()
+        conn.close()
+    assert "1 sessions to rewrite" in first and "Rewrote 1 sessions" in first
+    # Sessions already rewritten in this run are skipped.
+    assert "0 sessions to rewrite" in second
+    assert done == [(old,)]
+    assert rewritten == [(row["seq"], row["message"]) for row in messages]
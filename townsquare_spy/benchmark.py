@@ -0,0 +1,202 @@
+"""
+Benchmarks for the townsquare spy's storage.
+
+These use a temporary database on disk, so the results reflect the cost of
+actually committing to it. It can be invoked as:
+
+    python -m townsquare_spy.benchmark
+
+or, to compare storing synthetic games' logs with and without compressing
+them with a trained dictionary (see LogCodec):
+
+    python -m townsquare_spy.benchmark --log-codec
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import zlib
+
+from datetime import datetime, timezone
+
+from .database import DatabaseThread, LogCodec, TUNING_PROFILES, train_dictionary
+from .monitor import summarize_state
+from .spy import Session, receive
+from .synthetic import SyntheticGame
+
+
+async def simulated_game(db_thread: DatabaseThread, url: str, frames: int, rows_per_frame: int):
+    """
+    Logs like monitor_session would: a few rows per frame, waiting for each
+    frame's rows to be committed before handling the next one.
+    """
+    session_id = await db_thread.start_session(url, datetime.now(timezone.utc))
+    seq = 0
+    for i in range(frames):
+        messages = []
+        for j in range(rows_per_frame):
+            seq += 1
+            messages.append(dict(
+                session_id=session_id,
+                seq=seq,
+                timestamp=datetime.now(timezone.utc),
+                message=f'\x1b[1;36mPlayer {j}\x1b[0m voted.',
+                state=None))
+        await db_thread.log(messages)
+
+
+async def bench_writes(games: int, frames: int, rows_per_frame: int, profile: str, flush_interval: float, flush_rows: int):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "bench.db")
+        db_thread = DatabaseThread(path, profile=profile,
+                                   flush_interval=flush_interval, flush_rows=flush_rows)
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            simulated_game(db_thread, f'https://clocktower.online/#bench{i}', frames, rows_per_frame)
+            for i in range(games)))
+        elapsed = time.perf_counter() - start
+
+        # Then see how long it takes to read one session back.
+        query_start = time.perf_counter()
+        latest = await db_thread.latest('https://clocktower.online/#bench0')
+        query_elapsed = time.perf_counter() - query_start
+        # Sizes are compared after moving everything out of the write-ahead logs,
+        # and include the partitions.
+        await asyncio.get_running_loop().run_in_executor(
+            db_thread.executor, db_thread.conn.execute, "PRAGMA wal_checkpoint(TRUNCATE)")
+        db_thread.close()
+        size = sum(os.path.getsize(os.path.join(temp_dir, f)) for f in os.listdir(temp_dir))
+    rows = db_thread.rows_written
+    print(f'{games:4} games: {rows:8} rows in {elapsed:7.2f} s = {rows / elapsed:10.0f} rows/s '
+          f'({db_thread.transactions} transactions for {games * frames} frames), '
+          f'{size / rows:5.1f} bytes/row, {len(latest)} rows read in {query_elapsed * 1000:.1f} ms')
+
+
+def synthetic_log(seed: int, frames: int) -> list[tuple[str, str]]:
+    """
+    The messages a synthetic game logs, each with the state summary the
+    monitor would log alongside it (or None if that didn't change).
+    """
+    game = SyntheticGame(random.Random(seed))
+    session = Session()
+    rows = []
+    last_state = None
+    def log(message):
+        nonlocal last_state
+        state = summarize_state(session)
+        rows.append((message, None if state == last_state else state))
+        last_state = state
+    session.log = log
+    receive(session, game.edition())
+    receive(session, game.game_state())
+    for i in range(frames):
+        receive(session, game.next_message())
+    return rows
+
+
+async def log_games(db_thread: DatabaseThread, logs: dict[str, list[tuple[str, str]]]):
+    session_start = datetime.now(timezone.utc)
+    for url, rows in logs.items():
+        session_id = await db_thread.start_session(url, session_start)
+        await db_thread.log([
+            dict(session_id=session_id, seq=seq, timestamp=session_start, message=message, state=state)
+            for seq, (message, state) in enumerate(rows, start=1)])
+
+
+def time_per_row(function, values: list) -> float:
+    start = time.perf_counter()
+    for value in values:
+        function(value)
+    return (time.perf_counter() - start) / len(values)
+
+
+async def bench_log_codec(games: int, frames: int, profile: str):
+    """
+    Logs half of the games, trains a dictionary on them, then logs the rest
+    to one database compressing them and another not, and compares the two.
+    """
+    logs = {f'https://clocktower.online/#bench{i}': synthetic_log(i, frames) for i in range(games)}
+    training = dict(list(logs.items())[:games // 2])
+    held_out = dict(list(logs.items())[games // 2:])
+    texts = [text for rows in held_out.values() for row in rows for text in row if text]
+    size = sum(len(text.encode()) for text in texts)
+
+    codec = LogCodec(enabled=True)
+    codec.add(1, train_dictionary([text.encode() for rows in training.values() for row in rows for text in row if text]))
+    encoded = [codec.encode(text) for text in texts]
+    encoded_size = sum(len(value) if isinstance(value, bytes) else len(value.encode()) for value in encoded)
+    plain_size = sum(min(len(text.encode()), len(zlib.compress(text.encode(), 9))) for text in texts)
+    print(f'{len(texts)} messages and states, {size / len(texts):.1f} bytes each: '
+          f'{plain_size / len(texts):.1f} bytes with zlib alone, {encoded_size / len(texts):.1f} with a dictionary '
+          f'({size / encoded_size:.1f}x smaller)')
+    print(f'Per row: {time_per_row(codec.encode, texts) * 1e6:.1f} µs to compress, '
+          f'{time_per_row(codec.decode, encoded) * 1e6:.1f} µs to decompress')
+
+    for compress_log in [False, True]:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_thread = DatabaseThread(os.path.join(temp_dir, "bench.db"), profile=profile, compress_log=compress_log)
+            await log_games(db_thread, training)
+            if compress_log:
+                await db_thread.train_log_dictionary()
+            before = await table_sizes(db_thread)
+            await log_games(db_thread, held_out)
+            after = await table_sizes(db_thread)
+            query_start = time.perf_counter()
+            for url in held_out:
+                await db_thread.latest(url)
+            query_elapsed = (time.perf_counter() - query_start) / len(held_out)
+            db_thread.close()
+        growth = {name: after[name] - before.get(name, 0) for name in after}
+        print(f'{"Compressed" if compress_log else "Uncompressed":12}: held-out games grew session_log by '
+              f'{growth["session_log"] / 1024:6.0f} KiB and the search index by '
+              f'{growth["session_log_fts_data"] / 1024:4.0f} KiB, '
+              f'{query_elapsed * 1000:.1f} ms to read a game\'s log')
+
+
+async def table_sizes(db_thread: DatabaseThread) -> dict[str, int]:
+    """
+    The space used by session_log and its search index, after moving everything
+    out of the write-ahead logs. Every session benchmarked is in the same partition.
+    """
+    def read_on_thread(conn: sqlite3.Connection):
+        return dict(conn.execute(
+            """
+                SELECT name, SUM(pgsize) FROM dbstat(?)
+                WHERE name IN ('session_log', 'session_log_fts_data') GROUP BY name
+            """,
+            (db_thread.session_schema(conn, 1),)).fetchall())
+    def checkpoint_on_thread():
+        db_thread.conn.execute(f"PRAGMA {db_thread.writer_schema(1)}.wal_checkpoint(TRUNCATE)")
+    await asyncio.get_running_loop().run_in_executor(db_thread.executor, checkpoint_on_thread)
+    return await db_thread.read(read_on_thread)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--games', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--frames', type=int, default=200, help='frames logged by each game')
+    parser.add_argument('--rows-per-frame', type=int, default=3)
+    parser.add_argument('--profile', choices=TUNING_PROFILES.keys(), default='wal')
+    parser.add_argument('--flush-interval', type=float, default=0)
+    parser.add_argument('--flush-rows', type=int, default=1000)
+    parser.add_argument('--log-codec', action='store_true',
+                        help='instead compare logging with and without compression (of --games[0] games)')
+    args = parser.parse_args()
+
+    if args.log_codec:
+        asyncio.run(bench_log_codec(args.games[0], args.frames, args.profile))
+        return
+
+    print(f'Group commit every {args.flush_interval * 1000:g} ms or {args.flush_rows} rows, '
+          f'{args.profile} profile')
+    for games in args.games:
+        asyncio.run(bench_writes(games, args.frames, args.rows_per_frame,
+                                 args.profile, args.flush_interval, args.flush_rows))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""
+This module implements the terminal dashboard used by the command-line tool
+when it watches several games at once, and the background writer for the
+per-game logs it keeps.
+
+It only reads the state of sessions, so it can be tested without connecting
+to anything.
+"""
+
+import asyncio
+import os
+import queue
+import re
+import shutil
+import sys
+import threading
+import time
+
+from collections.abc import Callable
+from typing import TYPE_CHECKING, Optional, TextIO
+
+if TYPE_CHECKING:
+    from .supervisor import MonitoredSessionState
+
+
+def game_name(url: str) -> str:
+    """
+    A short name for a game, suitable for a file name: its room.
+    """
+    return re.sub(r'[^A-Za-z0-9_-]', '_', url.rsplit('#', 1)[-1])
+
+
+def describe_nomination(monitored: "MonitoredSessionState") -> str:
+    session = monitored.session
+    if not session.nomination:
+        return ""
+    names = [session.players[i].name if 0 <= i < len(session.players) else "?"
+             for i in session.nomination]
+    text = " → ".join(names)
+    if session.is_vote_in_progress:
+        text += f" ({session.vote_count} votes)"
+    return text
+
+
+class Dashboard(object):
+    """
+    Shows a line for each game, redrawing at most once every interval seconds
+    however many messages arrive, and then only the lines which changed.
+    Lines are also redrawn every refresh seconds even if nothing happened,
+    so that message rates decay.
+    """
+    games: dict[str, "MonitoredSessionState"]
+    last_lines: dict[str, str]
+    out: TextIO
+    interval: float
+    refresh: float
+    clock: Callable[[], float]
+    dirty: bool
+    drawn: list[str]
+    last_draw: Optional[float]
+    redraws: int
+
+    def __init__(self, out: TextIO = sys.stdout, interval: float = 0.5, refresh: float = 5.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.games = dict()
+        self.last_lines = dict()
+        self.out = out
+        self.interval = interval
+        self.refresh = refresh
+        self.clock = clock
+        self.dirty = True
+        self.drawn = []
+        self.last_draw = None
+        self.redraws = 0
+
+    def add(self, url: str, monitored: "MonitoredSessionState"):
+        self.games[url] = monitored
+        self.dirty = True
+
+    def changed(self, url: str, line: Optional[str] = None):
+        """
+        Called when a game receives a message, and optionally logs a (plain text) line.
+        """
+        if line is not None:
+            self.last_lines[url] = line
+        self.dirty = True
+
+    def render(self, now: float, width: int = 120) -> list[str]:
+        connected = sum(1 for m in self.games.values() if m.session is not None)
+        lines = [f"Watching {len(self.games)} games ({connected} connected)"[:width], ""]
+        for url, monitored in self.games.items():
+            name = game_name(url)[:16]
+            if monitored.last_error is not None:
+                status = f"error: {monitored.last_error!r}"
+            elif monitored.session is None:
+                status = "connecting"
+            else:
+                session = monitored.session
+                alive = sum(1 for p in session.players if not p.is_dead)
+                phase = "night" if session.is_night else "day"
+                status = (f"{phase:5} {alive:2}/{len(session.players):2} alive "
+                          f"{monitored.messages_per_minute(now):5.1f}/min "
+                          f"{describe_nomination(monitored):24.24} {self.last_lines.get(url, '')}")
+            lines.append(f"{name:16} {status}"[:width])
+        return lines
+
+    def draw(self, now: Optional[float] = None):
+        """
+        Draws the dashboard, only rewriting the lines which differ from those on screen.
+        """
+        if now is None:
+            now = self.clock()
+        lines = self.render(now, shutil.get_terminal_size().columns)
+        if not self.drawn:
+            self.out.write("\x1b[?25l\x1b[2J")
+        for row, line in enumerate(lines):
+            if row >= len(self.drawn) or self.drawn[row] != line:
+                self.out.write(f"\x1b[{row + 1};1H{line}\x1b[K")
+        if len(lines) < len(self.drawn):
+            self.out.write(f"\x1b[{len(lines) + 1};1H\x1b[J")
+        self.out.flush()
+        self.drawn = lines
+        self.dirty = False
+        self.last_draw = now
+        self.redraws += 1
+
+    def is_due(self, now: float) -> bool:
+        if self.last_draw is None:
+            return True
+        return now - self.last_draw >= (self.interval if self.dirty else self.refresh)
+
+    async def run(self):
+        """
+        Keeps the dashboard up to date until cancelled.
+        """
+        try:
+            while True:
+                now = self.clock()
+                if self.is_due(now):
+                    self.draw(now)
+                await asyncio.sleep(self.interval)
+        finally:
+            # Leave the cursor below the dashboard.
+            self.out.write(f"\x1b[{len(self.drawn) + 1};1H\x1b[?25h")
+            self.out.flush()
+
+
+class GameLogWriter(object):
+    """
+    Appends lines to a log file for each game in the given directory.
+    Writing happens on a separate thread, so that the event loop never waits
+    for the disk; lines queued together are flushed together.
+    """
+    directory: str
+    queue: queue.SimpleQueue
+    files: dict[str, TextIO]
+    thread: threading.Thread
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.queue = queue.SimpleQueue()
+        self.files = dict()
+        self.thread = threading.Thread(target=self.run, name="GameLogWriter", daemon=True)
+        self.thread.start()
+
+    def path(self, url: str) -> str:
+        return os.path.join(self.directory, f"{game_name(url)}.log")
+
+    def write(self, url: str, line: str):
+        self.queue.put((url, line))
+
+    def close(self):
+        """
+        Writes any lines still queued, then closes the files.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        closing = False
+        while not closing:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            written = set()
+            for item in batch:
+                if item is None:
+                    closing = True
+                    continue
+                url, line = item
+                if url not in self.files:
+                    self.files[url] = open(self.path(url), "a", encoding="utf-8")
+                self.files[url].write(line + "\n")
+                written.add(url)
+            for url in written:
+                self.files[url].flush()
+        for f in self.files.values():
+            f.close()
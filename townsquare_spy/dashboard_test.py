@@ -0,0 +1,54 @@
+"""
+Unit tests for the command-line dashboard and per-game logs.
+"""
+
+import io
+import os
+
+from dashboard import *
+from spy import Player, Session
+from supervisor import MonitoredSessionState
+
+def test_dashboard():
+    out = io.StringIO()
+    board = Dashboard(out=out, interval=0.5, refresh=5.0)
+    quiet = MonitoredSessionState()
+    busy = MonitoredSessionState(session=Session(
+        players=[Player(name="Alice"), Player(name="Bob", is_dead=True), Player(name="Carol")],
+        nomination=[0, 2], is_vote_in_progress=True, votes={0, 1}, vote_count=2))
+    board.add("https://clocktower.online/#quiet", quiet)
+    board.add("https://clocktower.online/#busy", busy)
+    for t in range(10):
+        busy.record_message(t)
+    board.changed("https://clocktower.online/#busy", "Alice nominated Carol.")
+    lines = board.render(10)
+    assert lines[0] == "Watching 2 games (1 connected)"
+    assert lines[2].startswith("quiet            connecting")
+    assert "day    2/ 3 alive" in lines[3]
+    assert "Alice → Carol (2 votes)" in lines[3]
+    assert lines[3].endswith("Alice nominated Carol.")
+
+    board.draw(10)
+    assert out.getvalue().count("\x1b[K") == 4
+    # Redraws are throttled, and only the lines which changed are written.
+    board.changed("https://clocktower.online/#busy", "Carol is executed.")
+    assert not board.is_due(10.1)
+    assert board.is_due(10.5)
+    out.seek(0)
+    out.truncate()
+    board.draw(10.5)
+    assert out.getvalue().count("\x1b[K") == 1
+    assert "Carol is" in out.getvalue()
+    # Without any changes, there's no hurry.
+    assert not board.is_due(11)
+    assert board.is_due(15.5)
+
+def test_game_log_writer(tmp_path):
+    writer = GameLogWriter(str(tmp_path / "logs"))
+    writer.write("https://clocktower.online/#a", "one")
+    writer.write("https://clocktower.online/#b/c", "two")
+    writer.write("https://clocktower.online/#a", "three")
+    writer.close()
+    with open(writer.path("https://clocktower.online/#a")) as f:
+        assert f.read() == "one\nthree\n"
+    assert sorted(os.listdir(tmp_path / "logs")) == ["a.log", "b_c.log"]
@@ -0,0 +1,1512 @@
+"""
+This module implements storage of townsquare spy logs in an sqlite database.
+
+It is kept separate from the bot integration in discord.py so that it can be
+used (and benchmarked) without a Discord connection.
+"""
+
+import asyncio
+import bz2
+import collections
+import concurrent.futures
+import functools
+import gzip
+import io
+import itertools
+import json
+import lzma
+import math
+import os
+import queue
+import re
+import sqlite3
+import struct
+import tempfile
+import threading
+import zlib
+
+from collections import deque
+from collections.abc import Callable, Collection
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import IO, Any, Optional, Union
+from urllib.request import pathname2url
+
+
+# PRAGMAs applied when connecting, by profile name.
+# "wal" suits the bot: readers don't block the writer, and with synchronous=NORMAL
+# a commit need only reach the write-ahead log. A power failure may lose the last
+# few commits, but will not corrupt the database.
+# "durable" also fsyncs the log on every commit.
+TUNING_PROFILES = {
+    "default": [],
+    "wal": [
+        "PRAGMA journal_mode = WAL",
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA temp_store = MEMORY",
+        "PRAGMA cache_size = -16384",
+    ],
+    "durable": [
+        "PRAGMA journal_mode = WAL",
+        "PRAGMA synchronous = FULL",
+    ],
+}
+
+# Stored in PRAGMA user_version. Databases created before this was tracked
+# have version 0, and store the URL and session start on every log row.
+SCHEMA_VERSION = 10
+
+# Tables other than sessions which have a session_id column.
+# Dumps restricted to some sessions include only their rows from these.
+SESSION_TABLES = ["session_log", "session_events", "session_frames", "session_checkpoints", "session_nominations"]
+
+# Kinds of event recorded in session_events, as reported by Session.event.
+EVENT_KINDS = ["edition", "script", "death", "revival", "nomination", "vote", "marked", "execution"]
+
+# The tables holding what was logged for each session. These are created in
+# each partition (and in the main database, which holds sessions logged
+# before partitioning, or everything if the database isn't partitioned).
+LOG_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {schema}.session_log(
+        session_id INTEGER NOT NULL REFERENCES sessions(id),
+        seq INTEGER NOT NULL,
+        timestamp TIMESTAMP,
+        message TEXT,
+        state TEXT,
+        PRIMARY KEY (session_id, seq)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS {schema}.session_events(
+        session_id INTEGER NOT NULL REFERENCES sessions(id),
+        seq INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        player TEXT COLLATE NOCASE,
+        target TEXT COLLATE NOCASE
+    );
+    CREATE INDEX IF NOT EXISTS {schema}.session_events_kind_index
+    ON session_events(kind);
+    CREATE INDEX IF NOT EXISTS {schema}.session_events_player_index
+    ON session_events(player, kind);
+    CREATE INDEX IF NOT EXISTS {schema}.session_events_target_index
+    ON session_events(target, kind);
+    CREATE VIRTUAL TABLE IF NOT EXISTS {schema}.session_log_fts
+    USING fts5(message, content='');
+    CREATE TABLE IF NOT EXISTS {schema}.session_frames(
+        session_id INTEGER NOT NULL REFERENCES sessions(id),
+        seq INTEGER NOT NULL,
+        timestamp TIMESTAMP,
+        frame TEXT,
+        PRIMARY KEY (session_id, seq)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS {schema}.session_checkpoints(
+        session_id INTEGER NOT NULL REFERENCES sessions(id),
+        seq INTEGER NOT NULL,
+        timestamp TIMESTAMP,
+        state TEXT,
+        PRIMARY KEY (session_id, seq)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS {schema}.session_nominations(
+        session_id INTEGER NOT NULL REFERENCES sessions(id),
+        seq INTEGER NOT NULL,
+        nominator TEXT,
+        nominee TEXT,
+        votes INTEGER NOT NULL,
+        voters TEXT,
+        dead_voters TEXT,
+        living_players INTEGER,
+        on_the_block BOOLEAN NOT NULL,
+        tied BOOLEAN NOT NULL,
+        PRIMARY KEY (session_id, seq)
+    ) WITHOUT ROWID;
+"""
+
+# How the rows given to DatabaseThread.log are written to each table,
+# along with anything derived from them. These are run in this order.
+LOG_INSERTS = {
+    # Sessions being rewritten (see DatabaseThread.rewrite) first have
+    # everything derived from their frames removed, including from the search
+    # index. That doesn't store the text, so is given it again to remove.
+    "rewritten_sessions": [
+        """
+            INSERT INTO {schema}.session_log_fts(session_log_fts, rowid, message)
+            SELECT 'delete', session_id << 32 | seq, strip_ansi(log_text(message))
+            FROM {schema}.session_log
+            WHERE session_id = :session_id
+        """,
+        "DELETE FROM {schema}.session_log WHERE session_id = :session_id",
+        "DELETE FROM {schema}.session_events WHERE session_id = :session_id",
+        "DELETE FROM {schema}.session_checkpoints WHERE session_id = :session_id",
+        "DELETE FROM {schema}.session_nominations WHERE session_id = :session_id",
+    ],
+    "session_log": [
+        """
+            INSERT INTO {schema}.session_log
+            (session_id, seq, timestamp, message, state)
+            VALUES (:session_id, :seq, :timestamp, log_encode(:message), log_encode(:state))
+        """,
+        """
+            INSERT INTO {schema}.session_log_fts(rowid, message)
+            VALUES (:session_id << 32 | :seq, strip_ansi(:message))
+        """,
+    ],
+    "session_events": [
+        """
+            INSERT INTO {schema}.session_events
+            (session_id, seq, kind, player, target)
+            VALUES (:session_id, :seq, :kind, :player, :target)
+        """,
+    ],
+    "session_frames": [
+        """
+            INSERT INTO {schema}.session_frames
+            (session_id, seq, timestamp, frame)
+            VALUES (:session_id, :seq, :timestamp, :frame)
+        """,
+    ],
+    "session_checkpoints": [
+        """
+            INSERT INTO {schema}.session_checkpoints
+            (session_id, seq, timestamp, state)
+            VALUES (:session_id, :seq, :timestamp, :state)
+        """,
+    ],
+    "session_nominations": [
+        """
+            INSERT INTO {schema}.session_nominations
+            (session_id, seq, nominator, nominee, votes, voters, dead_voters, living_players, on_the_block, tied)
+            VALUES (:session_id, :seq, :nominator, :nominee, :votes, :voters, :dead_voters, :living_players,
+                    :on_the_block, :tied)
+        """,
+    ],
+    # Scripts are shared by all sessions, and referred to by "script" events.
+    "scripts": [
+        """
+            INSERT OR IGNORE INTO main.scripts
+            (hash, edition_id, name, author, roles)
+            VALUES (:hash, :edition_id, :name, :author, :roles)
+        """,
+    ],
+    # Recorded along with the sessions a backfill rewrote, so that it can resume.
+    "backfill_progress": [
+        """
+            INSERT OR REPLACE INTO main.backfill_progress
+            (run, session_id, rewritten_at)
+            VALUES (:run, :session_id, :rewritten_at)
+        """,
+    ],
+}
+
+# The dictionaries log messages and states may be compressed with (see
+# LogCodec), by version. These are kept in the main database, and copied into
+# dumps and archived partitions so that those can still be read on their own.
+LOG_DICTIONARIES_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {schema}.log_dictionaries(
+        version INTEGER PRIMARY KEY,
+        created_at TIMESTAMP NOT NULL,
+        dictionary BLOB NOT NULL
+    );
+"""
+
+# zlib only looks this far back, so a longer dictionary would be wasted.
+LOG_DICTIONARY_SIZE = 32 << 10
+# Dictionaries are trained on this many of the most recently logged rows.
+LOG_DICTIONARY_SAMPLE_ROWS = 20000
+
+# Partitions are attached to each connection as they are needed, and the
+# oldest detached again to stay within SQLite's limit of ten attached
+# databases. This leaves room for a dump to be attached too.
+MAX_ATTACHED_PARTITIONS = 6
+
+@dataclass(frozen=True)
+class DumpCodec:
+    extension: str
+    default_level: int
+    compress: Callable[[bytes, int], bytes]
+
+# Dumps are compressed a chunk at a time, each becoming a complete stream.
+# xz, gzip and bzip2 all decompress concatenated streams as if they were one.
+DUMP_CODECS = {
+    "xz": DumpCodec("xz", 6, lambda data, level: lzma.compress(data, preset=level)),
+    "gzip": DumpCodec("gz", 6, lambda data, level: gzip.compress(data, compresslevel=level)),
+    "bz2": DumpCodec("bz2", 9, lambda data, level: bz2.compress(data, compresslevel=level)),
+}
+DUMP_CHUNK_SIZE = 4 << 20
+
+# Log exports are written through a file which only spills to disk past this size.
+EXPORT_MEMORY_LIMIT = 1 << 20
+EXPORT_BATCH_SIZE = 1000
+
+# Priorities for reads; lower numbers are served first.
+INTERACTIVE = 0
+BACKGROUND = 10
+
+
+def strip_ansi(s: Optional[str]) -> Optional[str]:
+    if s is None:
+        return None
+    return re.sub(r'\x1b\[[\x30-\x3f]*[\x20-\x2f]*[\x40-\x7e]', '', s)
+
+def train_dictionary(samples: list[bytes], size: int = LOG_DICTIONARY_SIZE,
+                     segment_size: int = 64, gram_size: int = 8) -> bytes:
+    """
+    Builds a dictionary for compressing text like the samples, by choosing the
+    segments of them which contain the most common fragments (gram_size bytes
+    long). This is a simplified version of zstd's COVER algorithm: the samples
+    are split into as many epochs as there is room for segments, and the best
+    segment is taken from each, after which its fragments no longer count.
+    zlib finds matches nearer the end of the dictionary more cheaply, so the
+    best segments are put last.
+    """
+    counts = collections.Counter()
+    for sample in samples:
+        counts.update({sample[i:i + gram_size] for i in range(len(sample) - gram_size + 1)})
+    epochs = max(1, size // segment_size)
+    epoch_length = max(1, -(-len(samples) // epochs))
+    chosen = []
+    for start in range(0, len(samples), epoch_length):
+        best_score, best = 0, None
+        for sample in samples[start:start + epoch_length]:
+            for i in range(0, max(1, len(sample) - segment_size + 1), gram_size):
+                segment = sample[i:i + segment_size]
+                grams = {segment[j:j + gram_size] for j in range(len(segment) - gram_size + 1)}
+                score = sum(counts[g] for g in grams)
+                if score > best_score:
+                    best_score, best = score, (segment, grams)
+        if best is not None:
+            segment, grams = best
+            chosen.append((best_score, segment))
+            for g in grams:
+                counts[g] = 0
+    chosen.sort(key=lambda c: c[0])
+    return b"".join(segment for score, segment in chosen)[-size:]
+
+
+class LogCodec(object):
+    """
+    Compresses the messages and states written to session_log, which are
+    mostly short and much alike, using a dictionary trained on earlier ones
+    (see DatabaseThread.train_log_dictionary). Compressed values are stored
+    as blobs: the dictionary's version, then a raw deflate stream. Anything
+    not made smaller (and everything written while disabled, or before a
+    dictionary was trained) is stored as text, so both are always read.
+
+    Setting a dictionary is the costly part of compressing a short value, so
+    a compressor (and decompressor) is set up once for each dictionary and
+    copied for every value. Copying is thread-safe, so one codec is shared by
+    all of a database's connections. The compressor's hash table is kept
+    small (memLevel 4), since values are short: at zlib's usual sizes,
+    copying it costs far more than compressing them.
+    """
+    HEADER = struct.Struct(">H")
+    enabled: bool
+    level: int
+    current: Optional[int]
+    compressors: dict[int, Any]
+    decompressors: dict[int, Any]
+
+    def __init__(self, enabled: bool = False, level: int = 9):
+        self.enabled = enabled
+        self.level = level
+        self.current = None
+        self.compressors = dict()
+        self.decompressors = dict()
+
+    def add(self, version: int, dictionary: bytes):
+        self.compressors[version] = zlib.compressobj(self.level, zlib.DEFLATED, -15, 4, zlib.Z_DEFAULT_STRATEGY,
+                                                     dictionary)
+        self.decompressors[version] = zlib.decompressobj(-15, dictionary)
+        if self.current is None or version > self.current:
+            self.current = version
+
+    def load(self, conn: sqlite3.Connection):
+        for version, dictionary in conn.execute("SELECT version, dictionary FROM main.log_dictionaries"):
+            if version not in self.compressors:
+                self.add(version, dictionary)
+
+    def encode(self, text: Optional[str]) -> Optional[Union[str, bytes]]:
+        if text is None or not self.enabled or self.current is None:
+            return text
+        data = text.encode()
+        encoded = self.compress(data, self.current)
+        return encoded if len(encoded) < len(data) else text
+
+    def compress(self, data: bytes, version: int) -> bytes:
+        compressor = self.compressors[version].copy()
+        return self.HEADER.pack(version) + compressor.compress(data) + compressor.flush()
+
+    def decode(self, value: Optional[Union[str, bytes]]) -> Optional[str]:
+        if not isinstance(value, bytes):
+            return value
+        (version,) = self.HEADER.unpack_from(value)
+        if version not in self.decompressors:
+            raise ValueError(f"Log dictionary {version} isn't loaded")
+        decompressor = self.decompressors[version].copy()
+        return (decompressor.decompress(value[self.HEADER.size:]) + decompressor.flush()).decode()
+
+def prepare_connection(conn: sqlite3.Connection, profile: str, codec: Optional[LogCodec] = None):
+    """
+    Applies a tuning profile, and defines the functions our queries rely on.
+    Log rows are compressed and decompressed by codec, if given.
+    """
+    if codec is None:
+        codec = LogCodec()
+    for pragma in TUNING_PROFILES[profile]:
+        conn.execute(pragma)
+    conn.create_function("strip_ansi", 1, strip_ansi, deterministic=True)
+    conn.create_function("log_encode", 1, codec.encode)
+    conn.create_function("log_text", 1, codec.decode, deterministic=True)
+
+def partition_name(session_start: datetime) -> str:
+    """
+    Sessions are partitioned by the (UTC) month they started in.
+    """
+    return session_start.astimezone(timezone.utc).strftime("%Y-%m")
+
+def partition_path(path: str, name: str) -> str:
+    root, extension = os.path.splitext(path)
+    return f"{root}-{name}{extension}"
+
+def partition_end(name: str) -> datetime:
+    """
+    The start of the month after a partition's.
+    """
+    year, month = map(int, name.split("-"))
+    return datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+
+def partition_schema(name: str) -> str:
+    return "p_" + name.replace("-", "_")
+
+def attach_partition(conn: sqlite3.Connection, path: str, name: str, read_only: bool = True,
+                     on_attach: Optional[Callable[[str], None]] = None, keep: Collection[str] = ()) -> str:
+    """
+    Attaches a partition to conn, unless it already is, returning its schema name.
+    The schemas in keep aren't detached to make room for it.
+    Must not be called during a transaction.
+    """
+    schema = partition_schema(name)
+    attached = [row[1] for row in conn.execute("PRAGMA database_list")]
+    if schema in attached:
+        return schema
+    partitions = [s for s in attached if s.startswith("p_")]
+    # Databases are listed in the order they were attached.
+    detachable = [s for s in partitions if s not in keep]
+    for old_schema in detachable[:len(partitions) - MAX_ATTACHED_PARTITIONS + 1]:
+        conn.execute(f"DETACH {old_schema}")
+    if read_only:
+        conn.execute("ATTACH ? AS " + schema, (f"file:{pathname2url(path)}?mode=ro",))
+    else:
+        conn.execute("ATTACH ? AS " + schema, (path,))
+    if on_attach is not None:
+        on_attach(schema)
+    return schema
+
+def search_query(text: str) -> str:
+    """
+    Turns what a user typed into an FTS5 query matching messages which contain
+    every word, or every "quoted phrase", in any order. Punctuation is left to
+    the tokenizer rather than being interpreted as query syntax.
+    """
+    phrases = [quoted or word.replace('"', ' ') for quoted, word in re.findall(r'"([^"]*)"|(\S+)', text)]
+    return " ".join(f'"{phrase}"' for phrase in phrases if phrase.strip())
+
+
+class ReaderPool(object):
+    """
+    A few threads, each with its own read-only connection, which serve queued
+    reads in priority order (and otherwise in the order they were queued).
+    In WAL mode readers neither wait for the writer nor hold it up, so this
+    keeps queries responsive while logs are being written.
+
+    Connections are only opened once ready is set, since until then the
+    writer may still be creating or migrating the tables.
+    """
+    path: str
+    profile: str
+    codec: LogCodec
+    ready: threading.Event
+    queue: queue.PriorityQueue
+    counter: itertools.count
+    threads: list[threading.Thread]
+
+    def __init__(self, path: str, profile: str, codec: LogCodec, ready: threading.Event, size: int, name: str):
+        self.path = path
+        self.profile = profile
+        self.codec = codec
+        self.ready = ready
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.threads = [
+            threading.Thread(target=self.serve, name=f"{name} {i}", daemon=True)
+            for i in range(size)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def connect(self) -> sqlite3.Connection:
+        self.ready.wait()
+        conn = sqlite3.connect(f"file:{pathname2url(self.path)}?mode=ro", uri=True)
+        prepare_connection(conn, self.profile, self.codec)
+        return conn
+
+    def serve(self):
+        conn = None
+        while True:
+            priority, _, work, future = self.queue.get()
+            if work is None:
+                break
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                if conn is None:
+                    conn = self.connect()
+                future.set_result(work(conn))
+            except BaseException as e:
+                future.set_exception(e)
+        if conn is not None:
+            conn.close()
+
+    def submit(self, work: Callable[[sqlite3.Connection], Any], priority: int = INTERACTIVE) -> asyncio.Future:
+        future = concurrent.futures.Future()
+        self.queue.put((priority, next(self.counter), work, future))
+        return asyncio.wrap_future(future)
+
+    def shutdown(self):
+        # These sort after any queued work, so that finishes first.
+        for thread in self.threads:
+            self.queue.put((float("inf"), next(self.counter), None, None))
+
+
+class DatabaseThread(object):
+    """
+    To ensure the main thread (and thus the bot) remain responsive even if the
+    disk is busy/slow, we set aside a thread and do all database access there.
+    One thread suffices for writing, and this avoids the need to do additional
+    synchronization if there were multiple.
+
+    Reads are served by a separate pool of read-only connections, so that
+    queries don't wait behind writes. Long-running maintenance such as dumps
+    has its own reader, so that it holds up neither. An in-memory database
+    can't be shared between connections, so then everything runs on the
+    writer's thread.
+
+    Writes from every monitored session are grouped: rows passed to log() are
+    buffered on the event loop and written in a single transaction once
+    flush_interval seconds have passed (by default, on the next iteration of
+    the event loop) or flush_rows rows are waiting. Only one transaction is in
+    flight at a time; rows which arrive while it is being committed make up
+    the next one, so batches grow as the disk falls behind.
+    Each caller receives a future which completes once its rows are committed,
+    and is expected to wait for it before logging more. This bounds the buffer
+    to roughly one batch per caller.
+
+    Unless it is in memory, the database is partitioned by month: the main
+    file holds the list of sessions, while what each session logged is kept
+    in a file for the month it started in (e.g. townsquare-2024-08.db).
+    Writes thus go to a small partition, and queries about a session only
+    open its partition. Once a partition is old enough, archive() compresses
+    it, after which its sessions are no longer found by queries. The archive
+    is itself an sqlite database, once decompressed.
+
+    Optionally, messages and states are compressed as they are logged, with
+    the latest dictionary trained by train_log_dictionary (see LogCodec).
+    Whether or not this is enabled, rows compressed earlier are decompressed
+    when read.
+    """
+    path: str
+    profile: str
+    codec: LogCodec
+    partitioned: bool
+    session_partitions: dict[int, Optional[str]]
+    conn: Optional[sqlite3.Connection]
+    executor: ThreadPoolExecutor
+    connected: threading.Event
+    readers: Optional[ReaderPool]
+    maintenance: Optional[ReaderPool]
+    compressors: Optional[ThreadPoolExecutor]
+    compressor_count: int
+    flush_interval: float
+    flush_rows: int
+    pending: dict[str, list[dict]]
+    pending_count: int
+    # Who is waiting for the pending rows, and the sessions their rows are for.
+    pending_futures: list[tuple[asyncio.Future, set[int]]]
+    flush_handle: Optional[asyncio.TimerHandle]
+    flushing: Optional[asyncio.Future]
+    rows_written: int
+    transactions: int
+
+    def __init__(self, path: str, profile: str = "wal", readers: int = 2, flush_interval: float = 0, flush_rows: int = 1000,
+                 partitioned: bool = True, compress_log: bool = False):
+        self.path = path
+        self.profile = profile
+        self.codec = LogCodec(enabled=compress_log)
+        self.partitioned = partitioned and path != ":memory:"
+        self.session_partitions = dict()
+        self.conn = None
+        self.executor = ThreadPoolExecutor(1, "Townsquare Spy Database", self.connect, (path, profile))
+        self.connected = threading.Event()
+        if path == ":memory:":
+            self.readers = None
+            self.maintenance = None
+        else:
+            self.readers = ReaderPool(path, profile, self.codec, self.connected, readers, "Townsquare Spy Reader")
+            self.maintenance = ReaderPool(path, profile, self.codec, self.connected, 1, "Townsquare Spy Maintenance")
+            # The writer's thread (and thus connect) only starts when it is first
+            # given something to do, but readers may need the tables before then.
+            self.executor.submit(lambda: None)
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.pending = {table: [] for table in LOG_INSERTS}
+        self.pending_count = 0
+        self.pending_futures = []
+        self.flush_handle = None
+        self.flushing = None
+        self.rows_written = 0
+        self.transactions = 0
+        self.compressors = None
+        self.compressor_count = os.cpu_count() or 1
+
+    def connect(self, path: str, profile: str):
+        try:
+            self.conn = sqlite3.connect(path)
+            prepare_connection(self.conn, profile, self.codec)
+            self.migrate()
+            self.codec.load(self.conn)
+        finally:
+            # Even if this failed, readers should try (and fail) rather than wait forever.
+            self.connected.set()
+
+    def close(self):
+        """
+        Stops the threads once any work already queued is done.
+        """
+        self.executor.shutdown(wait=False)
+        if self.readers is not None:
+            self.readers.shutdown()
+            self.maintenance.shutdown()
+        if self.compressors is not None:
+            self.compressors.shutdown(wait=False)
+
+    def read(self, work: Callable[[sqlite3.Connection], Any], priority: int = INTERACTIVE) -> asyncio.Future:
+        """
+        Runs work with a connection it may read from, returning a future with its result.
+        """
+        if self.readers is None:
+            return asyncio.get_running_loop().run_in_executor(self.executor, work, self.conn)
+        return self.readers.submit(work, priority)
+
+    def maintain(self, work: Callable[[sqlite3.Connection], Any]) -> asyncio.Future:
+        """
+        Like read, but for long-running jobs which shouldn't hold up other reads.
+        """
+        if self.maintenance is None:
+            return asyncio.get_running_loop().run_in_executor(self.executor, work, self.conn)
+        return self.maintenance.submit(work, BACKGROUND)
+
+    def attach(self, conn: sqlite3.Connection, name: Optional[str]) -> str:
+        """
+        Attaches a partition to a reader's connection, returning the schema
+        its tables are in. The main database holds sessions without one.
+        """
+        if name is None:
+            return "main"
+        return attach_partition(conn, partition_path(self.path, name), name,
+                                on_attach=functools.partial(self.tune, conn))
+
+    def attach_for_writing(self, name: Optional[str], keep: Collection[str] = ()) -> str:
+        """
+        Like attach, but for the writer, creating the partition if necessary.
+        The schemas in keep stay attached.
+        """
+        if name is None:
+            return "main"
+        def on_attach(schema: str):
+            self.tune(self.conn, schema)
+            self.conn.executescript(LOG_SCHEMA.format(schema=schema))
+        return attach_partition(self.conn, partition_path(self.path, name), name,
+                                read_only=False, on_attach=on_attach, keep=keep)
+
+    def tune(self, conn: sqlite3.Connection, schema: str):
+        for pragma in TUNING_PROFILES[self.profile]:
+            conn.execute(pragma.replace("PRAGMA ", f"PRAGMA {schema}."))
+
+    def session_schema(self, conn: sqlite3.Connection, session_id: int) -> str:
+        """
+        Attaches the partition holding a session's log, returning its schema.
+        """
+        row = conn.execute("SELECT partition_name FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return self.attach(conn, row and row[0])
+
+    def sources(self, conn: sqlite3.Connection, url: Optional[str] = None,
+                since: Optional[datetime] = None) -> list[Optional[str]]:
+        """
+        Lists the partitions which aren't archived, newest first, followed by
+        None for the main database. If given a URL or time, only those with
+        sessions at that URL or which may have been logged to since then.
+        """
+        names = [name for (name,) in conn.execute(
+            "SELECT name FROM partitions WHERE archived_at IS NULL ORDER BY name DESC")]
+        if url is not None:
+            with_url = {name for (name,) in conn.execute(
+                "SELECT DISTINCT partition_name FROM sessions WHERE url = ?", (url,))}
+            names = [name for name in names if name in with_url]
+        if since is not None:
+            # Sessions may continue a little past the end of the month they started in.
+            names = [name for name in names if partition_end(name) + timedelta(days=1) > since]
+        return names + [None]
+
+    def migrate(self):
+        """
+        Creates the tables, converting them from an older layout if necessary.
+
+        Sessions are stored once in the sessions table, and each log row refers
+        to one by its ID along with a sequence number within the session.
+        Older databases repeated the URL and session start on every log row;
+        their rows are copied over in the order they were written.
+        The space they used is only returned to the filesystem by a VACUUM.
+
+        Notable events are also extracted into session_events, and the text of
+        each message is indexed in session_log_fts. That is contentless (the
+        text is only stored in session_log), and its rowids combine the session
+        ID and seq. Messages logged before it existed are indexed when it is
+        created, but events can't be recovered from them.
+
+        Sessions logged before the database was partitioned are left in the
+        main database, with no partition_name.
+
+        The frames received in each session (and periodic checkpoints of its
+        state) are kept too, so that it can be reconstructed at any time.
+        Sessions logged before then can't be.
+
+        Custom scripts are stored once in scripts, by the hash which "script"
+        events refer to, rather than listed in the log of every session.
+
+        Log messages and states may since be compressed blobs, rather than
+        text, using the dictionaries in log_dictionaries. Rows are never
+        recompressed, so every version of those is kept.
+
+        Which sessions each backfill (see backfill.py) has rewritten is kept
+        in backfill_progress.
+        """
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        legacy_columns = [row[1] for row in self.conn.execute("PRAGMA table_info(session_log)")]
+        is_legacy = version < 2 and "url" in legacy_columns
+
+        script = "BEGIN;"
+        if is_legacy:
+            script += "ALTER TABLE session_log RENAME TO legacy_session_log;"
+        if version < 2:
+            script += """
+                CREATE TABLE IF NOT EXISTS sessions(
+                    id INTEGER PRIMARY KEY,
+                    url VARCHAR(255) NOT NULL,
+                    session_start TIMESTAMP NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS sessions_url_index
+                ON sessions(url, session_start);
+                CREATE TABLE IF NOT EXISTS session_log(
+                    session_id INTEGER NOT NULL REFERENCES sessions(id),
+                    seq INTEGER NOT NULL,
+                    timestamp TIMESTAMP,
+                    message TEXT,
+                    state TEXT,
+                    PRIMARY KEY (session_id, seq)
+                ) WITHOUT ROWID;
+            """
+        if is_legacy:
+            script += """
+                INSERT INTO sessions(url, session_start)
+                SELECT url, session_start
+                FROM legacy_session_log
+                GROUP BY url, session_start
+                ORDER BY session_start;
+                INSERT INTO session_log(session_id, seq, timestamp, message, state)
+                SELECT
+                    sessions.id,
+                    ROW_NUMBER() OVER (PARTITION BY sessions.id ORDER BY legacy_session_log.rowid),
+                    legacy_session_log.timestamp,
+                    legacy_session_log.message,
+                    legacy_session_log.state
+                FROM legacy_session_log
+                JOIN sessions USING (url, session_start);
+                DROP TABLE legacy_session_log;
+            """
+        if version < 3:
+            script += """
+                CREATE TABLE IF NOT EXISTS dumps(
+                    id INTEGER PRIMARY KEY,
+                    dumped_at TIMESTAMP NOT NULL,
+                    since TIMESTAMP
+                );
+            """
+        if version < 4:
+            script += LOG_SCHEMA.format(schema="main") + """
+                INSERT INTO session_log_fts(rowid, message)
+                SELECT session_id << 32 | seq, strip_ansi(message)
+                FROM session_log;
+            """
+        if version < 5:
+            script += """
+                ALTER TABLE sessions ADD COLUMN partition_name TEXT;
+                CREATE TABLE IF NOT EXISTS partitions(
+                    name TEXT PRIMARY KEY,
+                    archived_at TIMESTAMP,
+                    archive_path TEXT
+                );
+            """
+        if version < 7:
+            # Since then, tables have only been added to LOG_SCHEMA.
+            script += LOG_SCHEMA.format(schema="main")
+        if version < 8:
+            script += """
+                CREATE TABLE IF NOT EXISTS scripts(
+                    hash TEXT PRIMARY KEY,
+                    edition_id TEXT,
+                    name TEXT,
+                    author TEXT,
+                    roles TEXT
+                ) WITHOUT ROWID;
+            """
+        if version < 9:
+            script += LOG_DICTIONARIES_SCHEMA.format(schema="main")
+        if version < 10:
+            script += """
+                CREATE TABLE IF NOT EXISTS backfill_progress(
+                    run TEXT NOT NULL,
+                    session_id INTEGER NOT NULL REFERENCES sessions(id),
+                    rewritten_at TIMESTAMP NOT NULL,
+                    PRIMARY KEY (run, session_id)
+                ) WITHOUT ROWID;
+            """
+        script += f"PRAGMA user_version = {SCHEMA_VERSION}; COMMIT;"
+        self.conn.executescript(script)
+
+        # Partitions are brought up to date as they are attached, but readers
+        # may need the new tables before the writer next attaches them.
+        for (name,) in self.conn.execute("SELECT name FROM partitions WHERE archived_at IS NULL").fetchall():
+            self.attach_for_writing(name)
+
+    def start_session(self, url: str, session_start: datetime) -> asyncio.Future:
+        """
+        Records the start of a session, returning a future with its ID.
+        Log rows refer to this ID.
+        """
+        name = partition_name(session_start) if self.partitioned else None
+        def write_on_thread():
+            if name is not None:
+                self.attach_for_writing(name)
+                self.conn.execute("INSERT OR IGNORE INTO partitions(name) VALUES (?)", (name,))
+            cur = self.conn.execute(
+                "INSERT INTO sessions(url, session_start, partition_name) VALUES (?, ?, ?)",
+                (url, session_start, name))
+            self.conn.commit()
+            self.session_partitions[cur.lastrowid] = name
+            return cur.lastrowid
+        return asyncio.get_running_loop().run_in_executor(
+            self.executor, write_on_thread)
+
+    def log(self, messages: list[dict], events: list[dict] = (), frames: list[dict] = (),
+            checkpoints: list[dict] = (), nominations: list[dict] = (), scripts: list[dict] = ()) -> asyncio.Future:
+        """
+        Queues rows to be written, returning a future which completes once
+        they have been committed. Must be called from the event loop.
+
+        Each row is a dict with the session_id, its seq (sequence number within
+        the session), and the timestamp, message and state to record.
+        Each event is a dict with the session_id and seq of the message it
+        follows, its kind, and the player and target it involves (or None).
+        Frames are the messages received which affected the session, as
+        JSON, each with the session_id, its own seq and the timestamp.
+        Checkpoints are the whole state of the session (see session_to_dict)
+        as JSON, with the session_id, timestamp and seq of the last frame.
+        Nominations are NominationRecords which went to a vote, as dicts with
+        the session_id and seq of the message reporting the result; their
+        voters and dead_voters are JSON, and they include the count of votes.
+        Scripts are the hash, edition_id, name, author and roles (as JSON) of
+        each script a session's "script" events refer to, with the session_id.
+        Those already stored are ignored.
+        """
+        return self._queue([("session_log", messages), ("session_events", events),
+                            ("session_frames", frames), ("session_checkpoints", checkpoints),
+                            ("session_nominations", nominations), ("scripts", scripts)])
+
+    def rewrite(self, session_id: int, messages: list[dict], events: list[dict] = (),
+                checkpoints: list[dict] = (), nominations: list[dict] = (), scripts: list[dict] = (),
+                backfill_run: Optional[str] = None) -> asyncio.Future:
+        """
+        Like log, but replaces everything derived from a session's frames
+        (its log, events, checkpoints and nominations) with the rows given,
+        which needn't include the session_id. The frames are left as they were.
+        If backfill_run is given, the session is recorded as done for that run
+        in the same transaction.
+        """
+        rows = [messages, events, checkpoints, nominations, scripts]
+        for row in itertools.chain(*rows):
+            row["session_id"] = session_id
+        progress = []
+        if backfill_run is not None:
+            progress.append(dict(run=backfill_run, session_id=session_id, rewritten_at=datetime.now(timezone.utc)))
+        return self._queue([("rewritten_sessions", [dict(session_id=session_id)]), ("session_log", messages),
+                            ("session_events", events), ("session_checkpoints", checkpoints),
+                            ("session_nominations", nominations), ("scripts", scripts),
+                            ("backfill_progress", progress)])
+
+    def _queue(self, rows_by_table: list[tuple[str, list[dict]]]) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        session_ids = set()
+        for table, rows in rows_by_table:
+            self.pending[table].extend(rows)
+            self.pending_count += len(rows)
+            session_ids.update(row["session_id"] for row in rows)
+        self.pending_futures.append((future, session_ids))
+        self._schedule_flush(loop)
+        return future
+
+    def _schedule_flush(self, loop: asyncio.AbstractEventLoop):
+        if self.flushing is not None:
+            # This will be reconsidered once the current transaction commits.
+            return
+        if self.pending_count >= self.flush_rows:
+            self._flush(loop)
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.flush_interval, self._flush, loop)
+
+    def _flush(self, loop: asyncio.AbstractEventLoop):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        pending, futures = self.pending, self.pending_futures
+        self.pending = {table: [] for table in LOG_INSERTS}
+        self.pending_count = 0
+        self.pending_futures = []
+
+        def write_on_thread():
+            # Partitions can only be attached outside a transaction, and only so
+            # many at once, so this works out where everything goes first. Rows
+            # for more partitions than fit are written in several transactions,
+            # each of which keeps its partitions attached until it commits.
+            by_partition = collections.defaultdict(lambda: collections.defaultdict(list))
+            sessions_by_partition = collections.defaultdict(set)
+            for table, rows in pending.items():
+                for row in rows:
+                    name = self.session_partition(row["session_id"])
+                    by_partition[name][table].append(row)
+                    sessions_by_partition[name].add(row["session_id"])
+            names = sorted(name for name in by_partition if name is not None)
+            groups = [names[i:i + MAX_ATTACHED_PARTITIONS] for i in range(0, len(names), MAX_ATTACHED_PARTITIONS)] or [[]]
+            if None in by_partition:
+                groups[0].insert(0, None)
+            failed_sessions = dict()
+            row_count = transactions = 0
+            for group in groups:
+                keep = {partition_schema(name) for name in group if name is not None}
+                try:
+                    schemas = {name: self.attach_for_writing(name, keep) for name in group}
+                    for name in group:
+                        for table, rows in by_partition[name].items():
+                            for insert in LOG_INSERTS[table]:
+                                self.conn.executemany(insert.format(schema=schemas[name]), rows)
+                    self.conn.commit()
+                except Exception as error:
+                    # Every caller is told this failed, so none of it may be committed later.
+                    self.conn.rollback()
+                    for name in group:
+                        failed_sessions.update(dict.fromkeys(sessions_by_partition[name], error))
+                    continue
+                row_count += sum(len(by_partition[name]["session_log"]) for name in group)
+                transactions += 1
+            return failed_sessions, row_count, transactions
+        self.flushing = loop.run_in_executor(self.executor, write_on_thread)
+        self.flushing.add_done_callback(functools.partial(self._flushed, loop, futures))
+
+    def session_partition(self, session_id: int) -> Optional[str]:
+        """
+        The partition a session is logged to, or None if it is the main database.
+        Only for use on the writer's thread.
+        """
+        if session_id not in self.session_partitions:
+            row = self.conn.execute("SELECT partition_name FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            self.session_partitions[session_id] = row and row[0]
+        return self.session_partitions[session_id]
+
+    def writer_schema(self, session_id: int) -> str:
+        """
+        Attaches the partition a session is logged to on the writer, returning its schema.
+        """
+        return self.attach_for_writing(self.session_partition(session_id))
+
+    def _flushed(self, loop: asyncio.AbstractEventLoop, futures: list[tuple[asyncio.Future, set[int]]],
+                 flushing: asyncio.Future):
+        self.flushing = None
+        error = flushing.exception()
+        failed_sessions = dict()
+        if error is None:
+            failed_sessions, row_count, transactions = flushing.result()
+            self.rows_written += row_count
+            self.transactions += transactions
+        for future, session_ids in futures:
+            # Callers may have given up waiting (e.g. if their task was cancelled).
+            if future.done():
+                continue
+            caller_error = error or next((failed_sessions[i] for i in session_ids if i in failed_sessions), None)
+            if caller_error is not None:
+                future.set_exception(caller_error)
+            else:
+                future.set_result(None)
+        if self.pending_futures:
+            self._schedule_flush(loop)
+
+    def latest(self, url: str, as_of: Optional[datetime] = None) -> asyncio.Future:
+        def read_on_thread(conn: sqlite3.Connection):
+            found = latest_session(conn, url, as_of)
+            if found is None:
+                return []
+            session_id, name = found
+            cur = conn.execute(
+                f"""
+                    SELECT timestamp, log_text(message)
+                    FROM {self.attach(conn, name)}.session_log
+                    WHERE session_id = ?
+                    ORDER BY seq
+                """,
+                (session_id,))
+            return cur.fetchall()
+        return self.read(read_on_thread)
+
+    def find_session(self, url: str, as_of: Optional[datetime] = None) -> asyncio.Future:
+        """
+        Finds the latest session at a URL (which started by as_of, if given),
+        returning a future with its ID and how many rows it has logged,
+        or None if there is none.
+        """
+        def read_on_thread(conn: sqlite3.Connection):
+            found = latest_session(conn, url, as_of)
+            if found is None:
+                return None
+            session_id, name = found
+            return conn.execute(
+                f"SELECT ?, MAX(seq) FROM {self.attach(conn, name)}.session_log WHERE session_id = ?",
+                (session_id, session_id)).fetchone()
+        return self.read(read_on_thread)
+
+    def read_log(self, session_id: int, first_seq: int, count: int,
+                 format_row: Callable[[str, str], str]) -> asyncio.Future:
+        """
+        Reads up to count rows of a session's log, starting from first_seq,
+        returning a future with them formatted by format_row(timestamp, message).
+        Sequence numbers start at 1.
+        """
+        def read_on_thread(conn: sqlite3.Connection):
+            cur = conn.execute(
+                f"""
+                    SELECT timestamp, log_text(message)
+                    FROM {self.session_schema(conn, session_id)}.session_log
+                    WHERE session_id = ? AND seq >= ? AND seq < ?
+                    ORDER BY seq
+                """,
+                (session_id, first_seq, first_seq + count))
+            return [format_row(timestamp, message) for timestamp, message in cur]
+        return self.read(read_on_thread)
+
+    def session_history(self, session_id: int, at: datetime) -> asyncio.Future:
+        """
+        Reads what is needed to reconstruct a session as it was at a time:
+        the latest checkpoint by then, and the frames received after it.
+        Returns a future with the checkpoint (or None, to start from scratch)
+        and a list of frames, all decoded from JSON.
+        """
+        def read_on_thread(conn: sqlite3.Connection):
+            schema = self.session_schema(conn, session_id)
+            checkpoint = conn.execute(
+                f"""
+                    SELECT seq, state
+                    FROM {schema}.session_checkpoints
+                    WHERE session_id = ? AND timestamp <= ?
+                    ORDER BY seq DESC
+                    LIMIT 1
+                """,
+                (session_id, at)).fetchone()
+            first_seq, state = (checkpoint[0] + 1, json.loads(checkpoint[1])) if checkpoint else (1, None)
+            cur = conn.execute(
+                f"""
+                    SELECT frame
+                    FROM {schema}.session_frames
+                    WHERE session_id = ? AND seq >= ? AND timestamp <= ?
+                    ORDER BY seq
+                """,
+                (session_id, first_seq, at))
+            return state, [json.loads(frame) for (frame,) in cur]
+        return self.read(read_on_thread)
+
+    def nominations(self, session_id: int) -> asyncio.Future:
+        """
+        Reads every nomination in a session which went to a vote, returning a
+        future with a list of dicts like those given to log, with the
+        timestamp of each result, and voters and dead_voters decoded from JSON.
+        """
+        def read_on_thread(conn: sqlite3.Connection):
+            schema = self.session_schema(conn, session_id)
+            cur = conn.execute(
+                f"""
+                    SELECT session_log.timestamp, nominator, nominee, votes, voters, dead_voters,
+                        living_players, on_the_block, tied
+                    FROM {schema}.session_nominations
+                    JOIN {schema}.session_log USING (session_id, seq)
+                    WHERE session_id = ?
+                    ORDER BY seq
+                """,
+                (session_id,))
+            return [
+                dict(timestamp=timestamp, nominator=nominator, nominee=nominee, votes=votes,
+                     voters=json.loads(voters), dead_voters=json.loads(dead_voters),
+                     living_players=living_players, on_the_block=bool(on_the_block), tied=bool(tied))
+                for timestamp, nominator, nominee, votes, voters, dead_voters, living_players, on_the_block, tied in cur]
+        return self.read(read_on_thread)
+
+    def session_script(self, session_id: int) -> asyncio.Future:
+        """
+        Finds the script a session was last using, returning a future with a
+        dict of its hash, edition_id, name, author and roles (decoded from
+        JSON), or None if no script's roles were sent.
+        """
+        def read_on_thread(conn: sqlite3.Connection):
+            row = conn.execute(
+                f"""
+                    SELECT hash, edition_id, name, author, roles
+                    FROM {self.session_schema(conn, session_id)}.session_events
+                    JOIN main.scripts ON scripts.hash = session_events.target
+                    WHERE session_id = ? AND kind = 'script'
+                    ORDER BY seq DESC
+                    LIMIT 1
+                """,
+                (session_id,)).fetchone()
+            if row is None:
+                return None
+            hash, edition_id, name, author, roles = row
+            return dict(hash=hash, edition_id=edition_id, name=name, author=author, roles=json.loads(roles))
+        return self.read(read_on_thread)
+
+    def search(self, text: str, url: Optional[str] = None, since: Optional[datetime] = None,
+               limit: int = 20) -> asyncio.Future:
+        """
+        Finds the most recently logged messages containing the words in text,
+        optionally only from sessions at url or messages logged since a time.
+        Returns a future with a list of (url, timestamp, message) rows.
+        """
+        conditions = ["session_log_fts MATCH :query"]
+        if url is not None:
+            conditions.append("sessions.url = :url")
+        if since is not None:
+            conditions.append("session_log.timestamp >= :since")
+        def read_on_thread(conn: sqlite3.Connection):
+            # The newest sessions have the highest rowids, which FTS5 can
+            # return in descending order without sorting its matches.
+            # Partitions are searched newest first until there are enough.
+            results = []
+            for name in self.sources(conn, url, since):
+                schema = self.attach(conn, name)
+                cur = conn.execute(
+                    f"""
+                        SELECT sessions.url, session_log.timestamp, log_text(session_log.message)
+                        FROM {schema}.session_log_fts
+                        JOIN {schema}.session_log
+                            ON session_log.session_id = session_log_fts.rowid >> 32
+                            AND session_log.seq = session_log_fts.rowid & 0xffffffff
+                        JOIN main.sessions ON sessions.id = session_log.session_id
+                        WHERE {" AND ".join(conditions)}
+                        ORDER BY session_log_fts.rowid DESC
+                        LIMIT :limit
+                    """,
+                    dict(query=search_query(text), url=url, since=since, limit=limit - len(results)))
+                results += cur.fetchall()
+                if len(results) >= limit:
+                    break
+            return results
+        return self.read(read_on_thread)
+
+    def find_events(self, kind: Optional[str] = None, player: Optional[str] = None,
+                    target: Optional[str] = None, url: Optional[str] = None,
+                    since: Optional[datetime] = None, limit: int = 20) -> asyncio.Future:
+        """
+        Finds the most recent events matching all of the given criteria.
+        Player and target names are compared case-insensitively.
+        Returns a future with a list of (url, timestamp, kind, player, target) rows.
+        """
+        # Only the conditions given are included, so that SQLite can choose
+        # the index best suited to them.
+        conditions = ["TRUE"]
+        for column, value in [("kind", kind), ("player", player), ("target", target)]:
+            if value is not None:
+                conditions.append(f"session_events.{column} = :{column}")
+        if url is not None:
+            conditions.append("sessions.url = :url")
+        if since is not None:
+            conditions.append("session_log.timestamp >= :since")
+        def read_on_thread(conn: sqlite3.Connection):
+            results = []
+            for name in self.sources(conn, url, since):
+                schema = self.attach(conn, name)
+                cur = conn.execute(
+                    f"""
+                        SELECT sessions.url, session_log.timestamp, kind, player, target
+                        FROM {schema}.session_events
+                        JOIN {schema}.session_log USING (session_id, seq)
+                        JOIN main.sessions ON sessions.id = session_events.session_id
+                        WHERE {" AND ".join(conditions)}
+                        ORDER BY session_events.rowid DESC
+                        LIMIT :limit
+                    """,
+                    dict(kind=kind, player=player, target=target, url=url, since=since,
+                         limit=limit - len(results)))
+                results += cur.fetchall()
+                if len(results) >= limit:
+                    break
+            return results
+        return self.read(read_on_thread)
+
+    def export_log(self, session_id: int, format_row: Callable[[str, str], str],
+                   compress: bool = False) -> asyncio.Future:
+        """
+        Writes a session's log to a temporary file, one line per row as
+        formatted by format_row(timestamp, message), optionally gzipped.
+        Rows are read and written a batch at a time, so long logs needn't
+        be held in memory.
+        """
+        def export_on_thread(conn: sqlite3.Connection):
+            output = tempfile.SpooledTemporaryFile(EXPORT_MEMORY_LIMIT)
+            stream = gzip.GzipFile(fileobj=output, mode="wb") if compress else output
+            text = io.TextIOWrapper(stream, encoding="utf-8", newline="\n")
+            cur = conn.execute(
+                f"SELECT timestamp, log_text(message) FROM {self.session_schema(conn, session_id)}.session_log WHERE session_id = ? ORDER BY seq",
+                (session_id,))
+            while rows := cur.fetchmany(EXPORT_BATCH_SIZE):
+                text.writelines(format_row(timestamp, message) + "\n" for timestamp, message in rows)
+            text.flush()
+            text.detach()
+            if compress:
+                # This finishes the gzip stream, but leaves output open.
+                stream.close()
+            output.seek(0)
+            return output
+        return self.read(export_on_thread)
+
+    async def train_log_dictionary(self, sample_rows: int = LOG_DICTIONARY_SAMPLE_ROWS) -> tuple[int, int, int]:
+        """
+        Trains a new version of the dictionary log rows are compressed with,
+        on the messages and states most recently logged. Rows logged from
+        then on use it, if compression is enabled, while those logged earlier
+        keep the version they were compressed with.
+        Returns the new version, and the size of the sampled rows before and
+        after compressing them with it.
+        """
+        def sample_on_thread(conn: sqlite3.Connection):
+            samples = []
+            for name in self.sources(conn):
+                cur = conn.execute(
+                    f"""
+                        SELECT log_text(message), log_text(state)
+                        FROM {self.attach(conn, name)}.session_log
+                        ORDER BY session_id DESC, seq DESC
+                        LIMIT ?
+                    """,
+                    (sample_rows - len(samples),))
+                samples += [row for row in cur if row[0] is not None]
+                if len(samples) >= sample_rows:
+                    break
+            return [text.encode() for row in samples for text in row if text]
+        samples = await self.maintain(sample_on_thread)
+        if not samples:
+            raise ValueError("Nothing has been logged to train a dictionary on")
+        loop = asyncio.get_running_loop()
+        dictionary = await loop.run_in_executor(self.compression_pool(), train_dictionary, samples)
+
+        def write_on_thread():
+            cur = self.conn.execute(
+                "INSERT INTO log_dictionaries(created_at, dictionary) VALUES (?, ?)",
+                (datetime.now(timezone.utc), dictionary))
+            self.conn.commit()
+            self.codec.add(cur.lastrowid, dictionary)
+            return cur.lastrowid
+        version = await loop.run_in_executor(self.executor, write_on_thread)
+        compressed_size = sum(min(len(sample), len(self.codec.compress(sample, version))) for sample in samples)
+        return version, sum(map(len, samples)), compressed_size
+
+    def compression_pool(self) -> ThreadPoolExecutor:
+        if self.compressors is None:
+            self.compressors = ThreadPoolExecutor(self.compressor_count, "Townsquare Spy Compression")
+        return self.compressors
+
+    def snapshot(self, incremental: bool = False) -> Optional[tuple[sqlite3.Connection, int]]:
+        """
+        For a full dump, a connection reading the main database file as it is
+        now, and the size of the database in it. Runs on the writer's thread.
+
+        The write-ahead log is checkpointed into the file first, and nothing
+        is written in between, so the read transaction's snapshot is the
+        file itself. Checkpoints can't write anything newer to the file until
+        that transaction ends, so the file can be read directly while the bot
+        carries on logging. Returns None if the dump isn't a full one, or the
+        database is partitioned or can't be checkpointed right now.
+        """
+        conn = self.conn
+        if incremental and conn.execute("SELECT EXISTS (SELECT * FROM dumps)").fetchone()[0]:
+            return None
+        if (conn.execute("SELECT EXISTS (SELECT * FROM partitions)").fetchone()[0]
+                or conn.execute("PRAGMA main.journal_mode").fetchone()[0] != "wal"):
+            return None
+        busy, frames, checkpointed = conn.execute("PRAGMA main.wal_checkpoint(FULL)").fetchone()
+        if busy or frames != checkpointed:
+            return None
+        snapshot_conn = sqlite3.connect(self.path, check_same_thread=False)
+        snapshot_conn.execute("BEGIN")
+        page_size = snapshot_conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = snapshot_conn.execute("PRAGMA page_count").fetchone()[0]
+        return snapshot_conn, page_size * page_count
+
+    async def dump(self, codec: str = "xz", level: Optional[int] = None,
+                   since: Optional[datetime] = None, until: Optional[datetime] = None,
+                   incremental: bool = False) -> IO[bytes]:
+        """
+        Produces a compressed copy of the database, as a temporary file.
+
+        If since or until are given, only sessions which were active in that
+        range are included. An incremental dump includes the sessions active
+        since the previous full or incremental dump. Those are recorded, so that
+        the next incremental dump can pick up from there.
+
+        A full dump of an unpartitioned database in WAL mode streams the
+        database file's pages straight into the compressor (see snapshot),
+        so only the compressed result takes up space. Other dumps are copied
+        uncompressed first, since SQLite can only write the sessions chosen
+        (or merged from several partitions) to a file it can seek in, so they
+        briefly need the size of what they copy in free space too.
+        """
+        dump_codec = DUMP_CODECS[codec]
+        if level is None:
+            level = dump_codec.default_level
+        compressors = self.compression_pool()
+        snapshot = None
+        if since is None and until is None and self.maintenance is not None:
+            snapshot = await asyncio.get_running_loop().run_in_executor(self.executor, self.snapshot, incremental)
+
+        def stream_on_thread(conn: sqlite3.Connection):
+            snapshot_conn, size = snapshot
+            try:
+                compressed_file = tempfile.TemporaryFile()
+                with open(self.path, "rb") as source:
+                    compress_chunks(source, compressed_file, dump_codec, level, compressors, self.compressor_count,
+                                    size)
+                compressed_file.seek(0)
+                return compressed_file, datetime.now(timezone.utc), None
+            finally:
+                snapshot_conn.close()
+
+        def dump_on_thread(conn: sqlite3.Connection):
+            nonlocal since
+            if incremental:
+                previous = conn.execute("SELECT MAX(dumped_at) FROM dumps").fetchone()[0]
+                if previous is not None:
+                    # Rows are timestamped a little before they are committed.
+                    since = datetime.fromisoformat(previous) - timedelta(minutes=1)
+            dumped_at = datetime.now(timezone.utc)
+
+            # The uncompressed copy is removed as soon as it has been compressed.
+            named_temp = tempfile.NamedTemporaryFile(delete=False)
+            try:
+                named_temp.close()
+                copy_sessions(conn, named_temp.name, since, until,
+                              self.sources(conn, since=since), functools.partial(self.attach, conn))
+                compressed_file = tempfile.TemporaryFile()
+                with open(named_temp.name, "rb") as uncompressed:
+                    compress_chunks(uncompressed, compressed_file, dump_codec, level, compressors, self.compressor_count)
+                compressed_file.seek(0)
+                return compressed_file, dumped_at, since
+            finally:
+                os.unlink(named_temp.name)
+        compressed_file, dumped_at, since = await self.maintain(stream_on_thread if snapshot else dump_on_thread)
+
+        if until is None and (since is None or incremental):
+            def write_on_thread():
+                self.conn.execute(
+                    "INSERT INTO dumps(dumped_at, since) VALUES (?, ?)",
+                    (dumped_at, since))
+                self.conn.commit()
+            await asyncio.get_running_loop().run_in_executor(self.executor, write_on_thread)
+        return compressed_file
+
+
+    async def archive(self, keep_months: int, codec: str = "xz") -> list[str]:
+        """
+        Archives the partitions for all but the last keep_months months
+        (counting the current one), returning the paths of the archives.
+
+        Each partition is checkpointed and detached by the writer, compressed
+        on the maintenance thread, then marked as archived and removed.
+        Readers may keep a removed partition open until they next need to
+        make room for another, but won't query it again.
+        """
+        if not self.partitioned:
+            return []
+        dump_codec = DUMP_CODECS[codec]
+        compressors = self.compression_pool()
+        loop = asyncio.get_running_loop()
+        now = datetime.now(timezone.utc)
+        first_kept = now.year * 12 + now.month - keep_months
+        cutoff = f"{first_kept // 12:04}-{first_kept % 12 + 1:02}"
+
+        def list_on_thread():
+            return [name for (name,) in self.conn.execute(
+                "SELECT name FROM partitions WHERE archived_at IS NULL AND name < ? ORDER BY name",
+                (cutoff,))]
+        archived = []
+        for name in await loop.run_in_executor(self.executor, list_on_thread):
+            path = partition_path(self.path, name)
+            archive_path = f"{path}.{dump_codec.extension}"
+
+            def detach_on_thread():
+                schema = self.attach_for_writing(name)
+                # The archive may be read without the main database.
+                self.conn.executescript(LOG_DICTIONARIES_SCHEMA.format(schema=schema))
+                self.conn.execute(f"INSERT OR IGNORE INTO {schema}.log_dictionaries SELECT * FROM main.log_dictionaries")
+                self.conn.commit()
+                self.conn.execute(f"PRAGMA {schema}.wal_checkpoint(TRUNCATE)")
+                self.conn.execute(f"DETACH {schema}")
+            await loop.run_in_executor(self.executor, detach_on_thread)
+
+            def compress_on_thread(conn: sqlite3.Connection):
+                with open(path, "rb") as source, open(archive_path + ".tmp", "wb") as destination:
+                    compress_chunks(source, destination, dump_codec, dump_codec.default_level,
+                                    compressors, self.compressor_count)
+                os.replace(archive_path + ".tmp", archive_path)
+            await self.maintain(compress_on_thread)
+
+            def record_on_thread():
+                self.conn.execute(
+                    "UPDATE partitions SET archived_at = ?, archive_path = ? WHERE name = ?",
+                    (datetime.now(timezone.utc), archive_path, name))
+                self.conn.commit()
+                for suffix in ["", "-wal", "-shm"]:
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+            await loop.run_in_executor(self.executor, record_on_thread)
+            archived.append(archive_path)
+        return archived
+
+
+def latest_session(conn: sqlite3.Connection, url: str, as_of: Optional[datetime]) -> Optional[tuple[int, Optional[str]]]:
+    """
+    Finds the latest session at a URL which started by as_of (if given) and
+    hasn't been archived, returning its ID and partition.
+    """
+    session_start_condition = "TRUE" if as_of is None else "session_start <= :as_of"
+    return conn.execute(
+        f"""
+            SELECT id, partition_name
+            FROM sessions
+            LEFT JOIN partitions ON partitions.name = sessions.partition_name
+            WHERE url = :url AND {session_start_condition} AND partitions.archived_at IS NULL
+            ORDER BY session_start DESC
+            LIMIT 1
+        """,
+        dict(url=url, as_of=as_of)).fetchone()
+
+def copy_sessions(conn: sqlite3.Connection, path: str, since: Optional[datetime], until: Optional[datetime],
+                  sources: list[Optional[str]] = [None], attach: Callable[[Optional[str]], str] = lambda name: "main"):
+    """
+    Copies the database to a new file, optionally only including sessions
+    which were active within a range of time.
+    A full copy of an unpartitioned database uses the backup API, which
+    needn't rebuild any indexes. Otherwise, sessions are copied from each of
+    the partitions in sources (attached by attach), and the copy holds them
+    all in its main database.
+    """
+    is_partitioned = conn.execute("SELECT EXISTS (SELECT * FROM partitions)").fetchone()[0]
+    if since is None and until is None and not is_partitioned:
+        target = sqlite3.connect(path)
+        try:
+            conn.backup(target)
+        finally:
+            target.close()
+        return
+
+    conn.execute("ATTACH ? AS dump", (path,))
+    try:
+        conn.execute("BEGIN")
+        for table in ["sessions", "scripts", "log_dictionaries"] + SESSION_TABLES + ["session_log_fts"]:
+            for (sql,) in conn.execute(
+                    "SELECT sql FROM main.sqlite_master WHERE tbl_name = ? AND sql IS NOT NULL ORDER BY type DESC",
+                    (table,)).fetchall():
+                conn.execute(re.sub(r"^CREATE (TABLE|INDEX|UNIQUE INDEX|VIRTUAL TABLE) ", r"CREATE \1 dump.", sql))
+        conn.commit()
+        for name in sources:
+            # Each partition is copied in its own transaction, since it can't
+            # be attached during one.
+            schema = attach(name)
+            conn.execute("BEGIN")
+            conn.execute(
+                f"""
+                    INSERT INTO dump.sessions
+                    SELECT * FROM main.sessions
+                    WHERE
+                        partition_name IS :name AND
+                        (:until IS NULL OR session_start < :until) AND
+                        (:since IS NULL OR (
+                            SELECT timestamp FROM {schema}.session_log
+                            WHERE session_id = sessions.id
+                            ORDER BY seq DESC
+                            LIMIT 1) >= :since)
+                """,
+                dict(name=name, since=since, until=until))
+            for table in SESSION_TABLES:
+                conn.execute(
+                    f"""
+                        INSERT INTO dump.{table}
+                        SELECT * FROM {schema}.{table}
+                        WHERE session_id IN (SELECT id FROM dump.sessions WHERE partition_name IS ?)
+                    """,
+                    (name,))
+            conn.commit()
+        conn.execute("BEGIN")
+        conn.execute("UPDATE dump.sessions SET partition_name = NULL")
+        conn.execute(
+            """
+                INSERT INTO dump.scripts
+                SELECT * FROM main.scripts
+                WHERE hash IN (SELECT target FROM dump.session_events WHERE kind = 'script')
+            """)
+        conn.execute("INSERT INTO dump.log_dictionaries SELECT * FROM main.log_dictionaries")
+        # The search index doesn't store the text it indexes, so can't be copied.
+        conn.execute(
+            """
+                INSERT INTO dump.session_log_fts(rowid, message)
+                SELECT session_id << 32 | seq, strip_ansi(log_text(message))
+                FROM dump.session_log
+            """)
+        version = conn.execute("PRAGMA main.user_version").fetchone()[0]
+        conn.execute(f"PRAGMA dump.user_version = {version}")
+        conn.commit()
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.execute("DETACH dump")
+
+
+def compress_chunks(source: IO[bytes], destination: IO[bytes], codec: DumpCodec, level: int,
+                    executor: ThreadPoolExecutor, workers: int, size: Optional[int] = None):
+    """
+    Compresses source (or its first size bytes) into destination, several
+    chunks at a time. The compressors release the GIL, so threads suffice to
+    use several cores. Only a few chunks are held in memory at once.
+    """
+    in_flight = deque()
+    remaining = math.inf if size is None else size
+    while remaining > 0 and (chunk := source.read(min(DUMP_CHUNK_SIZE, remaining))):
+        remaining -= len(chunk)
+        in_flight.append(executor.submit(codec.compress, chunk, level))
+        if len(in_flight) > workers:
+            destination.write(in_flight.popleft().result())
+    while in_flight:
+        destination.write(in_flight.popleft().result())
@@ -0,0 +1,414 @@
+"""
+Unit tests for the spy's database storage.
+
+These mostly use an in-memory database, so they exercise the SQL but not the disk.
+"""
+
+import asyncio
+import gzip
+import os
+import pytest
+import sqlite3
+import tempfile
+
+from datetime import datetime, timezone
+
+from database import *
+
+def log_rows(session_id, messages):
+    return [
+        dict(session_id=session_id,
+             seq=seq,
+             timestamp=datetime.now(timezone.utc),
+             message=message,
+             state=None)
+        for seq, message in enumerate(messages, start=1)
+    ]
+
+def test_group_commit():
+    async def run():
+        db_thread = DatabaseThread(":memory:")
+        session_start = datetime.now(timezone.utc)
+        session_ids = [
+            await db_thread.start_session(f"https://clocktower.online/#game{i}", session_start)
+            for i in range(10)
+        ]
+        await asyncio.gather(*(
+            db_thread.log(log_rows(session_id, ["Alpha died.", "It is now night."]))
+            for session_id in session_ids))
+        latest = await db_thread.latest("https://clocktower.online/#game3")
+        return db_thread, latest
+    db_thread, latest = asyncio.run(run())
+    assert db_thread.rows_written == 20
+    assert db_thread.transactions == 1
+    assert [message for timestamp, message in latest] == ["Alpha died.", "It is now night."]
+
+def test_failed_group_commit():
+    async def run():
+        db_thread = DatabaseThread(":memory:")
+        session_start = datetime.now(timezone.utc)
+        first, second, third = [
+            await db_thread.start_session(f"https://clocktower.online/#game{i}", session_start)
+            for i in range(3)
+        ]
+        await db_thread.log(log_rows(first, ["Logged."]))
+        # The second write repeats a row, so the whole transaction fails, and the
+        # first write in it mustn't be committed by the next one.
+        results = await asyncio.gather(
+            db_thread.log(log_rows(second, ["Not logged."])),
+            db_thread.log(log_rows(first, ["Duplicate."])),
+            return_exceptions=True)
+        await db_thread.log(log_rows(third, ["Logged later."]))
+        return (results, await db_thread.latest("https://clocktower.online/#game1"),
+                await db_thread.latest("https://clocktower.online/#game2"))
+    results, second, third = asyncio.run(run())
+    assert all(isinstance(result, sqlite3.IntegrityError) for result in results)
+    assert second == []
+    assert [message for timestamp, message in third] == ["Logged later."]
+
+def test_latest_as_of():
+    async def run():
+        db_thread = DatabaseThread(":memory:")
+        url = "https://clocktower.online/#game"
+        first = await db_thread.start_session(url, datetime(2024, 1, 1, tzinfo=timezone.utc))
+        second = await db_thread.start_session(url, datetime(2024, 1, 2, tzinfo=timezone.utc))
+        await db_thread.log(log_rows(first, ["First game."]))
+        await db_thread.log(log_rows(second, ["Second game."]))
+        return (await db_thread.latest(url),
+                await db_thread.latest(url, as_of=datetime(2024, 1, 1, 12, tzinfo=timezone.utc)))
+    latest, earlier = asyncio.run(run())
+    assert [message for timestamp, message in latest] == ["Second game."]
+    assert [message for timestamp, message in earlier] == ["First game."]
+
+def test_migrate_legacy_schema():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "townsquare.db")
+        conn = sqlite3.connect(path)
+        conn.executescript("""
+            CREATE TABLE session_log(
+                url VARCHAR(255),
+                session_start TIMESTAMP,
+                timestamp TIMESTAMP,
+                message TEXT,
+                state TEXT
+            );
+            CREATE INDEX session_log_index
+            ON session_log(url, session_start);
+            INSERT INTO session_log VALUES
+                ('https://clocktower.online/#a', '2024-01-01 00:00:00', '2024-01-01 00:00:01', 'Players:', '{}'),
+                ('https://clocktower.online/#b', '2024-01-01 00:00:00', '2024-01-01 00:00:02', 'Other game.', NULL),
+                ('https://clocktower.online/#a', '2024-01-01 00:00:00', '2024-01-01 00:00:03', 'It is now night.', NULL),
+                ('https://clocktower.online/#a', '2024-01-02 00:00:00', '2024-01-02 00:00:01', 'Next game.', NULL);
+        """)
+        conn.close()
+
+        async def run():
+            db_thread = DatabaseThread(path)
+            return (await db_thread.latest("https://clocktower.online/#a"),
+                    await db_thread.latest("https://clocktower.online/#a", as_of="2024-01-01 12:00:00"))
+        latest, earlier = asyncio.run(run())
+        assert [message for timestamp, message in latest] == ["Next game."]
+        assert [message for timestamp, message in earlier] == ["Players:", "It is now night."]
+
+        conn = sqlite3.connect(path)
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+        assert conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] == 3
+        assert conn.execute("SELECT MAX(seq) FROM session_log").fetchone()[0] == 2
+        assert conn.execute("SELECT COUNT(*) FROM session_log_fts WHERE session_log_fts MATCH 'night'").fetchone()[0] == 1
+        conn.close()
+
+def test_reader_pool():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        async def run():
+            db_thread = DatabaseThread(os.path.join(temp_dir, "townsquare.db"))
+            session_id = await db_thread.start_session("https://clocktower.online/#game", datetime.now(timezone.utc))
+            await db_thread.log(log_rows(session_id, ["Alpha died.", "It is now night."]))
+            dump = db_thread.dump()
+            latest = await db_thread.latest("https://clocktower.online/#game")
+            (await dump).close()
+            db_thread.close()
+            return latest
+        latest = asyncio.run(run())
+        assert [message for timestamp, message in latest] == ["Alpha died.", "It is now night."]
+
+def read_dump(dump):
+    data = gzip.decompress(dump.read())
+    dump.close()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "dump.db")
+        with open(path, "wb") as f:
+            f.write(data)
+        conn = sqlite3.connect(path)
+        urls = [url for (url,) in conn.execute("SELECT url FROM sessions ORDER BY id")]
+        rows = conn.execute("SELECT COUNT(*) FROM session_log").fetchone()[0]
+        assert conn.execute("SELECT COUNT(*) FROM session_log_fts").fetchone()[0] == rows
+        conn.close()
+    return urls, rows
+
+@pytest.mark.parametrize("path", [":memory:", "townsquare.db"])
+def test_dump(path):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        async def run():
+            db_thread = DatabaseThread(path if path == ":memory:" else os.path.join(temp_dir, path))
+            first = await db_thread.start_session("https://clocktower.online/#first", datetime.now(timezone.utc))
+            await db_thread.log(log_rows(first, ["Alpha died.", "It is now night."]))
+            full = read_dump(await db_thread.dump(codec="gzip", incremental=True))
+            filtered = read_dump(await db_thread.dump(codec="gzip", until=datetime(2000, 1, 1, tzinfo=timezone.utc)))
+            second = await db_thread.start_session("https://clocktower.online/#second", datetime.now(timezone.utc))
+            await db_thread.log(log_rows(second, ["Bravo died."]))
+            incremental = read_dump(await db_thread.dump(codec="gzip", incremental=True))
+            db_thread.close()
+            return full, filtered, incremental
+        full, filtered, incremental = asyncio.run(run())
+    assert full == (["https://clocktower.online/#first"], 2)
+    assert filtered == ([], 0)
+    # The first session is included again, since it may have continued after the first dump.
+    assert incremental == (["https://clocktower.online/#first", "https://clocktower.online/#second"], 3)
+
+def test_streamed_dump(monkeypatch):
+    def copy_sessions(*args):
+        raise AssertionError("A full dump shouldn't make an uncompressed copy")
+    monkeypatch.setattr("database.copy_sessions", copy_sessions)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        async def run():
+            db_thread = DatabaseThread(os.path.join(temp_dir, "townsquare.db"), partitioned=False)
+            first = await db_thread.start_session("https://clocktower.online/#first", datetime.now(timezone.utc))
+            await db_thread.log(log_rows(first, ["Alpha died.", "It is now night."]))
+            second = await db_thread.start_session("https://clocktower.online/#second", datetime.now(timezone.utc))
+            dump = read_dump(await db_thread.dump(codec="gzip"))
+            # What is logged (and checkpointed) after the snapshot is taken doesn't reach the file.
+            loop = asyncio.get_running_loop()
+            snapshot, size = await loop.run_in_executor(db_thread.executor, db_thread.snapshot)
+            await db_thread.log(log_rows(second, ["Bravo died."] * 1000))
+            await loop.run_in_executor(db_thread.executor, db_thread.conn.execute, "PRAGMA wal_checkpoint(PASSIVE)")
+            with open(db_thread.path, "rb") as f:
+                data = f.read(size)
+            snapshot.close()
+            db_thread.close()
+            return dump, data
+        dump, data = asyncio.run(run())
+        with open(os.path.join(temp_dir, "snapshot.db"), "wb") as f:
+            f.write(data)
+        conn = sqlite3.connect(os.path.join(temp_dir, "snapshot.db"))
+        assert conn.execute("PRAGMA integrity_check").fetchone() == ("ok",)
+        assert conn.execute("SELECT COUNT(*) FROM session_log").fetchone() == (2,)
+        conn.close()
+    assert dump == (["https://clocktower.online/#first", "https://clocktower.online/#second"], 2)
+
+def test_export_and_read_log():
+    async def run():
+        db_thread = DatabaseThread(":memory:")
+        session_id = await db_thread.start_session("https://clocktower.online/#game", datetime.now(timezone.utc))
+        await db_thread.log(log_rows(session_id, [f"Message {i}" for i in range(1, 26)]))
+        found = await db_thread.find_session("https://clocktower.online/#game")
+        page = await db_thread.read_log(session_id, 21, 10, lambda timestamp, message: message)
+        export = await db_thread.export_log(session_id, lambda timestamp, message: message.upper(), compress=True)
+        return found, page, gzip.decompress(export.read()).decode()
+    found, page, exported = asyncio.run(run())
+    assert found == (1, 25)
+    assert page == [f"Message {i}" for i in range(21, 26)]
+    assert exported.splitlines() == [f"MESSAGE {i}" for i in range(1, 26)]
+
+def test_search_and_events():
+    async def run():
+        db_thread = DatabaseThread(":memory:")
+        first = await db_thread.start_session("https://clocktower.online/#first", datetime(2024, 1, 1, tzinfo=timezone.utc))
+        second = await db_thread.start_session("https://clocktower.online/#second", datetime(2024, 1, 2, tzinfo=timezone.utc))
+        await db_thread.log(
+            log_rows(first, ["\x1b[1;36mAlpha\x1b[0m nominated \x1b[1;36mBravo\x1b[0m.", "\x1b[1;36mBravo\x1b[0m died."]),
+            [dict(session_id=first, seq=1, kind="nomination", player="Alpha", target="Bravo"),
+             dict(session_id=first, seq=2, kind="death", player="Bravo", target=None)])
+        await db_thread.log(
+            log_rows(second, ["\x1b[1;36mBravo\x1b[0m died.", "It is now night."]),
+            [dict(session_id=second, seq=1, kind="death", player="Bravo", target=None)])
+        return (await db_thread.search("bravo died"),
+                await db_thread.search('"now night"'),
+                await db_thread.search("Bravo", url="https://clocktower.online/#first"),
+                await db_thread.find_events(kind="death", player="bravo"),
+                await db_thread.find_events(target="BRAVO"))
+    died, night, first_bravo, deaths, nominations = asyncio.run(run())
+    assert [url for url, timestamp, message in died] == ["https://clocktower.online/#second", "https://clocktower.online/#first"]
+    assert [message for url, timestamp, message in night] == ["It is now night."]
+    assert len(first_bravo) == 2
+    assert [url for url, timestamp, kind, player, target in deaths] == ["https://clocktower.online/#second", "https://clocktower.online/#first"]
+    assert [(kind, player, target) for url, timestamp, kind, player, target in nominations] == [("nomination", "Alpha", "Bravo")]
+
+def test_search_query():
+    assert search_query('Alpha "was executed" "') == '"Alpha" "was executed"'
+    assert search_query('NOT a"b') == '"NOT" "a b"'
+
+def test_partitions():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "townsquare.db")
+        async def run():
+            db_thread = DatabaseThread(path)
+            old = await db_thread.start_session("https://clocktower.online/#old", datetime(2024, 1, 31, 23, tzinfo=timezone.utc))
+            new = await db_thread.start_session("https://clocktower.online/#new", datetime.now(timezone.utc))
+            await db_thread.log(log_rows(old, ["Alpha died."]) + log_rows(new, ["Bravo died."]))
+            before = (await db_thread.latest("https://clocktower.online/#old"),
+                      await db_thread.search("died"))
+            archived = await db_thread.archive(keep_months=1, codec="gzip")
+            after = (await db_thread.latest("https://clocktower.online/#old"),
+                     await db_thread.search("died"),
+                     read_dump(await db_thread.dump(codec="gzip")))
+            db_thread.close()
+            return before, archived, after
+        before, archived, after = asyncio.run(run())
+        assert [message for timestamp, message in before[0]] == ["Alpha died."]
+        assert [url for url, timestamp, message in before[1]] == ["https://clocktower.online/#new", "https://clocktower.online/#old"]
+        assert archived == [os.path.join(temp_dir, "townsquare-2024-01.db.gz")]
+        assert not os.path.exists(os.path.join(temp_dir, "townsquare-2024-01.db"))
+        assert after[0] == []
+        assert [url for url, timestamp, message in after[1]] == ["https://clocktower.online/#new"]
+        assert after[2] == (["https://clocktower.online/#new"], 1)
+
+        # The archive is an ordinary database, once decompressed.
+        with open(archived[0], "rb") as f:
+            data = gzip.decompress(f.read())
+        with open(os.path.join(temp_dir, "restored.db"), "wb") as f:
+            f.write(data)
+        conn = sqlite3.connect(os.path.join(temp_dir, "restored.db"))
+        assert conn.execute("SELECT message FROM session_log").fetchall() == [("Alpha died.",)]
+        conn.close()
+
+def test_flush_into_many_partitions():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "townsquare.db")
+        urls = [f"https://clocktower.online/#month{month}" for month in range(1, 9)]
+        async def run():
+            db_thread = DatabaseThread(path)
+            session_ids = [await db_thread.start_session(url, datetime(2024, month, 1, tzinfo=timezone.utc))
+                           for month, url in enumerate(urls, start=1)]
+            transactions = db_thread.transactions
+            # More partitions than can be attached at once, all in one flush.
+            await asyncio.gather(*(db_thread.log(log_rows(session_id, [f"Logged in {url}."]))
+                                   for session_id, url in zip(session_ids, urls)))
+            latest = [await db_thread.latest(url) for url in urls]
+            db_thread.close()
+            return db_thread.transactions - transactions, latest
+        transactions, latest = asyncio.run(run())
+        assert transactions == 2
+        assert [[message for timestamp, message in rows] for rows in latest] == [[f"Logged in {url}."] for url in urls]
+
+def test_session_history():
+    def at(minute):
+        return datetime(2024, 1, 1, 20, minute, tzinfo=timezone.utc)
+    async def run():
+        db_thread = DatabaseThread(":memory:")
+        session_id = await db_thread.start_session("https://clocktower.online/#game", at(0))
+        frames = [dict(session_id=session_id, seq=seq, timestamp=at(seq), frame=f'["frame", {seq}]')
+                  for seq in range(1, 6)]
+        checkpoints = [dict(session_id=session_id, seq=3, timestamp=at(3), state='{"frames": 3}')]
+        await db_thread.log([], frames=frames, checkpoints=checkpoints)
+        return (await db_thread.session_history(session_id, at(2)),
+                await db_thread.session_history(session_id, at(4)))
+    early, later = asyncio.run(run())
+    assert early == (None, [["frame", 1], ["frame", 2]])
+    assert later == ({"frames": 3}, [["frame", 4]])
+
+def test_nominations():
+    async def run():
+        db_thread = DatabaseThread(":memory:")
+        session_id = await db_thread.start_session("https://clocktower.online/#game", datetime.now(timezone.utc))
+        messages = [dict(session_id=session_id, seq=seq, timestamp=datetime.now(timezone.utc),
+                         message="The following players voted: ...", state=None)
+                    for seq in (1, 2)]
+        nominations = [
+            dict(session_id=session_id, seq=1, nominator="Alpha", nominee="Bravo", votes=2,
+                 voters='["Charlie", "Echo"]', dead_voters='["Echo"]', living_players=4,
+                 on_the_block=True, tied=False),
+            dict(session_id=session_id, seq=2, nominator="Charlie", nominee="Delta", votes=0,
+                 voters='[]', dead_voters='[]', living_players=4, on_the_block=False, tied=False),
+        ]
+        await db_thread.log(messages, nominations=nominations)
+        return await db_thread.nominations(session_id)
+    rows = asyncio.run(run())
+    assert [(r["nominee"], r["votes"], r["voters"], r["on_the_block"]) for r in rows] == [
+        ("Bravo", 2, ["Charlie", "Echo"], True), ("Delta", 0, [], False)]
+    assert rows[0]["dead_voters"] == ["Echo"]
+
+def test_rewrite():
+    async def run():
+        db_thread = DatabaseThread(":memory:")
+        session_id = await db_thread.start_session("https://clocktower.online/#game", datetime.now(timezone.utc))
+        frames = [dict(session_id=session_id, seq=1, timestamp=datetime.now(timezone.utc), frame='["frame", 1]')]
+        await db_thread.log(log_rows(session_id, ["Alpha was nominated.", "Alpha died."]),
+                            [dict(session_id=session_id, seq=2, kind="death", player="Alpha", target=None)],
+                            frames=frames)
+        messages = [dict(seq=1, timestamp=datetime.now(timezone.utc), message="Bravo died.", state=None)]
+        events = [dict(seq=1, kind="death", player="Bravo", target=None)]
+        await db_thread.rewrite(session_id, messages, events, backfill_run="again")
+        progress = await db_thread.read(lambda conn: conn.execute(
+            "SELECT run, session_id FROM backfill_progress").fetchall())
+        return (await db_thread.latest("https://clocktower.online/#game"),
+                await db_thread.search("nominated"),
+                await db_thread.find_events(kind="death"),
+                await db_thread.session_history(session_id, datetime.now(timezone.utc)),
+                progress, session_id)
+    latest, found, deaths, history, progress, session_id = asyncio.run(run())
+    assert [message for timestamp, message in latest] == ["Bravo died."]
+    assert found == []
+    assert [player for url, timestamp, kind, player, target in deaths] == ["Bravo"]
+    # The frames it was derived from are kept.
+    assert history == (None, [["frame", 1]])
+    assert progress == [("again", session_id)]
+
+def test_session_script():
+    async def run():
+        db_thread = DatabaseThread(":memory:")
+        session_id = await db_thread.start_session("https://clocktower.online/#game", datetime.now(timezone.utc))
+        messages = [dict(session_id=session_id, seq=1, timestamp=datetime.now(timezone.utc),
+                         message="The script was changed to Small Script.", state=None)]
+        events = [dict(session_id=session_id, seq=1, kind="script", player=None, target="0123456789abcdef")]
+        scripts = [dict(session_id=session_id, hash="0123456789abcdef", edition_id="custom", name="Small Script", author="Someone",
+                        roles='["clockmaker", "imp"]')]
+        missing = await db_thread.session_script(session_id)
+        # The same script is logged again by other sessions, but only stored once.
+        await db_thread.log(messages, events, scripts=scripts)
+        await db_thread.log([], scripts=scripts)
+        return missing, await db_thread.session_script(session_id)
+    missing, script = asyncio.run(run())
+    assert missing is None
+    assert script == dict(hash="0123456789abcdef", edition_id="custom", name="Small Script", author="Someone",
+                          roles=["clockmaker", "imp"])
+
+def test_log_dictionary():
+    messages = [f"\x1b[1;36mPlayer {i % 7}\x1b[0m voted to execute \x1b[1;36mPlayer {i % 5}\x1b[0m." for i in range(200)]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        async def run():
+            db_thread = DatabaseThread(os.path.join(temp_dir, "townsquare.db"), compress_log=True)
+            with pytest.raises(ValueError):
+                await db_thread.train_log_dictionary()
+            first = await db_thread.start_session("https://clocktower.online/#first", datetime.now(timezone.utc))
+            await db_thread.log(log_rows(first, messages))
+            version, size, compressed_size = await db_thread.train_log_dictionary()
+            second = await db_thread.start_session("https://clocktower.online/#second", datetime.now(timezone.utc))
+            await db_thread.log(log_rows(second, messages + ["Zulu died."]))
+            stored = await db_thread.read(lambda conn: conn.execute(
+                f"SELECT typeof(message), COUNT(*) FROM {db_thread.session_schema(conn, second)}.session_log "
+                "WHERE session_id = ? GROUP BY 1", (second,)).fetchall())
+            results = (await db_thread.latest("https://clocktower.online/#second"),
+                       await db_thread.search("execute Player", url="https://clocktower.online/#second"),
+                       read_dump(await db_thread.dump(codec="gzip")))
+            db_thread.close()
+            return version, size, compressed_size, dict(stored), results
+        version, size, compressed_size, stored, (latest, found, dumped) = asyncio.run(run())
+    assert version == 1
+    assert compressed_size * 4 < size
+    # Messages which don't compress are left as text.
+    assert stored == {"blob": 200, "text": 1}
+    assert [message for timestamp, message in latest] == messages + ["Zulu died."]
+    assert len(found) == 20 and found[0][2] == messages[-1]
+    assert dumped == (["https://clocktower.online/#first", "https://clocktower.online/#second"], 401)
+
+def test_log_codec():
+    codec = LogCodec(enabled=True)
+    assert codec.encode("Alpha died.") == "Alpha died."
+    codec.add(1, train_dictionary([b"Alpha died.", b"It is now night."] * 10))
+    codec.add(2, train_dictionary([b"Bravo was nominated by Charlie."] * 10))
+    encoded = codec.encode("Bravo was nominated by Charlie. Bravo was nominated by Charlie.")
+    assert isinstance(encoded, bytes) and encoded[:2] == b"\x00\x02"
+    assert codec.decode(encoded) == "Bravo was nominated by Charlie. Bravo was nominated by Charlie."
+    assert codec.decode(None) is None
+    with pytest.raises(ValueError):
+        LogCodec().decode(encoded)
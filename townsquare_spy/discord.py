@@ -7,216 +7,194 @@ begins monitoring them and logging what happens to an sqlite database.
 While this database could be examined manually, commands to query it
 are also provided.
 
+Monitoring itself is implemented in monitor.py and supervisor.py.
 See __main__.py for a much simpler usage of the spy functionality.
 """
 
 import asyncio
 import dateparser
 import functools
-import json
-import lzma
 import nextcord
 import os
-import re
-import shutil
-import sqlite3
 import tempfile
+import time
 
-from concurrent.futures import ThreadPoolExecutor
-from dataclasses import dataclass
-from datetime import datetime, timedelta, timezone
-from io import BytesIO, StringIO, TextIOWrapper
-from nextcord.ext import commands
+from datetime import datetime, timezone
+from io import StringIO
+from nextcord.ext import commands, tasks
 from typing import Optional
 
-from .spy import random_player_id, interpret_url, connect_to_session, receive, Player, Session
-
-
-# Database access
-
-class DatabaseThread(object):
-    """
-    To ensure the main thread (and thus the bot) remain responsive even if the
-    disk is busy/slow, we set aside a thread and do all database access there.
-    One thread suffices, and this avoids the need to do additional synchronization
-    if there were multiple.
-    """
-    conn: Optional[sqlite3.Connection]
-    executor: ThreadPoolExecutor
-
-    def __init__(self, path: str):
-        self.conn = None
-        self.executor = ThreadPoolExecutor(1, "Townsquare Spy Database", self.connect, (path,))
-
-    def connect(self, path: str):
-        self.conn = sqlite3.connect(path)
-        self.conn.executescript("""
-            BEGIN;
-            CREATE TABLE IF NOT EXISTS session_log(
-                url VARCHAR(255),
-                session_start TIMESTAMP,
-                timestamp TIMESTAMP,
-                message TEXT,
-                state TEXT
-            );
-            CREATE INDEX IF NOT EXISTS session_log_index
-            ON session_log(url, session_start);
-            COMMIT;
-        """)
-
-    def log(self, messages: list[dict]) -> asyncio.Future:
-        def write_on_thread():
-            self.conn.executemany(
-                """
-                    INSERT INTO session_log
-                    (url, session_start, timestamp, message, state)
-                    VALUES (:url, :session_start, :timestamp, :message, :state);
-                """,
-                messages)
-            self.conn.commit()
-        return asyncio.get_running_loop().run_in_executor(
-            self.executor, write_on_thread)
-    
-    def latest(self, url: str, as_of: Optional[datetime] = None) -> asyncio.Future:
-        def read_on_thread():
-            session_start_condition = "TRUE" if as_of is None else "session_start <= :as_of"
-            cur = self.conn.execute(
-                f"""
-                    SELECT timestamp, message
-                    FROM session_log
-                    WHERE
-                        url = :url AND
-                        session_start = (SELECT MAX(session_start) FROM session_log WHERE url = :url AND {session_start_condition})
-                """,
-                dict(url=url, as_of=as_of))
-            return cur.fetchall()
-        return asyncio.get_running_loop().run_in_executor(
-            self.executor, read_on_thread)
-
-    def dump(self) -> asyncio.Future:
-        def dump_on_thread():
-            named_temp = tempfile.NamedTemporaryFile()
-            try:
-                named_temp.close()
-                self.conn.execute("VACUUM INTO ?", (named_temp.name,))
-                compressed_file = tempfile.TemporaryFile()
-                with open(named_temp.name, "rb") as uncompressed, \
-                    lzma.LZMAFile(compressed_file, "wb") as lzma_file:
-                    shutil.copyfileobj(uncompressed, lzma_file)
-                compressed_file.seek(0)
-                return compressed_file
-            finally:
-                os.unlink(named_temp.name)
-        return asyncio.get_running_loop().run_in_executor(
-            self.executor, dump_on_thread)
+from .database import DatabaseThread, DUMP_CODECS, EVENT_KINDS, strip_ansi
+from .monitor import monitor_session, IdleSavings
+from .scanner import LinkScanner
+from .spy import handler_observers, script_catalog, HandlerStats, night_or_day, player_full, replay
+from .supervisor import GameEndWatcher, MonitorSupervisor
 
 
 # Utilities for formatting data
 
-def summarize_player(p: Player):
+def parse_time(s: Optional[str]) -> Optional[datetime]:
     """
-    Summarize the state of an individual player for the log.
-    This is less complete than the full state, but makes
-    it easier to query the interesting state changes.
+    Interprets a time given by a user, such as "yesterday" or "2024-08-01 20:00".
     """
-    summary = dict(name=p.name, is_dead=p.is_dead, known_role=p.known_role)
-    if not summary["known_role"]:
-        del summary["known_role"]
-    return summary
+    if s is not None:
+        s = dateparser.parse(s)
+    if s is not None:
+        s = s.astimezone(timezone.utc)
+    return s
 
-def summarize_state(session: Session):
-    """
-    Summarize the state of the game for the log.
-    This is less complete than the full state, but makes
-    it easier to query the interesting state changes.
-    """
-    return json.dumps(dict(
-        players=[summarize_player(p) for p in session.players],
-        fabled=session.fabled))
 
-def strip_ansi(s):
-    return re.sub(r'\x1b\[[\x30-\x3f]*[\x20-\x2f]*[\x40-\x7e]', '', s)
+def format_log_row(timestamp: str, message: str) -> str:
+    return f"[{timestamp}] {strip_ansi(message)}"
 
+def format_page_row(timestamp: str, message: str) -> str:
+    # Shown in a code block, with the time of day to save space.
+    line = f"[{timestamp[11:19]}] {strip_ansi(message)}".replace("`", "'")
+    return line if len(line) <= 180 else line[:179] + "…"
 
-# Observing an individual session and timing out when it becomes inactive
+def format_results(lines: list[str]) -> str:
+    # Shown in a code block, keeping to Discord's limit on message length.
+    text = ""
+    for line in lines:
+        line = line.replace("`", "'") + "\n"
+        if len(text) + len(line) > 1900:
+            text += "…\n"
+            break
+        text += line
+    return "```\n" + text + "```"
 
-@dataclass
-class MonitoredSessionState:
-    session: Optional[Session] = None
-    task: Optional[asyncio.Task] = None
 
-async def monitor_session(monitored: MonitoredSessionState, url: str, db_thread: DatabaseThread):
+# Observing events and accepting commands from Discord
+
+def message_texts(message: nextcord.Message) -> list[str]:
     """
-    Monitors a session. Expected to be run as a task.
-    Dispatches database access to a thread pool, but attempts to
-    cancel it if the task is itself cancelled.
+    The text of a message which might mention a link: its content, and that of any embeds.
     """
-    monitored.session = Session()
-    monitored.session_start = datetime.now(timezone.utc)
-    player_id = random_player_id()
-    socket_url, app_origin = interpret_url(url, player_id)
-
-    messages = []
-    current_state = None
-    def log_message(message: str):
-        nonlocal current_state
-        new_state = summarize_state(monitored.session)
-        messages.append(dict(
-            url=url,
-            session_start=monitored.session_start,
-            timestamp=datetime.now(timezone.utc),
-            message=message,
-            state=new_state if new_state != current_state else None))
-        current_state = new_state
-
-    monitored.session.log = log_message
-
-    # We wait 10 minutes to receive initial game state, and 30 minutes
-    # without anything happening to stop monitoring.
-    initial_timeout = timedelta(minutes=10)
-    abandon_timeout = timedelta(minutes=30)
-
-    socket = connect_to_session(socket_url, origin=app_origin, player_id=player_id)
-    async with asyncio.timeout(initial_timeout.total_seconds()) as timeout:
-        async for m in socket:
-            receive(monitored.session, m)
-            if not messages: continue
-            timeout.reschedule(asyncio.get_running_loop().time() + abandon_timeout.total_seconds())
-
-            # If there are now messages to log, do so. If this task is cancelled
-            # while waiting for that to finish, attempt to cancel it.
-            write_future = db_thread.log(messages)
-            try:
-                await write_future
-            except asyncio.CancelledError:
-                write_future.cancel()
-                raise
-            messages.clear()
-
+    texts = [message.content]
+    for embed in message.embeds:
+        texts += [embed.url, embed.title, embed.description]
+        texts += [field.value for field in embed.fields]
+    return texts
 
-# Observing events and accepting commands from Discord
+class SessionLogView(nextcord.ui.View):
+    """
+    Pages through a session's log, only reading the page being shown.
+    """
+    page_size = 20
+
+    def __init__(self, db_thread: DatabaseThread, session_id: int, row_count: int, title: str):
+        super().__init__(timeout=600)
+        self.db_thread = db_thread
+        self.session_id = session_id
+        self.page_count = max(1, -(-row_count // self.page_size))
+        self.page = 0
+        self.title = title
+
+    async def render(self) -> nextcord.Embed:
+        lines = await self.db_thread.read_log(
+            self.session_id, self.page * self.page_size + 1, self.page_size, format_page_row)
+        embed = nextcord.Embed(title=self.title, description="```\n" + "\n".join(lines) + "\n```")
+        embed.set_footer(text=f"Page {self.page + 1} of {self.page_count}")
+        self.previous.disabled = self.page == 0
+        self.next.disabled = self.page >= self.page_count - 1
+        return embed
+
+    @nextcord.ui.button(label="Previous", style=nextcord.ButtonStyle.grey)
+    async def previous(self, button: nextcord.ui.Button, interaction: nextcord.Interaction):
+        self.page = max(0, self.page - 1)
+        await interaction.response.edit_message(embed=await self.render(), view=self)
+
+    @nextcord.ui.button(label="Next", style=nextcord.ButtonStyle.grey)
+    async def next(self, button: nextcord.ui.Button, interaction: nextcord.Interaction):
+        self.page = min(self.page_count - 1, self.page + 1)
+        await interaction.response.edit_message(embed=await self.render(), view=self)
 
 class TownsquareSpyCog(commands.Cog):
     bot: commands.Bot
     db_thread: DatabaseThread
-    monitored_sessions: dict[str, MonitoredSessionState]
+    supervisor: MonitorSupervisor
+    idle_savings: IdleSavings
+    shutdown_task: Optional[asyncio.Task]
     watched_channels: set[int]
-    watch_re: re.Pattern
+    columns_path: str
+    scanner: LinkScanner
+    handler_stats: Optional[HandlerStats]
+    retention_months: Optional[int]
+    game_ends: GameEndWatcher
 
-    def __init__(self, bot: commands.Bot, db_path: str):
+    def __init__(self, bot: commands.Bot, db_path: str, db_profile: str):
         self.bot = bot
-        self.db_thread = DatabaseThread(db_path)
-        self.monitored_sessions = dict()
+        # Statistics are computed from an export kept next to the database.
+        self.columns_path = os.path.join(tempfile.gettempdir(), "townsquare-spy-columns") \
+            if db_path == ":memory:" else os.path.splitext(db_path)[0] + "-columns"
+        self.db_thread = DatabaseThread(db_path, profile=db_profile,
+                                        compress_log=bool(os.environ.get("TOWNSQUARE_SPY_COMPRESS_LOG")))
+        self.idle_savings = IdleSavings()
+        self.supervisor = MonitorSupervisor(
+            functools.partial(monitor_session, db_thread=self.db_thread, savings=self.idle_savings,
+                              hub=os.environ.get("TOWNSQUARE_SPY_HUB")),
+            max_concurrent=int(os.environ.get("TOWNSQUARE_SPY_MAX_MONITORS", 20)))
+        self.shutdown_task = None
         self.watched_channels = set(int(c) for c in os.environ["TOWNSQUARE_SPY_CHANNELS"].split(","))
-        self.watch_re = re.compile(r'\bhttps?://clocktower\.(?:online|live)/#[A-Za-z0-9-_]+\b')
+        self.scanner = LinkScanner()
+        # Timing handlers has some overhead, so it's only done when asked for.
+        self.handler_stats = HandlerStats() if os.environ.get("TOWNSQUARE_SPY_HANDLER_STATS") else None
+        if self.handler_stats is not None:
+            handler_observers.append(self.handler_stats)
+        retention_months = os.environ.get("TOWNSQUARE_SPY_RETENTION_MONTHS")
+        self.retention_months = int(retention_months) if retention_months else None
+        self.game_ends = GameEndWatcher(self.supervisor)
 
     def cog_unload(self):
         """
         Called if this cog is being unloaded.
-        This cancels all ongoing monitoring.
+        This cancels all ongoing monitoring, and closes the database
+        once the monitors have stopped (or a few seconds have passed).
         """
-        for monitored in self.monitored_sessions:
-            monitored.task.cancel()
+        if self.handler_stats is not None:
+            handler_observers.remove(self.handler_stats)
+        self.archive_old_partitions.cancel()
+        async def shut_down():
+            await self.supervisor.shutdown(timeout=5)
+            self.db_thread.close()
+        self.shutdown_task = asyncio.create_task(shut_down())
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if self.retention_months is not None and not self.archive_old_partitions.is_running():
+            self.archive_old_partitions.start()
+
+    @tasks.loop(hours=24)
+    async def archive_old_partitions(self):
+        """
+        Archives the logs of old sessions, if a retention period is configured.
+        """
+        for path in await self.db_thread.archive(keep_months=self.retention_months):
+            print(f"Archived old townsquare spy logs to {path}")
+
+    def scan_message(self, message: nextcord.Message):
+        """
+        Monitors any townsquare links in a message's content or embeds.
+        """
+        if message.channel.id not in self.watched_channels: return
+        for url in self.scanner.scan(message_texts(message)):
+            self.supervisor.request(url, message.channel.id)
+
+    def storyteller_game_end(self, url: str, channel_id: Optional[int] = None) -> Optional[str]:
+        """
+        For the bot's queue: why a storyteller's game seems to be over, if it
+        does (see GameEndWatcher.game_end).
+        """
+        return self.game_ends.game_end(url, channel_id)
+
+    def seated_players(self) -> int:
+        """
+        For the bot's queue: how many players are seated in the games being
+        monitored, other than those which seem to be over.
+        """
+        return sum(sum(1 for p in monitored.session.players if p.id)
+                   for monitored in self.supervisor.sessions.values()
+                   if monitored.session is not None and monitored.end_signal() is None)
 
     @commands.Cog.listener()
     async def on_message(self, message: nextcord.Message):
@@ -224,64 +202,261 @@ class TownsquareSpyCog(commands.Cog):
         Observes messages in text channels.
         If a message mentioning a townsquare link is found, it is monitored.
         """
-        if message.channel.id not in self.watched_channels: return
-        for url in self.watch_re.findall(message.content):
-            if url in self.monitored_sessions:
-                continue
+        self.scan_message(message)
 
-            monitored = MonitoredSessionState()
-            monitored.task = asyncio.create_task(
-                monitor_session(monitored, url, db_thread=self.db_thread))
-            self.monitored_sessions[url] = monitored
-            def discard(url, task):
-                monitored = self.monitored_sessions.get(url)
-                if monitored and monitored.task == task:
-                    del self.monitored_sessions[url]
-            monitored.task.add_done_callback(functools.partial(discard, url))
+    @commands.Cog.listener()
+    async def on_message_edit(self, before: nextcord.Message, after: nextcord.Message):
+        """
+        Observes edited messages, including Discord adding link previews.
+        """
+        self.scan_message(after)
 
     @nextcord.slash_command(description="Show the log of a particular game")
-    async def spyshowlog(self, interaction: nextcord.Interaction, session_url: str, as_of: Optional[str]):
-        if as_of is not None:
-            as_of = dateparser.parse(as_of)
-        if as_of is not None:
-            as_of = as_of.astimezone(timezone.utc)
-        latest = await self.db_thread.latest(session_url, as_of=as_of)
-        if not latest:
+    async def spyshowlog(
+        self,
+        interaction: nextcord.Interaction,
+        session_url: str,
+        as_of: Optional[str],
+        paginate: bool = nextcord.SlashOption(default=False, description="Page through the log here instead of attaching it"),
+        compress: bool = nextcord.SlashOption(default=False, description="Attach the log gzipped"),
+    ):
+        as_of = parse_time(as_of)
+        found = await self.db_thread.find_session(session_url, as_of=as_of)
+        if not found or not found[1]:
             await interaction.send("No session log found.")
+            return
+        session_id, row_count = found
+        if paginate:
+            view = SessionLogView(self.db_thread, session_id, row_count, title=session_url)
+            await interaction.send(embed=await view.render(), view=view)
         else:
-            data = BytesIO()
-            text = TextIOWrapper(data, encoding="utf-8", newline="\n")
-            for timestamp, message in latest:
-                print(f"[{timestamp}] {strip_ansi(message)}", file=text)
-            text.flush()
-            data.seek(0)
-            with nextcord.File(data, filename="session.txt", description="Session Log") as f:
+            log = await self.db_thread.export_log(session_id, format_log_row, compress=compress)
+            filename = "session.txt.gz" if compress else "session.txt"
+            with nextcord.File(log, filename=filename, description="Session Log") as f:
                 await interaction.send(file=f)
 
+    @nextcord.slash_command(description="Show what a game looked like at a particular time")
+    async def spystate(
+        self,
+        interaction: nextcord.Interaction,
+        session_url: str,
+        time: str = nextcord.SlashOption(description='For example, "20:15" or "10 minutes ago"'),
+    ):
+        at = parse_time(time)
+        if at is None:
+            await interaction.send("I couldn't understand that time.")
+            return
+        found = await self.db_thread.find_session(session_url, as_of=at)
+        if not found:
+            await interaction.send("No session log found.")
+            return
+        state, frames = await self.db_thread.session_history(found[0], at)
+        if state is None and not frames:
+            await interaction.send("Nothing had been recorded in that session by then.")
+            return
+        session = replay(frames, state)
+        lines = [f"{session.edition_name}, {strip_ansi(night_or_day(session.is_night))}"]
+        lines += [f"{i + 1}. {strip_ansi(player_full(p))}" for i, p in enumerate(session.players)]
+        if session.fabled:
+            lines.append("Fabled: " + ", ".join(session.fabled))
+        if session.nomination:
+            nominator, nominee = (session.players[i].name for i in session.nomination)
+            lines.append(f"{nominator} nominated {nominee}.")
+        if session.on_the_block is not None:
+            lines.append(f"{session.on_the_block} is on the block with {session.block_votes} votes.")
+        if 0 <= session.marked_player < len(session.players):
+            lines.append(f"{session.players[session.marked_player].name} is marked for execution.")
+        await interaction.send(format_results(lines))
+
+    @nextcord.slash_command(description="Show which script a game was using")
+    async def spyscript(
+        self,
+        interaction: nextcord.Interaction,
+        session_url: str,
+        as_of: Optional[str] = nextcord.SlashOption(required=False),
+    ):
+        found = await self.db_thread.find_session(session_url, as_of=parse_time(as_of))
+        if not found:
+            await interaction.send("No session log found.")
+            return
+        script = await self.db_thread.session_script(found[0])
+        if script is None:
+            await interaction.send("No custom script was recorded for that session.")
+            return
+        by = f" by {script['author']}" if script["author"] else ""
+        lines = [f"{script['name']}{by} ({len(script['roles'])} characters, script {script['hash']})"]
+        lines.append(", ".join(script["roles"]))
+        await interaction.send(format_results(lines))
+
+    @nextcord.slash_command(description="Show how each nomination in a game was voted on")
+    async def spyvotes(
+        self,
+        interaction: nextcord.Interaction,
+        session_url: str,
+        as_of: Optional[str] = nextcord.SlashOption(required=False),
+    ):
+        found = await self.db_thread.find_session(session_url, as_of=parse_time(as_of))
+        if not found:
+            await interaction.send("No session log found.")
+            return
+        nominations = await self.db_thread.nominations(found[0])
+        if not nominations:
+            await interaction.send("No nominations have gone to a vote in that session.")
+            return
+        def describe(n):
+            line = f"[{n['timestamp'][11:16]}] {n['nominator']} -> {n['nominee']}: {n['votes']} of {n['living_players']} alive"
+            if n["voters"]:
+                line += " (" + ", ".join(n["voters"]) + ")"
+            if n["dead_voters"]:
+                line += "; dead votes spent by " + ", ".join(n["dead_voters"])
+            if n["tied"]:
+                line += "; tied"
+            elif n["on_the_block"]:
+                line += "; on the block"
+            return line
+        await interaction.send(format_results(describe(n) for n in nominations))
+
+    @nextcord.slash_command(description="Search the text of logged games")
+    async def spysearch(
+        self,
+        interaction: nextcord.Interaction,
+        text: str = nextcord.SlashOption(description='Words which must all appear; "quote" phrases'),
+        session_url: Optional[str] = nextcord.SlashOption(required=False),
+        since: Optional[str] = nextcord.SlashOption(required=False),
+        limit: int = nextcord.SlashOption(default=20, min_value=1, max_value=100),
+    ):
+        rows = await self.db_thread.search(text, url=session_url, since=parse_time(since), limit=limit)
+        if not rows:
+            await interaction.send("No matching messages found.")
+            return
+        await interaction.send(format_results(
+            f"[{timestamp[:16]}] {url}: {strip_ansi(message)}" for url, timestamp, message in rows))
+
+    @nextcord.slash_command(description="Find deaths, nominations, votes and other events in logged games")
+    async def spyevents(
+        self,
+        interaction: nextcord.Interaction,
+        kind: Optional[str] = nextcord.SlashOption(required=False, choices=EVENT_KINDS),
+        player: Optional[str] = nextcord.SlashOption(required=False, description="Who died, nominated, voted, etc."),
+        target: Optional[str] = nextcord.SlashOption(required=False, description="Who was nominated or voted for, or the script"),
+        session_url: Optional[str] = nextcord.SlashOption(required=False),
+        since: Optional[str] = nextcord.SlashOption(required=False),
+        limit: int = nextcord.SlashOption(default=20, min_value=1, max_value=100),
+    ):
+        rows = await self.db_thread.find_events(
+            kind=kind, player=player, target=target, url=session_url, since=parse_time(since), limit=limit)
+        if not rows:
+            await interaction.send("No matching events found.")
+            return
+        def describe(kind, player, target):
+            return " ".join(part for part in [player, kind, target and f"-> {target}"] if part)
+        await interaction.send(format_results(
+            f"[{timestamp[:16]}] {url}: {describe(kind, player, target)}" for url, timestamp, kind, player, target in rows))
+
     @nextcord.slash_command(description="Dump the townsquare spy database")
-    async def spydumpdb(self, interaction: nextcord.Interaction):
-        dump = await self.db_thread.dump()
-        with nextcord.File(dump, filename="townsquare.db.xz", description="Database Dump") as f:
+    async def spydumpdb(
+        self,
+        interaction: nextcord.Interaction,
+        codec: str = nextcord.SlashOption(choices=list(DUMP_CODECS), default="xz"),
+        level: Optional[int] = nextcord.SlashOption(required=False, min_value=1, max_value=9),
+        since: Optional[str] = nextcord.SlashOption(required=False, description="Only sessions active since this time"),
+        until: Optional[str] = nextcord.SlashOption(required=False, description="Only sessions started before this time"),
+        incremental: bool = nextcord.SlashOption(default=False, description="Only sessions active since the last dump"),
+    ):
+        since = parse_time(since)
+        until = parse_time(until)
+        await interaction.response.defer()
+        dump = await self.db_thread.dump(codec=codec, level=level, since=since, until=until, incremental=incremental)
+        filename = f"townsquare.db.{DUMP_CODECS[codec].extension}"
+        with nextcord.File(dump, filename=filename, description="Database Dump") as f:
             dm = await interaction.user.create_dm()
             await dm.send(file=f)
         dump.close()
         await interaction.send("Database dump sent via DM.")
 
+    @nextcord.slash_command(description="Summarize statistics over every logged game")
+    async def spystats(
+        self,
+        interaction: nextcord.Interaction,
+        refresh: bool = nextcord.SlashOption(default=True, description="Export the latest games first"),
+    ):
+        try:
+            # NumPy is only needed for this, so the bot doesn't depend on it otherwise.
+            from . import analytics
+        except ImportError as e:
+            await interaction.send(f"Statistics aren't available: {e}")
+            return
+        await interaction.response.defer()
+        if refresh or not os.path.exists(self.columns_path):
+            await analytics.export(self.db_thread, self.columns_path)
+        columns = analytics.Columns(self.columns_path)
+        lines = await asyncio.get_running_loop().run_in_executor(None, analytics.summary, columns)
+        await interaction.send(format_results(lines))
+
+    @nextcord.slash_command(description="Train a new dictionary for compressing the townsquare spy's logs")
+    async def spytrainlog(self, interaction: nextcord.Interaction):
+        await interaction.response.defer()
+        try:
+            version, size, compressed_size = await self.db_thread.train_log_dictionary()
+        except ValueError as e:
+            await interaction.send(str(e))
+            return
+        enabled = "" if self.db_thread.codec.enabled else " Compression isn't enabled, so it won't be used yet."
+        await interaction.send(f"Trained log dictionary {version}, which compresses recent logs "
+                               f"{size / max(compressed_size, 1):.1f}x ({size} to {compressed_size} bytes).{enabled}")
+
     @nextcord.slash_command(description="Explain what's going on right now")
     async def spystatus(self, interaction: nextcord.Interaction):
         markdown_translate = str.maketrans({ c: "\\"+c for c in "\\`*_{}[]()<>#+-.!|~"})
         response = StringIO()
+        now = time.monotonic()
         print("Monitoring the following games:", file=response)
-        for url, monitored in self.monitored_sessions.items():
+        for url, monitored in self.supervisor.sessions.items():
+            if monitored.last_message is None:
+                print(f"* {url} (connecting)", file=response)
+                continue
             escaped_edition = monitored.session.edition_name.translate(markdown_translate)
             living_players = sum(1 for p in monitored.session.players if not p.is_dead)
             total_players = len(monitored.session.players)
-            print(f"* {url} ({escaped_edition}, {living_players}/{total_players} alive)", file=response)
+            health = f"last message {now - monitored.last_message:.0f}s ago, {monitored.messages_per_minute(now):.1f}/min"
+            if monitored.session.nomination:
+                nominee = monitored.session.players[monitored.session.nomination[1]].name
+                health += f", {monitored.session.vote_count} votes on {nominee.translate(markdown_translate)}"
+            if monitored.session.on_the_block is not None:
+                health += f", {monitored.session.on_the_block.translate(markdown_translate)} on the block"
+            if monitored.stages:
+                name, stage = max(monitored.stages.items(), key=lambda item: item[1].lag)
+                if stage.lag >= 1:
+                    health += f", {name} stage {stage.lag:.1f}s behind with {stage.depth} waiting"
+            if monitored.hibernating:
+                health += ", quiet"
+            if (end := monitored.end_signal(now)) is not None:
+                health += f", seems over ({end.translate(markdown_translate)})"
+            if monitored.restarts:
+                health += f", restarted {monitored.restarts} times"
+            print(f"* {url} ({escaped_edition}, {living_players}/{total_players} alive; {health})", file=response)
+        if self.supervisor.queued or self.supervisor.dropped:
+            print(f"{self.supervisor.queued} more waiting, {self.supervisor.dropped} dropped.", file=response)
+        savings = self.idle_savings
+        if savings.probes:
+            print(f"Checking on quiet games instead of staying connected saved {savings.socket_seconds / 3600:.1f} "
+                  f"socket-hours and about {savings.pings_avoided} pings ({savings.probes} checks, "
+                  f"{savings.resumes} resumed).", file=response)
+        if savings.pings_skipped:
+            print(f"{savings.pings_skipped} pings received were skipped without being parsed.", file=response)
+        print(f"Link scanning: {self.scanner.stats.summary()}.", file=response)
+        if script_catalog.misses:
+            print(f"Custom scripts: {len(script_catalog.scripts)} cached, {script_catalog.hits} re-sent "
+                  f"and {script_catalog.misses} parsed.", file=response)
+        if self.handler_stats is not None and self.handler_stats.by_type:
+            print("Time spent handling messages:", file=response)
+            for line in self.handler_stats.summary(limit=5):
+                print(f"* {line.translate(markdown_translate)}", file=response)
         await interaction.send(response.getvalue(), suppress_embeds=True)
 
-def setup(bot, db_path=":memory:"):
+def setup(bot, db_path=":memory:", db_profile="wal"):
     """
     Invoked as part of extension loading:
     https://docs.nextcord.dev/en/stable/ext/commands/extensions.html
     """
-    bot.add_cog(TownsquareSpyCog(bot, db_path))
\ No newline at end of file
+    bot.add_cog(TownsquareSpyCog(bot, db_path, db_profile))
\ No newline at end of file
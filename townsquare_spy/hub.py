@@ -0,0 +1,175 @@
+"""
+A hub which shares one connection to each townsquare session among any
+number of local subscribers, such as the bot and command-line tool, so that
+each game only has one spectator for us however many are watching.
+
+Subscribers connect to a Unix socket and send the game URL on a line, then
+receive the session's messages one per line (see spy.connect_via_hub).
+Those joining late first receive what is needed to catch up: the edition,
+the full state, and every message affecting the session since. The
+connection to a session is closed as soon as its last subscriber leaves.
+It can be run as:
+
+    python -m townsquare_spy.hub /run/townsquare-spy/hub.sock
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import os
+import websockets
+
+from typing import Optional
+
+from .spy import HUB_LINE_LIMIT, affects_state, decode, interpret_url, is_ping, random_player_id
+
+# Once this many messages have been received since the full state, the host
+# is asked for it again, so that catching up stays quick.
+MAX_BACKLOG = 500
+
+# Subscribers this far behind (in bytes not yet sent) are disconnected,
+# rather than buffering without limit or holding up everyone else.
+MAX_SUBSCRIBER_BUFFER = 2 ** 24
+
+
+class SharedSession(object):
+    """
+    One connection to a session, and everything subscribed to it.
+    """
+    url: str
+    subscribers: set[asyncio.StreamWriter]
+    edition: Optional[str]
+    backlog: list[str]
+    resyncing: bool
+    task: Optional[asyncio.Task]
+
+    def __init__(self, url: str):
+        self.url = url
+        self.subscribers = set()
+        self.edition = None
+        self.backlog = []
+        self.resyncing = False
+        self.task = None
+
+    def subscribe(self, writer: asyncio.StreamWriter):
+        if self.edition is not None:
+            writer.write(self.edition.encode() + b"\n")
+        for raw in self.backlog:
+            writer.write(raw.encode() + b"\n")
+        self.subscribers.add(writer)
+
+    def publish(self, raw: str):
+        line = raw.encode() + b"\n"
+        for writer in list(self.subscribers):
+            if writer.transport.get_write_buffer_size() > MAX_SUBSCRIBER_BUFFER:
+                self.subscribers.discard(writer)
+                writer.close()
+            else:
+                writer.write(line)
+
+    def remember(self, raw: str, m: list) -> bool:
+        """
+        Keeps what a late subscriber would need to catch up.
+        Returns False if the message shouldn't be published, because it's
+        the full state the hub asked for itself.
+        """
+        if m[0] == "edition":
+            self.edition = raw
+        elif m[0] == "gs" and not m[1].get("isLightweight", False):
+            self.backlog = [raw]
+            if self.resyncing:
+                self.resyncing = False
+                return False
+        elif affects_state(m) and self.backlog:
+            self.backlog.append(raw)
+        return True
+
+    async def run(self):
+        player_id = random_player_id()
+        socket_url, origin = interpret_url(self.url, player_id)
+        get_state = json.dumps(["direct", {"host": ["getGamestate", player_id]}])
+        try:
+            async with websockets.connect(socket_url, origin=origin) as ws:
+                await ws.send(get_state)
+                async for raw in ws:
+                    if not isinstance(raw, str):
+                        continue
+                    if not is_ping(raw):
+                        m = decode(raw)
+                        if m is None:
+                            continue
+                        if "\n" in raw:
+                            raw = json.dumps(m)
+                        if not self.remember(raw, m):
+                            continue
+                        if len(self.backlog) > MAX_BACKLOG and not self.resyncing:
+                            self.resyncing = True
+                            await ws.send(get_state)
+                    self.publish(raw)
+        except Exception as e:
+            self.publish(json.dumps(["hub-error", repr(e)]))
+            raise
+        finally:
+            for writer in self.subscribers:
+                writer.close()
+
+
+class Hub(object):
+    sessions: dict[str, SharedSession]
+
+    def __init__(self):
+        self.sessions = dict()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        url = (await reader.readline()).decode().strip()
+        try:
+            interpret_url(url, "")
+        except ValueError as e:
+            writer.write(json.dumps(["hub-error", str(e)]).encode() + b"\n")
+            writer.close()
+            return
+        session = self.sessions.get(url)
+        if session is None:
+            session = self.sessions[url] = SharedSession(url)
+            session.task = asyncio.create_task(session.run())
+            session.task.add_done_callback(functools.partial(self.closed, session))
+        session.subscribe(writer)
+        print(f"{url}: {len(session.subscribers)} subscribers")
+        try:
+            # Subscribers don't send anything else, so this waits for them to leave.
+            await reader.read()
+        finally:
+            session.subscribers.discard(writer)
+            writer.close()
+            print(f"{url}: {len(session.subscribers)} subscribers")
+            if not session.subscribers:
+                self.closed(session)
+                session.task.cancel()
+
+    def closed(self, session: SharedSession, task: Optional[asyncio.Task] = None):
+        # Anyone subscribing from now on gets a new connection.
+        if self.sessions.get(session.url) is session:
+            del self.sessions[session.url]
+        if task is not None and not task.cancelled() and task.exception() is not None:
+            print(f"{session.url}: {task.exception()!r}")
+
+
+async def serve(path: str):
+    hub = Hub()
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(hub.handle, path, limit=HUB_LINE_LIMIT)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='the Unix socket to listen on')
+    args = parser.parse_args()
+    asyncio.run(serve(args.path))
+
+
+if __name__ == '__main__':
+    main()
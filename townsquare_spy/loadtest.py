@@ -0,0 +1,220 @@
+"""
+Load tests the townsquare spy against a fake townsquare server, which runs
+many synthetic games (see synthetic.py) at once.
+
+Each game is monitored as the bot would monitor it, logging to a temporary
+database on disk. The lag reported is from the server sending a message
+which affects the session to the transaction logging it committing.
+It can be invoked as:
+
+    python -m townsquare_spy.loadtest --rooms 200 --duration 60
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+import websockets
+
+from .database import DatabaseThread, TUNING_PROFILES
+from .monitor import monitor_session
+from .spy import KNOWN_SERVERS, affects_state
+from .supervisor import MonitorSupervisor
+from .synthetic import SyntheticGame
+
+# Hosts send each spectator a ping about this often, in seconds.
+PING_INTERVAL = 5
+
+
+class FakeRoom(object):
+    """
+    A game being hosted on the fake server, and the spectators connected to it.
+    For each spectator, the times at which messages which affect the session
+    were sent to it are kept, so that they can be matched up with its frames.
+    While paused, nothing happens in the game, but pings are still sent.
+    """
+    name: str
+    game: SyntheticGame
+    clients: dict[websockets.WebSocketServerProtocol, list[float]]
+    messages_sent: int
+    state_requests: int
+    paused: bool
+
+    def __init__(self, name: str, game: SyntheticGame):
+        self.name = name
+        self.game = game
+        self.clients = dict()
+        self.messages_sent = 0
+        self.state_requests = 0
+        self.paused = False
+
+    async def send(self, client: websockets.WebSocketServerProtocol, m: list):
+        raw = json.dumps(m)
+        if affects_state(m):
+            self.clients[client].append(time.monotonic())
+        self.messages_sent += 1
+        try:
+            await client.send(raw)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def broadcast(self, m: list):
+        await asyncio.gather(*(self.send(client, m) for client in list(self.clients)))
+
+
+class FakeTownsquareServer(object):
+    """
+    Serves synthetic games at ws://host:port/{room}/{player_id}, sending each
+    spectator the game's state when it asks the host for it (as
+    connect_raw does), and then everything which happens in the game.
+    Each room generates rate messages per second on average.
+    """
+    rooms: dict[str, FakeRoom]
+    rate: float
+    ping_interval: float
+    server: websockets.WebSocketServer
+    tasks: list[asyncio.Task]
+
+    def __init__(self, room_names: list[str], rate: float = 1.0, player_count: int = 10, seed: int = 0,
+                 ping_interval: float = PING_INTERVAL):
+        rng = random.Random(seed)
+        self.rooms = {
+            name: FakeRoom(name, SyntheticGame(random.Random(rng.random()), player_count))
+            for name in room_names
+        }
+        self.rate = rate
+        self.ping_interval = ping_interval
+        self.tasks = []
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """
+        Starts serving, returning the port.
+        """
+        self.server = await websockets.serve(self.handle, host, port)
+        for room in self.rooms.values():
+            self.tasks.append(asyncio.create_task(self.play(room)))
+            self.tasks.append(asyncio.create_task(self.ping(room)))
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, client: websockets.WebSocketServerProtocol):
+        room = self.rooms.get(client.path.strip("/").split("/")[0])
+        if room is None:
+            return
+        try:
+            async for raw in client:
+                m = json.loads(raw)
+                if m[0] == "direct" and "getGamestate" in m[1].get("host", []) and client not in room.clients:
+                    room.state_requests += 1
+                    room.clients[client] = []
+                    await room.send(client, room.game.edition())
+                    await room.send(client, room.game.game_state())
+        finally:
+            room.clients.pop(client, None)
+
+    async def play(self, room: FakeRoom):
+        # Rooms start at random times, so that they don't all send at once.
+        rng = random.Random(room.name)
+        await asyncio.sleep(rng.expovariate(self.rate))
+        while True:
+            if not room.paused:
+                await room.broadcast(room.game.next_message())
+            await asyncio.sleep(rng.expovariate(self.rate))
+
+    async def ping(self, room: FakeRoom):
+        await asyncio.sleep(random.Random(room.name).uniform(0, self.ping_interval))
+        while True:
+            await room.broadcast(room.game.ping(len(room.clients)))
+            await asyncio.sleep(self.ping_interval)
+
+
+async def load_test(rooms: int, duration: float, rate: float, players: int, profile: str,
+                    flush_interval: float, seed: int):
+    room_names = [f"room{i}" for i in range(rooms)]
+    server = FakeTownsquareServer(room_names, rate=rate, player_count=players, seed=seed)
+    port = await server.start()
+    KNOWN_SERVERS["localhost"] = f"ws://127.0.0.1:{port}"
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_thread = DatabaseThread(os.path.join(temp_dir, "load.db"), profile=profile, flush_interval=flush_interval)
+
+        # Frames are matched with the times the server sent them: the nth
+        # frame a monitor logs is the nth message sent which affected the session.
+        urls = dict()
+        start_session = db_thread.start_session
+        def measured_start_session(url, session_start):
+            future = start_session(url, session_start)
+            future.add_done_callback(lambda f: f.exception() is None and urls.setdefault(f.result(), url))
+            return future
+        lags = []
+        def committed(frames, future):
+            if future.cancelled() or future.exception() is not None:
+                return
+            now = time.monotonic()
+            for frame in frames:
+                room = server.rooms[urls[frame["session_id"]].rsplit("#", 1)[-1]]
+                sent = next(iter(room.clients.values()), [])
+                if frame["seq"] <= len(sent):
+                    lags.append(now - sent[frame["seq"] - 1])
+        log = db_thread.log
+        def measured_log(messages, events=(), frames=(), *args):
+            future = log(messages, events, frames, *args)
+            future.add_done_callback(functools.partial(committed, list(frames)))
+            return future
+        db_thread.start_session = measured_start_session
+        db_thread.log = measured_log
+
+        supervisor = MonitorSupervisor(
+            functools.partial(monitor_session, db_thread=db_thread, idle_after=duration * 2),
+            max_concurrent=rooms)
+        for name in room_names:
+            supervisor.request(f"http://localhost/#{name}")
+        started = time.monotonic()
+        await asyncio.sleep(duration)
+        worst_stages = dict()
+        for monitored in supervisor.sessions.values():
+            for name, stage in monitored.stages.items():
+                worst_stages[name] = max(worst_stages.get(name, 0.0), stage.max_lag)
+        await supervisor.shutdown()
+        elapsed = time.monotonic() - started
+        await server.close()
+        db_thread.close()
+
+    sent = sum(room.messages_sent for room in server.rooms.values())
+    print(f"{rooms} rooms for {elapsed:.0f} s: {sent} messages sent ({sent / elapsed:.0f}/s), "
+          f"{db_thread.rows_written} rows written in {db_thread.transactions} transactions")
+    if len(lags) >= 2:
+        percentiles = statistics.quantiles(lags, n=100)
+        print(f"Lag from sending to committing {len(lags)} frames: median {percentiles[49] * 1000:.1f} ms, "
+              f"95% {percentiles[94] * 1000:.1f} ms, 99% {percentiles[98] * 1000:.1f} ms, "
+              f"max {max(lags) * 1000:.1f} ms")
+    print("Worst lag by stage: " + ", ".join(f"{name} {lag * 1000:.1f} ms" for name, lag in worst_stages.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rooms', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run for')
+    parser.add_argument('--rate', type=float, default=0.5, help='messages per second in each room, besides pings')
+    parser.add_argument('--players', type=int, default=10)
+    parser.add_argument('--profile', choices=TUNING_PROFILES.keys(), default='wal')
+    parser.add_argument('--flush-interval', type=float, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(load_test(args.rooms, args.duration, args.rate, args.players, args.profile,
+                          args.flush_interval, args.seed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,469 @@
+"""
+This module monitors individual sessions, logging what happens in each
+to the database. See supervisor.py for how many are monitored at once.
+"""
+
+import asyncio
+import itertools
+import json
+
+from collections.abc import AsyncIterator, Callable, Coroutine
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Optional
+
+from .database import DatabaseThread
+from .spy import (random_player_id, interpret_url, connect_raw, connect_via_hub, decode, receive, affects_state, is_ping, replay,
+                  script_catalog, session_to_dict, Player, Session)
+from .supervisor import MonitoredSessionState
+
+
+# Utilities for formatting data
+
+def summarize_player(p: Player):
+    """
+    Summarize the state of an individual player for the log.
+    This is less complete than the full state, but makes
+    it easier to query the interesting state changes.
+    """
+    summary = dict(name=p.name, is_dead=p.is_dead, known_role=p.known_role)
+    if not summary["known_role"]:
+        del summary["known_role"]
+    return summary
+
+def summarize_state(session: Session):
+    """
+    Summarize the state of the game for the log.
+    This is less complete than the full state, but makes
+    it easier to query the interesting state changes.
+    """
+    return json.dumps(dict(
+        players=[summarize_player(p) for p in session.players],
+        fabled=session.fabled))
+
+
+# Observing an individual session and timing out when it becomes inactive
+
+# The state of each session is saved after this many frames which affect it,
+# so that reconstructing it never needs to replay more than this many.
+CHECKPOINT_INTERVAL = 100
+
+# Sessions which have been quiet for this many seconds are only checked on
+# every PROBE_INTERVAL seconds, for at most PROBE_TIMEOUT seconds each time.
+IDLE_AFTER = 300
+PROBE_INTERVAL = 60
+PROBE_TIMEOUT = 15
+
+@dataclass
+class IdleSavings:
+    """
+    What idle sessions haven't cost, compared to staying connected to them.
+    The pings they would have sent are estimated from how often each session
+    sent them while it was followed. Pings which were received, but skipped
+    without being parsed, are counted separately, since they were received
+    whether or not sessions were checked on instead.
+    """
+    socket_seconds: float = 0.0
+    pings_avoided: int = 0
+    pings_skipped: int = 0
+    probes: int = 0
+    resumes: int = 0
+
+@dataclass
+class StageStats:
+    """
+    How one stage of monitoring a session (see monitor_session) is keeping up.
+    Depth is how much is waiting for the stage, and lag is how long it has
+    been since the frame it last finished with was received.
+    """
+    items: int = 0
+    batches: int = 0
+    depth: int = 0
+    max_depth: int = 0
+    lag: float = 0.0
+    max_lag: float = 0.0
+
+    def waiting(self, depth: int):
+        self.depth = depth
+        self.max_depth = max(self.max_depth, depth)
+
+    def finished(self, items: int, received: float, now: float):
+        self.items += items
+        self.batches += 1
+        self.lag = now - received
+        self.max_lag = max(self.max_lag, self.lag)
+
+# Frames waiting to be decoded, or to update the session, are limited to this
+# many each. Frames waiting to be logged aren't limited, but are written in
+# one batch as soon as the previous write finishes.
+STAGE_QUEUE_SIZE = 256
+
+async def read_state(socket: AsyncIterator[str]) -> list[list]:
+    """
+    Reads from a newly opened connection up to and including the session's
+    full state, returning the messages which affect it, or an empty list if
+    it didn't arrive within PROBE_TIMEOUT seconds.
+    """
+    received = []
+    try:
+        async with asyncio.timeout(PROBE_TIMEOUT):
+            async for raw in socket:
+                m = None if is_ping(raw) else decode(raw)
+                if m is None:
+                    continue
+                if affects_state(m):
+                    received.append(m)
+                if m[0] == "gs" and not m[1].get("isLightweight", False):
+                    return received
+    except TimeoutError:
+        pass
+    return []
+
+def session_changed(session: Session, messages: list[list]) -> bool:
+    """
+    Whether receiving messages would change a session, judged on a copy.
+    """
+    before = session_to_dict(session)
+    after = session_to_dict(replay(messages, before))
+    del before["state_version"], after["state_version"]
+    return before != after
+
+async def run_stages(*stages: Coroutine):
+    """
+    Runs stages concurrently until all of them finish, or one fails (in which
+    case so does this). The others are cancelled if this doesn't finish.
+    """
+    tasks = [asyncio.create_task(stage) for stage in stages]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+class SessionRecorder(object):
+    """
+    Collects what happens in a session as rows for DatabaseThread.log, as it
+    receives messages: what it logs (with a summary of its state, if that
+    changed), its events and nominations, the frames which affected it, and
+    periodic checkpoints. The session ID is filled in when the rows are taken.
+    Rows are timestamped by clock, so that sessions can be recorded again
+    later from their frames (see backfill.py), in which case those needn't
+    be recorded again themselves (record_frames).
+    """
+    session: Session
+    clock: Callable[[], Any]
+    record_frames: bool
+    messages: list[dict]
+    events: list[dict]
+    frames: list[dict]
+    checkpoints: list[dict]
+    nominations: list[dict]
+    scripts: list[dict]
+    seq: int
+    frame_seq: int
+    nominations_logged: int
+    current_state: Optional[str]
+    current_state_version: Optional[int]
+
+    def __init__(self, session: Session, clock: Callable[[], Any] = lambda: datetime.now(timezone.utc),
+                 record_frames: bool = True):
+        self.session = session
+        self.clock = clock
+        self.record_frames = record_frames
+        self.messages = []
+        self.events = []
+        self.frames = []
+        self.checkpoints = []
+        self.nominations = []
+        self.scripts = []
+        self.seq = 0
+        self.frame_seq = 0
+        self.nominations_logged = 0
+        self.current_state = None
+        self.current_state_version = None
+        session.log = self.log_message
+        session.event = self.log_event
+        # Scripts are stored separately, so needn't be listed in the log.
+        session.abbreviate_scripts = True
+
+    def log_message(self, message: str):
+        # The state is only summarized again if the session has changed since
+        # the last message, and only stored if that summary is different.
+        new_state = None
+        if self.session.state_version != self.current_state_version:
+            self.current_state_version = self.session.state_version
+            new_state = summarize_state(self.session)
+            if new_state == self.current_state:
+                new_state = None
+            else:
+                self.current_state = new_state
+        self.seq += 1
+        self.messages.append(dict(
+            seq=self.seq,
+            timestamp=self.clock(),
+            message=message,
+            state=new_state))
+
+    def log_event(self, kind: str, player: Optional[str] = None, target: Optional[str] = None):
+        self.events.append(dict(seq=self.seq, kind=kind, player=player, target=target))
+        if kind == "script":
+            script = script_catalog.get(target)
+            self.scripts.append(dict(hash=script.hash, edition_id=script.edition_id, name=script.name,
+                                     author=script.author, roles=json.dumps(script.roles)))
+
+    def receive(self, m: list):
+        receive(self.session, m)
+        history = self.session.nomination_history
+        for n in history[self.nominations_logged:]:
+            self.nominations.append(dict(asdict(n), seq=self.seq, votes=n.votes,
+                                         voters=json.dumps(n.voters), dead_voters=json.dumps(n.dead_voters)))
+        self.nominations_logged = len(history)
+        if affects_state(m):
+            self.frame_seq += 1
+            now = self.clock()
+            if self.record_frames:
+                self.frames.append(dict(seq=self.frame_seq, timestamp=now, frame=json.dumps(m)))
+            if self.frame_seq % CHECKPOINT_INTERVAL == 0:
+                self.checkpoints.append(dict(
+                    seq=self.frame_seq, timestamp=now, state=json.dumps(session_to_dict(self.session))))
+
+    def pending(self) -> int:
+        """
+        How many messages and frames there are to log.
+        """
+        return len(self.messages) + len(self.frames)
+
+    def take(self, session_id: int) -> tuple[list[dict], ...]:
+        """
+        Takes the rows collected so far, in the order DatabaseThread.log expects them.
+        """
+        batch = tuple(rows[:] for rows in (self.messages, self.events, self.frames, self.checkpoints,
+                                           self.nominations, self.scripts))
+        for rows in (self.messages, self.events, self.frames, self.checkpoints, self.nominations, self.scripts):
+            rows.clear()
+        for row in itertools.chain(*batch):
+            row["session_id"] = session_id
+        return batch
+
+async def monitor_session(monitored: MonitoredSessionState, url: str, db_thread: DatabaseThread,
+                          savings: Optional[IdleSavings] = None,
+                          idle_after: float = IDLE_AFTER, probe_interval: float = PROBE_INTERVAL,
+                          hub: Optional[str] = None):
+    """
+    Monitors a session. Expected to be run as a task (see MonitorSupervisor).
+    Dispatches database access to a thread pool, but attempts to
+    cancel it if the task is itself cancelled.
+
+    The session is followed in stages, connected by queues: reading from the
+    socket, decoding frames, updating the session, and logging. Only logging
+    waits for the disk, so a slow write never stops the socket being read;
+    whatever arrives in the meantime is logged together once it finishes.
+    How each stage is keeping up is reported in monitored.stages.
+
+    Once nothing but pings has been received for idle_after seconds, the
+    connection is closed, and reopened every probe_interval seconds just
+    long enough to get the session's state. Once that changes, the session
+    is followed closely again. Time and pings saved are added to savings.
+
+    If hub is given, the session is followed through the hub listening on that
+    Unix socket (see hub.py), rather than connecting to it directly.
+    """
+    if savings is None:
+        savings = IdleSavings()
+    monitored.session = Session()
+    monitored.session_start = datetime.now(timezone.utc)
+    monitored.stages = {name: StageStats() for name in ("read", "decode", "update", "log")}
+    player_id = random_player_id()
+    socket_url, app_origin = interpret_url(url, player_id)
+    def connect() -> AsyncIterator[str]:
+        if hub is not None:
+            return connect_via_hub(hub, url)
+        return connect_raw(socket_url, origin=app_origin, player_id=player_id)
+
+    recorder = SessionRecorder(monitored.session)
+    # When the oldest frame which hasn't been logged yet was received.
+    pending_since = None
+    # Pings received while following the session closely, and for how long.
+    pings_received = 0
+    followed_seconds = 0.0
+
+    def update(m: list, received: float) -> bool:
+        """
+        Handles a message, collecting what it did (if anything) to be logged.
+        Returns whether there was anything.
+        """
+        nonlocal pending_since
+        pending_before = recorder.pending()
+        recorder.receive(m)
+        if recorder.pending() == pending_before:
+            return False
+        if pending_since is None:
+            pending_since = received
+        return True
+
+    def take_pending() -> tuple[list[dict], ...]:
+        nonlocal pending_since
+        pending_since = None
+        return recorder.take(monitored.session_id)
+
+    async def write_pending():
+        """
+        Logs everything collected so far, waiting until it has been written.
+        If this task is cancelled while waiting, attempts to cancel the write.
+        """
+        if not recorder.pending():
+            return
+        received = pending_since
+        # The session is only recorded once there is something to log,
+        # so that failed attempts don't hide the previous session at this URL.
+        if monitored.session_id is None:
+            monitored.session_id = await db_thread.start_session(url, monitored.session_start)
+        batch = take_pending()
+        write_future = db_thread.log(*batch)
+        try:
+            await write_future
+        except asyncio.CancelledError:
+            write_future.cancel()
+            raise
+        monitored.stages["log"].finished(len(batch[0]) + len(batch[2]), received, loop.time())
+
+    async def read_stage(socket: AsyncIterator[str], decode_queue: asyncio.Queue):
+        nonlocal pings_received
+        stats = monitored.stages["read"]
+        async for raw in socket:
+            monitored.record_message()
+            if is_ping(raw):
+                pings_received += 1
+                savings.pings_skipped += 1
+                continue
+            received = loop.time()
+            await decode_queue.put((received, raw))
+            stats.finished(1, received, loop.time())
+            monitored.stages["decode"].waiting(decode_queue.qsize())
+        await decode_queue.put(None)
+
+    async def decode_stage(decode_queue: asyncio.Queue, update_queue: asyncio.Queue):
+        stats = monitored.stages["decode"]
+        while (item := await decode_queue.get()) is not None:
+            received, raw = item
+            m = decode(raw)
+            if m is not None:
+                await update_queue.put((received, m))
+                monitored.stages["update"].waiting(update_queue.qsize())
+            stats.finished(1, received, loop.time())
+            stats.waiting(decode_queue.qsize())
+        await update_queue.put(None)
+
+    async def update_stage(update_queue: asyncio.Queue, on_update: Callable[[list, bool], None],
+                           wake_log: asyncio.Event, log_closing: list):
+        # Everything which arrived since the last time is handled together.
+        stats = monitored.stages["update"]
+        while True:
+            batch = [await update_queue.get()]
+            while not update_queue.empty() and batch[-1] is not None:
+                batch.append(update_queue.get_nowait())
+            closing = batch[-1] is None
+            if closing:
+                batch.pop()
+            for received, m in batch:
+                on_update(m, update(m, received))
+            if batch:
+                stats.finished(len(batch), batch[0][0], loop.time())
+            stats.waiting(update_queue.qsize())
+            monitored.stages["log"].waiting(recorder.pending())
+            if closing:
+                log_closing.append(True)
+            wake_log.set()
+            if closing:
+                return
+
+    async def log_stage(wake_log: asyncio.Event, log_closing: list):
+        while not log_closing:
+            await wake_log.wait()
+            wake_log.clear()
+            await write_pending()
+            monitored.stages["log"].waiting(recorder.pending())
+        await write_pending()
+
+    async def follow(socket: AsyncIterator[str], on_update: Callable[[list, bool], None]):
+        """
+        Follows a session until the socket closes, or this is cancelled.
+        on_update(m, logged) is called after each message updates the session.
+        """
+        decode_queue = asyncio.Queue(STAGE_QUEUE_SIZE)
+        update_queue = asyncio.Queue(STAGE_QUEUE_SIZE)
+        wake_log = asyncio.Event()
+        log_closing = []
+        await run_stages(
+            read_stage(socket, decode_queue),
+            decode_stage(decode_queue, update_queue),
+            update_stage(update_queue, on_update, wake_log, log_closing),
+            log_stage(wake_log, log_closing))
+
+    # We wait 10 minutes to receive initial game state, and 30 minutes
+    # without anything happening to stop monitoring.
+    initial_timeout = timedelta(minutes=10)
+    abandon_timeout = timedelta(minutes=30)
+
+    loop = asyncio.get_running_loop()
+    socket = connect()
+    try:
+        async with asyncio.timeout(initial_timeout.total_seconds()) as timeout:
+            while True:
+                # Follow the session until it goes quiet.
+                follow_start = loop.time()
+                try:
+                    async with asyncio.timeout(None) as idle:
+                        def on_update(m: list, logged: bool):
+                            if logged:
+                                timeout.reschedule(loop.time() + abandon_timeout.total_seconds())
+                            if affects_state(m):
+                                monitored.record_activity()
+                            # Until the session has been recorded, it can't be resumed.
+                            if affects_state(m) and monitored.session_id is not None:
+                                idle.reschedule(loop.time() + idle_after)
+                        await follow(socket, on_update)
+                except TimeoutError:
+                    if not idle.expired():
+                        raise
+                await socket.aclose()
+                followed_seconds += loop.time() - follow_start
+                await write_pending()
+
+                # Then check on it now and then, until it changes.
+                # The connection which saw the change is followed from there.
+                monitored.hibernating = True
+                hibernation_start = loop.time()
+                probing_time = 0.0
+                try:
+                    while True:
+                        await asyncio.sleep(probe_interval)
+                        probe_start = loop.time()
+                        socket = connect()
+                        state_frames = await read_state(socket)
+                        savings.probes += 1
+                        probing_time += loop.time() - probe_start
+                        if state_frames and session_changed(monitored.session, state_frames):
+                            break
+                        await socket.aclose()
+                finally:
+                    monitored.hibernating = False
+                    hibernated = loop.time() - hibernation_start - probing_time
+                    savings.socket_seconds += hibernated
+                    if followed_seconds > 0:
+                        savings.pings_avoided += round(hibernated * pings_received / followed_seconds)
+                savings.resumes += 1
+                recorder.log_message("Activity resumed after a quiet period.")
+                for m in state_frames:
+                    update(m, loop.time())
+                monitored.record_activity()
+                await write_pending()
+                timeout.reschedule(loop.time() + abandon_timeout.total_seconds())
+    finally:
+        await socket.aclose()
+        # Anything not yet written is queued without waiting, if possible.
+        if monitored.session_id is not None and recorder.pending():
+            db_thread.log(*take_pending())
@@ -0,0 +1,116 @@
+"""
+Unit tests for monitoring sessions, against the fake server in loadtest.py.
+"""
+
+import asyncio
+import pytest
+
+from townsquare_spy import monitor, spy
+from townsquare_spy.database import DatabaseThread
+from townsquare_spy.loadtest import FakeTownsquareServer
+from townsquare_spy.monitor import IdleSavings, monitor_session, run_stages
+from townsquare_spy.supervisor import MonitoredSessionState
+
+async def wait_until(condition, timeout=10.0):
+    async with asyncio.timeout(timeout):
+        while not condition():
+            await asyncio.sleep(0.01)
+
+def test_hibernate_and_resume(monkeypatch):
+    async def run():
+        server = FakeTownsquareServer(["room"], rate=50.0, ping_interval=0.05)
+        port = await server.start()
+        monkeypatch.setitem(spy.KNOWN_SERVERS, "localhost", f"ws://127.0.0.1:{port}")
+        room = server.rooms["room"]
+        db_thread = DatabaseThread(":memory:")
+        monitored = MonitoredSessionState()
+        savings = IdleSavings()
+        task = asyncio.create_task(monitor_session(monitored, "http://localhost/#room", db_thread, savings,
+                                                   idle_after=0.3, probe_interval=0.1))
+        try:
+            await wait_until(lambda: monitored.session_id is not None and room.messages_sent >= 20)
+            room.paused = True
+            # Once quiet, the socket is closed, and the session checked on now and then.
+            await wait_until(lambda: monitored.hibernating)
+            await wait_until(lambda: not room.clients)
+            await wait_until(lambda: savings.probes >= 2)
+            assert room.state_requests >= 3
+            assert savings.resumes == 0
+            room.paused = False
+            await wait_until(lambda: savings.resumes == 1)
+            assert not monitored.hibernating
+            await wait_until(lambda: len(room.clients) == 1)
+            messages_sent = room.messages_sent
+            await wait_until(lambda: room.messages_sent > messages_sent + 10)
+            room.paused = True
+            await wait_until(lambda: monitored.hibernating)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await server.close()
+        log = await db_thread.read_log(monitored.session_id, 1, 100000, lambda timestamp, message: message)
+        db_thread.close()
+        return savings, log
+
+    savings, log = asyncio.run(run())
+    assert log.count("Activity resumed after a quiet period.") == 1
+    assert savings.socket_seconds > 0
+    assert savings.pings_skipped > 0
+    assert savings.pings_avoided > 0
+
+class StuckDatabaseThread(object):
+    """
+    Records sessions, but never finishes writing anything to them.
+    """
+    def __init__(self):
+        self.writes = []
+
+    async def start_session(self, url, session_start):
+        return 1
+
+    def log(self, messages, events=(), frames=(), *args):
+        self.writes.append(asyncio.get_running_loop().create_future())
+        return self.writes[-1]
+
+def test_slow_log_doesnt_stall_reading(monkeypatch):
+    monkeypatch.setattr(monitor, "STAGE_QUEUE_SIZE", 4)
+    async def run():
+        server = FakeTownsquareServer(["room"], rate=200.0)
+        port = await server.start()
+        monkeypatch.setitem(spy.KNOWN_SERVERS, "localhost", f"ws://127.0.0.1:{port}")
+        db_thread = StuckDatabaseThread()
+        monitored = MonitoredSessionState()
+        task = asyncio.create_task(monitor_session(monitored, "http://localhost/#room", db_thread))
+        try:
+            await wait_until(lambda: db_thread.writes)
+            await wait_until(lambda: monitored.stages["read"].items >= 200)
+            # Everything read since is waiting to be logged, in one batch.
+            assert len(db_thread.writes) == 1
+            assert monitored.stages["log"].batches == 0
+            assert monitored.stages["log"].depth >= 150
+            assert monitored.stages["update"].items >= 200
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await server.close()
+        assert db_thread.writes[0].cancelled()
+        return monitored.stages
+
+    stages = asyncio.run(run())
+    assert stages["decode"].max_depth <= 4
+    assert stages["update"].max_depth <= 4
+
+def test_failed_stage_cancels_others():
+    cancelled = []
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("stage failed")
+    async def wait():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+    with pytest.raises(ValueError):
+        asyncio.run(run_stages(wait(), fail()))
+    assert cancelled == [True]
@@ -0,0 +1,87 @@
+"""
+This module finds townsquare URLs in the text of chat messages.
+
+Most messages in game chat don't mention one, so a cheap substring check
+comes before the regular expression. URLs found recently are remembered
+for a while, so reposts and edits don't cause repeated work.
+"""
+
+import re
+import time
+
+from collections import OrderedDict
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass
+
+
+@dataclass
+class ScanStats:
+    messages: int = 0
+    # Messages with some text containing the marker, which the regex was run on.
+    candidates: int = 0
+    urls: int = 0
+    duplicates: int = 0
+    seconds: float = 0.0
+
+    def summary(self) -> str:
+        per_message = self.seconds / self.messages * 1e6 if self.messages else 0
+        return (f"{self.messages} messages scanned ({self.candidates} possible links, {self.urls} new, "
+                f"{self.duplicates} repeated), {per_message:.1f} µs per message")
+
+
+class LinkScanner(object):
+    """
+    Finds townsquare URLs which haven't been seen in the last recent_ttl
+    seconds. At most recent_size URLs are remembered; the least recently
+    seen are forgotten first.
+    """
+    marker = "clocktower."
+    pattern = re.compile(r'\bhttps?://clocktower\.(?:online|live)/#[A-Za-z0-9-_]+\b')
+
+    recent: OrderedDict[str, float]
+    recent_size: int
+    recent_ttl: float
+    clock: Callable[[], float]
+    stats: ScanStats
+
+    def __init__(self, recent_size: int = 1024, recent_ttl: float = 300, clock: Callable[[], float] = time.monotonic):
+        self.recent = OrderedDict()
+        self.recent_size = recent_size
+        self.recent_ttl = recent_ttl
+        self.clock = clock
+        self.stats = ScanStats()
+
+    def scan(self, texts: Iterable[str]) -> list[str]:
+        """
+        Returns the new URLs mentioned in any of a message's texts
+        (its content, and the text of any embeds), in order.
+        """
+        start = time.perf_counter()
+        self.stats.messages += 1
+        found = []
+        is_candidate = False
+        for text in texts:
+            if not text or self.marker not in text:
+                continue
+            is_candidate = True
+            for url in self.pattern.findall(text):
+                if url not in found:
+                    found.append(url)
+        if is_candidate:
+            self.stats.candidates += 1
+        new = [url for url in found if self.remember(url)]
+        self.stats.urls += len(new)
+        self.stats.duplicates += len(found) - len(new)
+        self.stats.seconds += time.perf_counter() - start
+        return new
+
+    def remember(self, url: str) -> bool:
+        """
+        Records that a URL was seen, returning whether it hadn't been recently.
+        """
+        now = self.clock()
+        seen = self.recent.pop(url, None)
+        self.recent[url] = now
+        if len(self.recent) > self.recent_size:
+            self.recent.popitem(last=False)
+        return seen is None or now - seen >= self.recent_ttl
@@ -0,0 +1,26 @@
+"""
+Unit tests for finding townsquare links in messages.
+"""
+
+from scanner import *
+
+def test_scan():
+    now = 0.0
+    scanner = LinkScanner(recent_size=2, recent_ttl=60, clock=lambda: now)
+    assert scanner.scan(["no links here", None]) == []
+    assert scanner.scan(["clocktower.online is down"]) == []
+    assert scanner.scan(["join https://clocktower.online/#abc",
+                         "https://clocktower.live/#def and https://clocktower.online/#abc"]) \
+        == ["https://clocktower.online/#abc", "https://clocktower.live/#def"]
+    # Edits and reposts are ignored for a while...
+    now = 30.0
+    assert scanner.scan(["https://clocktower.online/#abc (edited)"]) == []
+    # ...but a room reused for another game later on is found again.
+    now = 120.0
+    assert scanner.scan(["https://clocktower.online/#abc"]) == ["https://clocktower.online/#abc"]
+    # Only the most recently seen are remembered.
+    scanner.scan(["https://clocktower.online/#ghi https://clocktower.online/#jkl"])
+    assert scanner.scan(["https://clocktower.online/#abc"]) == ["https://clocktower.online/#abc"]
+    stats = scanner.stats
+    assert (stats.messages, stats.candidates, stats.urls, stats.duplicates) == (7, 6, 6, 1)
+    assert "7 messages scanned" in stats.summary()
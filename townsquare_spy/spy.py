@@ -1,10 +1,17 @@
+import asyncio
+import contextlib
+import functools
+import hashlib
 import json
 import json.decoder
 import secrets
+import sys
+import time
 import websockets
 
+from collections import OrderedDict, deque
 from collections.abc import Callable
-from dataclasses import dataclass, field
+from dataclasses import asdict, dataclass, field, fields
 from typing import Optional
 from urllib.parse import urlparse
 
@@ -19,9 +26,33 @@ class Player:
     is_voteless: bool = False
     known_role: str = ''
 
+@dataclass
+class NominationRecord:
+    """
+    A nomination which went to a vote, as it stood once the vote finished.
+    """
+    nominator: str = ''
+    nominee: str = ''
+    # Who voted, by seat, and which of them were dead (spending their vote).
+    voters: list[str] = field(default_factory=list)
+    dead_voters: list[str] = field(default_factory=list)
+    living_players: int = 0
+    # Whether the nominee went on the block, and whether this tied the
+    # player already on it (so that neither is).
+    on_the_block: bool = False
+    tied: bool = False
+
+    @property
+    def votes(self):
+        return len(self.voters)
+
 @dataclass
 class Session:
     log: Callable[[str], None] = lambda x: None
+    # Notable events are also reported in a structured form, as
+    # event(kind, player=name, target=name), where player and target are
+    # included only if relevant. Each follows the log message describing it.
+    event: Callable[..., None] = lambda kind, **details: None
     players: list[Player] = field(default_factory=list)
     is_night: bool = False
     is_vote_history_allowed: bool = False
@@ -29,9 +60,51 @@ class Session:
     votes: set[int] = field(default_factory=set)
     is_vote_in_progress: bool = False
     locked_vote: int = 0
+    # The votes locked in so far as the vote goes around the circle, and the
+    # dead players among them. These are kept up to date as each is locked.
+    vote_count: int = 0
+    dead_votes: list[str] = field(default_factory=list)
+    # Every nomination which went to a vote, and who today's votes have put on
+    # the block (with the most votes, at least half the living players, untied).
+    # block_votes is the count to beat, which is kept even after a tie.
+    nomination_history: list[NominationRecord] = field(default_factory=list)
+    on_the_block: Optional[str] = None
+    block_votes: int = 0
     marked_player: int = -1
+    # Whether the marked player has been recorded as executed, which they are
+    # once night falls with them still marked.
+    mark_executed: bool = False
+    # Whether the session has been seen during the day. Until then, night
+    # may have fallen before it was joined, so a mark can't be counted.
+    seen_day: bool = False
     fabled: list[str] = field(default_factory=list)
     edition_name: str = ""
+    # Identifies the script's roles (see ScriptCatalog), if they were sent.
+    script_hash: str = ""
+    # If set, the roles aren't listed in the log, only counted, for when
+    # the script is recorded elsewhere (e.g. reported by a "script" event).
+    abbreviate_scripts: bool = False
+    # Incremented whenever the players or fabled change, so that consumers
+    # can tell whether they need to look at them again.
+    state_version: int = 0
+
+# Sessions can be saved and restored (e.g. to checkpoint them), except for
+# their callbacks. The result can be converted to JSON.
+
+def session_to_dict(session):
+    d = {f.name: getattr(session, f.name) for f in fields(Session)
+         if f.name not in ('log', 'event', 'abbreviate_scripts')}
+    d['players'] = [asdict(p) for p in session.players]
+    d['votes'] = sorted(session.votes)
+    d['nomination_history'] = [asdict(n) for n in session.nomination_history]
+    return d
+
+def session_from_dict(d):
+    session = Session(**{k: v for k, v in d.items() if k not in ('players', 'votes', 'nomination_history')})
+    session.players = [Player(**p) for p in d['players']]
+    session.votes = set(d['votes'])
+    session.nomination_history = [NominationRecord(**n) for n in d.get('nomination_history', [])]
+    return session
 
 # Fancy (ANSI) formatting!
 # See strip_ansi in spy_test.py for how to remove this.
@@ -62,6 +135,44 @@ def player_seat(name, id):
         desc += f'\x1b[0;30m [{id}]\x1b[0m'
     return desc
 
+def vote_position(session, index):
+    """
+    When a player's vote is locked: the first to vote (after the nominee) is
+    0, and the nominee is last. A vote is locked once this is less than
+    session.locked_vote - 1.
+    """
+    return (index - 1 - session.nomination[1]) % len(session.players)
+
+def count_locked_votes(session):
+    """
+    Recounts the votes locked in so far, for when a vote is joined partway through.
+    """
+    session.vote_count = 0
+    session.dead_votes = []
+    if not session.nomination:
+        return
+    for index in sorted(session.votes, key=lambda i: vote_position(session, i)):
+        if vote_position(session, index) < session.locked_vote - 1:
+            session.vote_count += 1
+            if session.players[index].is_dead:
+                session.dead_votes.append(session.players[index].name)
+
+def execute_marked_player(session):
+    """
+    Records an execution of the player marked as night falls, unless this mark
+    has already been counted (marks can be moved or cleared during the day).
+    A mark found when first joining a session at night is taken to have been
+    counted already, since whether it was executed wasn't seen.
+    """
+    if 0 <= session.marked_player < len(session.players) and not session.mark_executed:
+        session.mark_executed = True
+        if session.seen_day:
+            session.event('execution', player=session.players[session.marked_player].name)
+
+def start_new_day(session):
+    session.on_the_block = None
+    session.block_votes = 0
+
 def night_or_day(is_night):
     if is_night:
         return '\x1b[0;34mnight\x1b[0m'
@@ -78,6 +189,54 @@ def townsquare_handler(name):
         return func
     return _decorator
 
+# Handler calls can optionally be instrumented.
+# Middleware is called as middleware(session, m, call_next), and must call
+# call_next() for the handler (or the next middleware) to run.
+# Observers are called after each handler as observer(type, elapsed_seconds, m).
+# If neither is registered, receive() calls the handler directly, so this costs
+# nothing when it isn't used.
+
+handler_middleware = []
+handler_observers = []
+
+@dataclass
+class HandlerStat:
+    count: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+
+class HandlerStats:
+    """
+    An observer which aggregates how long each message type takes to handle.
+    Messages slower than slow_threshold seconds are also sampled, so that the
+    most recent few can be inspected.
+    """
+    def __init__(self, slow_threshold: float = 0.01, max_samples: int = 20):
+        self.by_type: dict[str, HandlerStat] = {}
+        self.slow_threshold = slow_threshold
+        self.slow_samples = deque(maxlen=max_samples)
+
+    def __call__(self, message_type: str, elapsed: float, m: list):
+        stat = self.by_type.get(message_type)
+        if stat is None:
+            stat = self.by_type[message_type] = HandlerStat()
+        stat.count += 1
+        stat.total_seconds += elapsed
+        stat.max_seconds = max(stat.max_seconds, elapsed)
+        if elapsed >= self.slow_threshold:
+            self.slow_samples.append((elapsed, m))
+
+    def summary(self, limit: Optional[int] = None) -> list[str]:
+        """
+        Describes the message types which took the most time, one per line.
+        """
+        ranked = sorted(self.by_type.items(), key=lambda item: item[1].total_seconds, reverse=True)
+        return [
+            f'{message_type}: {stat.count} calls, {stat.total_seconds * 1000:.1f} ms total, '
+            f'{stat.max_seconds * 1000:.2f} ms max'
+            for message_type, stat in ranked[:limit]
+        ]
+
 @townsquare_handler('bye')
 @townsquare_handler('claim')
 @townsquare_handler('getGamestate')
@@ -90,6 +249,62 @@ def ignore_message(*args):
     """
     pass
 
+# Scripts are kept by a hash of what the host sent, so that the same script
+# (re-sent on every connection, and played in many games) is parsed and stored once.
+
+@dataclass(frozen=True)
+class Script:
+    hash: str
+    edition_id: str
+    name: str
+    author: str
+    roles: tuple[str, ...]
+
+def script_hash(edition_info):
+    canonical = json.dumps(edition_info, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()[:16]
+
+class ScriptCatalog(object):
+    """
+    The most recently seen scripts, by hash. Role IDs are interned, so that
+    each is only stored once however many scripts include it.
+    """
+    scripts: OrderedDict[str, Script]
+    size: int
+    hits: int
+    misses: int
+
+    def __init__(self, size=256):
+        self.scripts = OrderedDict()
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, hash):
+        return self.scripts.get(hash)
+
+    def parse(self, edition_info):
+        hash = script_hash(edition_info)
+        script = self.scripts.get(hash)
+        if script is not None:
+            self.hits += 1
+            self.scripts.move_to_end(hash)
+            return script
+        self.misses += 1
+        edition = edition_info['edition']
+        script = Script(
+            hash=hash,
+            edition_id=edition.get('id', ''),
+            name=edition.get('name', edition.get('id', '').upper()),
+            author=edition.get('author', ''),
+            roles=tuple(sys.intern(r.get('id') or r.get('0')) for r in edition_info.get('roles', [])))
+        self.scripts[hash] = script
+        if len(self.scripts) > self.size:
+            self.scripts.popitem(last=False)
+        return script
+
+script_catalog = ScriptCatalog()
+
 @townsquare_handler('edition')
 def set_edition(session, edition_info):
     """
@@ -106,10 +321,21 @@ def set_edition(session, edition_info):
             ... id, name, image, ability, edition, etc
     """
     edition_name = edition_info['edition'].get('name', edition_info['edition']['id'].upper())
+    script = script_catalog.parse(edition_info) if edition_info.get('roles') else None
+    new_hash = script.hash if script else ''
+    if session.edition_name == edition_name and session.script_hash == new_hash:
+        # This is re-sent to each new spectator, but nothing has changed.
+        return
     session.log(f'The script was changed to {edition_name}.')
+    session.event('edition', target=edition_name)
     session.edition_name = edition_name
-    if edition_info.get('roles'):
-        session.log('It contains: ' + ', '.join([r.get('id') or r.get('0') for r in edition_info['roles']]))
+    session.script_hash = new_hash
+    if script:
+        if session.abbreviate_scripts:
+            session.log(f'It contains {len(script.roles)} characters.')
+        else:
+            session.log('It contains: ' + ', '.join(script.roles))
+        session.event('script', target=script.hash)
 
 @townsquare_handler('gs')
 def receive_game_state(session, state_info):
@@ -151,16 +377,29 @@ def receive_game_state(session, state_info):
             )
             for p in state_info['gamestate']
         ]
+        session.state_version += 1
     is_lightweight = state_info.get('isLightweight', False)
     if not is_lightweight:
+        was_night = session.is_night
         session.is_night = state_info.get('isNight', False)
         session.is_vote_history_allowed = state_info.get('isVoteHistoryAllowed', False)
         session.nomination = state_info.get('nomination', None)
         session.votes = {i for i, v in enumerate(state_info.get('votes', [])) if v}
         session.is_vote_in_progress = state_info.get('isVoteInProgress', False)
         session.locked_vote = state_info.get('lockedVote', 0)
-        session.marked_player = state_info.get('markedPlayer', -1)
+        marked_player = state_info.get('markedPlayer', -1)
+        if marked_player != session.marked_player:
+            session.mark_executed = False
+        session.marked_player = marked_player
         session.fabled = [f['id'] for f in state_info.get('fabled', [])]
+        session.state_version += 1
+        count_locked_votes(session)
+        if session.is_night:
+            if not was_night:
+                execute_marked_player(session)
+            start_new_day(session)
+        else:
+            session.seen_day = True
 
     if not is_lightweight:
         session.log('Players:')
@@ -205,7 +444,13 @@ def change_night_phase(session, new_value = None):
     """
     if new_value is None:
         new_value = not session.is_night
+    if new_value and not session.is_night:
+        execute_marked_player(session)
     session.is_night = new_value
+    if session.is_night:
+        start_new_day(session)
+    else:
+        session.seen_day = True
     session.log(f'It is now {night_or_day(session.is_night)}.')
 
 
@@ -246,23 +491,30 @@ def update_player(session, update):
         else:
             session.log(f'{player_seat(player.name, value)} claimed their seat.')
         player.id = value
+        session.state_version += 1
     elif property == 'name':
         session.log(f'{player_name(player.name)} was renamed {player_name(value)}.')
         player.name = value
+        session.state_version += 1
     elif property == 'pronouns':
         player.pronouns = value
+        session.state_version += 1
         if value:
             session.log(f'{player_name(player.name)} changed their pronouns to {player_pronouns(player.pronouns)}.')
         else:
             session.log(f'{player_name(player.name)} cleared their pronouns.')
     elif property == 'isDead':
         player.is_dead = value
+        session.state_version += 1
         if value:
             session.log(f'{player_name(player.name)} died.')
+            session.event('death', player=player.name)
         else:
             session.log(f'{player_name(player.name)} came back to life.')
+            session.event('revival', player=player.name)
     elif property == 'isVoteless':
         player.is_voteless = value
+        session.state_version += 1
         if value:
             session.log(f'{player_name(player.name)} spent their dead vote.')
         elif player.is_dead:
@@ -270,9 +522,11 @@ def update_player(session, update):
     elif property == 'role':
         if value:
             player.known_role = value
+            session.state_version += 1
             session.log(f'{player_name(player.name)} became a \x1b[0;35m{value}\x1b[0m (traveler).')
         else:
             player.known_role = ''
+            session.state_version += 1
             session.log(f'{player_name(player.name)} became a resident.')
 
 @townsquare_handler('pronouns')
@@ -280,6 +534,7 @@ def change_pronouns(session, pronoun_info):
     index, pronouns = pronoun_info
     player = session.players[index]
     player.pronouns = pronouns
+    session.state_version += 1
     if pronouns:
         session.log(f'{player_name(player.name)} changed their pronouns to {player_pronouns(player.pronouns)}.')
     else:
@@ -298,16 +553,50 @@ def nominate(session, nom = None):
         elif session.locked_vote <= len(session.players):
             session.log(f'Vote was cancelled.')
         else:
-            session.log(f'The following players voted: ' +
-                  ', '.join(player_name(session.players[p].name) for p in sorted(session.votes)))
+            record = record_nomination(session)
+            session.log(f'The following players voted: ' + ', '.join(player_name(p) for p in record.voters))
+            for p in record.voters:
+                session.event('vote', player=p, target=record.nominee)
+            if record.tied:
+                session.log(f'That ties with {record.votes} votes, so nobody is on the block.')
+            elif record.on_the_block:
+                session.log(f'{player_name(record.nominee)} is on the block with {record.votes} votes.')
     else:
         players = session.players
         session.log(f'{player_name(players[nom[0]].name)} nominated {player_name(players[nom[1]].name)}.')
+        session.event('nomination', player=players[nom[0]].name, target=players[nom[1]].name)
         session.votes = set()
         session.is_vote_in_progress = False
         session.locked_vote = 0
+        session.vote_count = 0
+        session.dead_votes = []
     session.nomination = nom
 
+def record_nomination(session):
+    """
+    Records the result of a finished vote, and who that puts on the block.
+    """
+    players = session.players
+    nominator, nominee = session.nomination
+    living_players = sum(1 for p in players if not p.is_dead)
+    record = NominationRecord(
+        nominator=players[nominator].name,
+        nominee=players[nominee].name,
+        voters=[players[p].name for p in sorted(session.votes)],
+        dead_voters=list(session.dead_votes),
+        living_players=living_players)
+    # Half the living players, rounded up, is enough to go on the block.
+    if record.votes >= (living_players + 1) // 2:
+        if record.votes > session.block_votes:
+            record.on_the_block = True
+            session.on_the_block = record.nominee
+            session.block_votes = record.votes
+        elif record.votes == session.block_votes:
+            record.tied = True
+            session.on_the_block = None
+    session.nomination_history.append(record)
+    return record
+
 @townsquare_handler('swap')
 def swap_players(session, indices):
     """
@@ -319,6 +608,7 @@ def swap_players(session, indices):
     i, j = indices
     session.log(f'{player_name(players[i].name)} and {player_name(players[j].name)} swapped seats.')
     players[i], players[j] = players[j], players[i]
+    session.state_version += 1
 
 @townsquare_handler('move')
 def move_player(session, indices):
@@ -333,6 +623,7 @@ def move_player(session, indices):
     player = players[i]
     del players[i]
     players.insert(j, player)
+    session.state_version += 1
 
 @townsquare_handler('remove')
 def remove_player(session, index):
@@ -344,6 +635,7 @@ def remove_player(session, index):
     players = session.players
     session.log(f'{player_name(players[index].name)} was removed.')
     del players[index]
+    session.state_version += 1
 
 @townsquare_handler('marked')
 def mark_player(session, index):
@@ -356,7 +648,9 @@ def mark_player(session, index):
         session.log(f'The execution mark was cleared.')
     else:
         session.log(f'{player_name(session.players[index].name)} was marked for execution.')
+        session.event('marked', player=session.players[index].name)
     session.marked_player = index
+    session.mark_executed = False
 
 @townsquare_handler('isVoteInProgress')
 def start_end_vote(session, status):
@@ -380,8 +674,7 @@ def update_vote(session, info):
     if not session.nomination:
         return
     index, vote, from_st = info
-    index_locked = (index - 1 - session.nomination[1]) % len(session.players)
-    if from_st or index_locked >= session.locked_vote - 1:
+    if from_st or vote_position(session, index) >= session.locked_vote - 1:
         if vote:
             session.votes.add(index)
         else:
@@ -399,10 +692,16 @@ def lock_vote(session, info):
     relative, vote = info
     session.locked_vote = relative
     if relative <= 1:
+        # The vote is (re)starting.
+        session.vote_count = 0
+        session.dead_votes = []
         return
     index = (session.nomination[1] + relative - 1) % len(session.players)
     if vote:
         session.votes.add(index)
+        session.vote_count += 1
+        if session.players[index].is_dead:
+            session.dead_votes.append(session.players[index].name)
     else:
         session.votes.discard(index)
 
@@ -417,6 +716,7 @@ def update_fabled(session, fabled):
     """
     previous_fabled = session.fabled
     session.fabled = [f['id'] for f in fabled]
+    session.state_version += 1
     for f in previous_fabled:
         if f not in session.fabled:
             session.log(f'Fabled \x1b[0;33m{f}\x1b[0m was removed.')
@@ -433,7 +733,38 @@ def receive(session, m):
     if not handler:
         raise ValueError('unrecognized message type ' + repr(m[0]))
 
-    handler(session, *m[1:])
+    if handler_middleware or handler_observers:
+        _instrumented_call(handler, session, m)
+    else:
+        handler(session, *m[1:])
+
+def affects_state(m):
+    """
+    Whether a message might change the session, i.e. isn't ignored.
+    Replaying just these messages reconstructs the session.
+    """
+    return message_handlers.get(m[0]) is not ignore_message
+
+def replay(messages, state=None):
+    """
+    Reconstructs a session by receiving messages, starting from a saved state if given.
+    """
+    session = Session() if state is None else session_from_dict(state)
+    for m in messages:
+        receive(session, m)
+    return session
+
+def _instrumented_call(handler, session, m):
+    call = functools.partial(handler, session, *m[1:])
+    for middleware in reversed(handler_middleware):
+        call = functools.partial(middleware, session, m, call)
+    start = time.perf_counter()
+    try:
+        call()
+    finally:
+        elapsed = time.perf_counter() - start
+        for observer in handler_observers:
+            observer(m[0], elapsed, m)
 
 def random_player_id():
     return f'spy_{secrets.token_hex(4)}'
@@ -441,24 +772,80 @@ def random_player_id():
 # Known servers:
 # https://clocktower.online -> wss://live.clocktower.online:8080/{session}/{player_id}
 # https://clocktower.live -> wss://clocktower.live:8001/{session}/{player_id}
+# The websocket server used by each townsquare host. Others (such as a fake
+# server for testing) can be added here.
+KNOWN_SERVERS = {
+    'clocktower.online': 'wss://live.clocktower.online:8080',
+    'clocktower.live': 'wss://clocktower.live:8001',
+}
+
 def interpret_url(game_url, player_id):
     u = urlparse(game_url)
     session_name = u.fragment
-    socket_url = None
-    if u.hostname == 'clocktower.online':
-        socket_url = f'wss://live.clocktower.online:8080/{session_name}/{player_id}'
-    elif u.hostname == 'clocktower.live':
-        socket_url = f'wss://clocktower.live:8001/{session_name}/{player_id}'
-    if not session_name or not socket_url:
+    server = KNOWN_SERVERS.get(u.hostname)
+    if not session_name or not server:
         raise ValueError('unknown game URL', game_url)
-    return (socket_url, f'{u.scheme}://{u.netloc}')
+    return (f'{server}/{session_name}/{player_id}', f'{u.scheme}://{u.netloc}')
 
-async def connect_to_session(socket_url, origin, player_id):
+async def connect_raw(socket_url, origin, player_id):
+    """
+    Yields the messages received from a session without parsing them,
+    after asking the host for its state.
+    """
     async with websockets.connect(socket_url, origin=origin) as ws:
         await ws.send(json.dumps(["direct", {"host": ["getGamestate", player_id]}]))
         while True:
-            try:
-                m = json.loads(await ws.recv())
-            except json.decoder.JSONDecodeError:
+            yield await ws.recv()
+
+# Messages from a hub (see hub.py) are one per line. Lines can be as long as
+# the largest game state.
+HUB_LINE_LIMIT = 2 ** 24
+
+async def connect_via_hub(hub_path, game_url):
+    """
+    Yields the messages received from a session without parsing them, through
+    a hub listening on a Unix socket at hub_path. The hub shares one connection
+    to each session among everything subscribed to it, and begins with the
+    session's state so far. Raises ConnectionError if the hub loses its
+    connection to the session.
+    """
+    reader, writer = await asyncio.open_unix_connection(hub_path, limit=HUB_LINE_LIMIT)
+    try:
+        writer.write(game_url.encode() + b'\n')
+        await writer.drain()
+        while line := await reader.readline():
+            raw = line.decode().rstrip('\n')
+            if raw.startswith('["hub-error"'):
+                raise ConnectionError(json.loads(raw)[1])
+            yield raw
+    finally:
+        writer.close()
+
+def decode(raw):
+    """
+    Parses a message, returning None if it isn't valid JSON.
+    """
+    try:
+        return json.loads(raw)
+    except json.decoder.JSONDecodeError:
+        return None
+
+async def connect_to_session(socket_url, origin, player_id, skip=None):
+    """
+    Yields the messages received from a session, after asking the host for its state.
+    If given, skip(raw) is called with each message before it is parsed, and
+    if it returns True the message is dropped without being parsed.
+    """
+    async with contextlib.aclosing(connect_raw(socket_url, origin, player_id)) as socket:
+        async for raw in socket:
+            if skip is not None and skip(raw):
                 continue
-            yield m
+            m = decode(raw)
+            if m is not None:
+                yield m
+
+def is_ping(raw):
+    """
+    Recognizes pings without parsing them. They don't affect the session.
+    """
+    return isinstance(raw, str) and raw.startswith('["ping"')
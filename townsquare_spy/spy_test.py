@@ -4,8 +4,11 @@ Unit tests for the game logic.
 This is isolated from the websocket client by using pre-canned messages.
 """
 
+import asyncio
+import json
 import pytest
 import re
+import sys
 
 from spy import *
 
@@ -97,6 +100,34 @@ def test_shows_homebrew_edition():
     assert any_line_matches(output, r'script.*Werewolf'), "expected to see script change"
     assert any_line_matches(output, r'villager'), "expected to see character list"
 
+def test_script_catalog():
+    session, output = simulated_session()
+    events = []
+    session.event = lambda kind, player=None, target=None: events.append((kind, target))
+    roles = [dict(id=id) for id in ["clockmaker", "empath", "drunk", "imp"]]
+    edition = {"edition": dict(id="custom", name="Small Script", author="Someone"), "roles": roles}
+    catalog = ScriptCatalog(size=2)
+    script = catalog.parse(edition)
+    assert script.roles == ("clockmaker", "empath", "drunk", "imp")
+    assert script.name == "Small Script" and script.author == "Someone"
+    assert catalog.parse(json.loads(json.dumps(edition))) is script, "expected the same script to be found by hash"
+    assert (catalog.hits, catalog.misses) == (1, 1)
+    assert script.roles[0] is sys.intern("clockmaker")
+    catalog.parse({"edition": dict(id="other"), "roles": roles[:2]})
+    catalog.parse({"edition": dict(id="third"), "roles": roles[2:]})
+    assert catalog.get(script.hash) is None, "expected the least recently used script to be dropped"
+
+    receive(session, ["edition", edition])
+    assert ("script", script_hash(edition)) in events
+    output.clear()
+    events.clear()
+    receive(session, ["edition", edition])
+    assert output == [] and events == [], "expected an unchanged script to be ignored"
+    session.abbreviate_scripts = True
+    receive(session, ["edition", {"edition": dict(id="custom", name="Small Script"), "roles": roles[:3]}])
+    assert any_line_matches(output, r'contains 3 characters')
+    assert not any_line_matches(output, r'clockmaker')
+
 def test_shows_player_names_and_ids():
     session, output = simulated_session()
     receive(session, ["edition", {"edition": {"id": "tb"}}])
@@ -321,6 +352,41 @@ def test_mark_for_execution():
     assert session.marked_player == -1
     assert any_line_matches(output, "mark.*cleared")
 
+def test_execution_at_nightfall():
+    session, output = simulated_session()
+    events = []
+    session.event = lambda kind, **details: events.append((kind, details))
+    receive(session, ["gs", basic_gs()])
+    receive(session, ["marked", 1])
+    receive(session, ["marked", 2])
+    receive(session, ["isNight", True])
+    # The same mark resent, or left standing into the next night, is only counted once.
+    receive(session, ["gs", dict(basic_gs(), isNight=True, markedPlayer=2)])
+    receive(session, ["isNight", False])
+    receive(session, ["isNight", True])
+    receive(session, ["isNight", False])
+    receive(session, ["marked", 3])
+    receive(session, ["marked", -1])
+    receive(session, ["isNight", True])
+    assert [(kind, details) for kind, details in events if kind == "execution"] == [
+        ("execution", dict(player="Charlie")),
+    ]
+
+def test_joined_at_night():
+    session, output = simulated_session()
+    events = []
+    session.event = lambda kind, **details: events.append((kind, details))
+    # Night fell with Charlie marked before the session was joined.
+    receive(session, ["gs", dict(basic_gs(), isNight=True, markedPlayer=2)])
+    receive(session, ["isNight", False])
+    receive(session, ["isNight", True])
+    receive(session, ["isNight", False])
+    receive(session, ["marked", 3])
+    receive(session, ["isNight", True])
+    assert [(kind, details) for kind, details in events if kind == "execution"] == [
+        ("execution", dict(player="Delta")),
+    ]
+
 def test_nominate_and_cancel():
     session, output = simulated_session()
     receive(session, ["edition", {"edition": {"id": "tb"}}])
@@ -588,6 +654,41 @@ def test_ignore_ping():
     receive(session, ["ping", [9, "69"]])
     receive(session, ["ping", [9, "420"]])
     receive(session, ["ping", [9, "47"]])
+    assert is_ping('["ping", [9, "47"]]')
+    assert not is_ping('["gs", {"gamestate": []}]')
+    assert decode('["ping", [9, "47"]]') == ["ping", [9, "47"]]
+    assert decode('["ping", [9, ') is None
+
+def test_interpret_url():
+    assert interpret_url("https://clocktower.online/#game", "abc") == \
+        ("wss://live.clocktower.online:8080/game/abc", "https://clocktower.online")
+    KNOWN_SERVERS["localhost"] = "ws://127.0.0.1:8765"
+    try:
+        assert interpret_url("http://localhost/#game", "abc")[0] == "ws://127.0.0.1:8765/game/abc"
+    finally:
+        del KNOWN_SERVERS["localhost"]
+    with pytest.raises(ValueError):
+        interpret_url("https://example.com/#game", "abc")
+
+def test_connect_via_hub(tmp_path):
+    async def run():
+        requested = []
+        async def handle(reader, writer):
+            requested.append((await reader.readline()).decode())
+            writer.write(b'["edition", {"edition": {"id": "tb"}}]\n["ping", [1, "20"]]\n')
+            writer.write(b'["hub-error", "ConnectionClosedError()"]\n')
+            writer.close()
+        path = str(tmp_path / "hub.sock")
+        server = await asyncio.start_unix_server(handle, path)
+        received = []
+        with pytest.raises(ConnectionError):
+            async for raw in connect_via_hub(path, "https://clocktower.online/#game"):
+                received.append(raw)
+        server.close()
+        return requested, received
+    requested, received = asyncio.run(run())
+    assert requested == ["https://clocktower.online/#game\n"]
+    assert received == ['["edition", {"edition": {"id": "tb"}}]', '["ping", [1, "20"]]']
 
 def test_organ_grinder_extension():
     # clocktower.live extension for Organ Grinder
@@ -633,3 +734,157 @@ def test_banshee_extension():
     receive(session, ["isVoteInProgress", False])
     receive(session, ["nomination", None])
     assert any_line_matches(output, r'voted.*Alpha$')
+
+def test_handler_stats():
+    session, output = simulated_session()
+    stats = HandlerStats(slow_threshold=0)
+    handler_observers.append(stats)
+    try:
+        receive(session, ["edition", {"edition": {"id": "tb"}}])
+        receive(session, ["gs", basic_gs()])
+        receive(session, ["ping", [9, "69"]])
+        receive(session, ["ping", [9, "420"]])
+    finally:
+        handler_observers.remove(stats)
+    assert stats.by_type["ping"].count == 2
+    assert stats.by_type["gs"].count == 1
+    assert stats.by_type["gs"].total_seconds >= stats.by_type["gs"].max_seconds > 0
+    assert len(stats.slow_samples) == 4
+    assert any(line.startswith("gs: 1 calls") for line in stats.summary())
+
+def test_handler_middleware():
+    session, output = simulated_session()
+    seen = []
+    def middleware(session, m, call_next):
+        seen.append(m[0])
+        if m[0] != "isNight":
+            call_next()
+    handler_middleware.append(middleware)
+    try:
+        receive(session, ["gs", basic_gs()])
+        receive(session, ["isNight", True])
+    finally:
+        handler_middleware.remove(middleware)
+    assert seen == ["gs", "isNight"]
+    assert not session.is_night
+
+def test_state_version():
+    session, output = simulated_session()
+    receive(session, ["edition", {"edition": {"id": "tb"}}])
+    receive(session, ["gs", basic_gs()])
+    version = session.state_version
+    receive(session, ["ping", [9, "69"]])
+    receive(session, ["isNight", True])
+    receive(session, ["nomination", [0, 1]])
+    receive(session, ["vote", [2, 1, False]])
+    assert session.state_version == version
+    receive(session, ["player", dict(index=1, property="isDead", value=True)])
+    assert session.state_version > version
+    version = session.state_version
+    receive(session, ["swap", [0, 1]])
+    assert session.state_version > version
+    version = session.state_version
+    receive(session, ["fabled", [{"id": "buddhist"}]])
+    assert session.state_version > version
+
+def test_events():
+    session, output = simulated_session()
+    events = []
+    session.event = lambda kind, **details: events.append((kind, details))
+    receive(session, ["edition", {"edition": {"id": "tb"}}])
+    receive(session, ["gs", basic_gs(player_count=5)])
+    receive(session, ["nomination", [0, 1]])
+    receive(session, ["lock", [0, None]])
+    receive(session, ["isVoteInProgress", True])
+    receive(session, ["lock", [1, None]])
+    receive(session, ["lock", [2, 1]])
+    for i in range(3, 7):
+        receive(session, ["lock", [i, None]])
+    receive(session, ["nomination", None])
+    receive(session, ["marked", 1])
+    receive(session, ["player", dict(index=1, property="isDead", value=True)])
+    assert events == [
+        ("edition", dict(target="TB")),
+        ("nomination", dict(player="Alpha", target="Bravo")),
+        ("vote", dict(player="Charlie", target="Bravo")),
+        ("marked", dict(player="Bravo")),
+        ("death", dict(player="Bravo")),
+    ]
+
+def run_vote(session, nomination, votes):
+    """
+    Runs a vote, locking each player's vote in turn (votes are by player index).
+    """
+    receive(session, ["nomination", nomination])
+    receive(session, ["lock", [0, None]])
+    receive(session, ["isVoteInProgress", True])
+    receive(session, ["lock", [1, None]])
+    for relative in range(2, len(session.players) + 2):
+        index = (nomination[1] + relative - 1) % len(session.players)
+        receive(session, ["lock", [relative, 1 if index in votes else None]])
+    receive(session, ["nomination", None])
+
+def test_vote_tally():
+    session, output = simulated_session()
+    receive(session, ["gs", basic_gs(player_count=5)])
+    receive(session, ["player", dict(index=4, property="isDead", value=True)])
+    receive(session, ["nomination", [0, 1]])
+    receive(session, ["lock", [1, None]])
+    receive(session, ["lock", [2, 1]])
+    receive(session, ["lock", [3, 1]])
+    assert (session.vote_count, session.dead_votes) == (2, [])
+    receive(session, ["lock", [4, 1]])
+    assert (session.vote_count, session.dead_votes) == (3, ["Echo"])
+    receive(session, ["lock", [5, None]])
+    receive(session, ["lock", [6, None]])
+    receive(session, ["nomination", None])
+    assert session.on_the_block == "Bravo"
+    assert any_line_matches(output, r"Bravo is on the block with 3 votes")
+
+    # Joining partway through a vote counts what has been locked so far.
+    joined = Session()
+    gs = basic_gs(player_count=5)
+    gs.update(nomination=[2, 3], votes=[True, False, False, False, True], lockedVote=2)
+    receive(joined, ["gs", gs])
+    assert joined.vote_count == 1
+
+    run_vote(session, [2, 3], votes={0, 1, 2})
+    assert session.on_the_block is None
+    assert any_line_matches(output, r"That ties with 3 votes")
+    run_vote(session, [3, 0], votes={0})
+    assert session.block_votes == 3
+
+    history = session.nomination_history
+    assert [(n.nominator, n.nominee, n.votes) for n in history] == [
+        ("Alpha", "Bravo", 3), ("Charlie", "Delta", 3), ("Delta", "Alpha", 1)]
+    assert history[0].dead_voters == ["Echo"] and history[0].on_the_block
+    assert history[1].tied and not history[2].on_the_block
+    assert session_from_dict(json.loads(json.dumps(session_to_dict(session)))).nomination_history == history
+
+    receive(session, ["isNight", True])
+    assert (session.on_the_block, session.block_votes) == (None, 0)
+
+def test_save_and_replay():
+    messages = [
+        ["edition", {"edition": {"id": "tb"}}],
+        ["gs", basic_gs(player_count=5)],
+        ["ping", [9, "69"]],
+        ["player", dict(index=1, property="isDead", value=True)],
+        ["nomination", [0, 2]],
+        ["lock", [0, None]],
+        ["isVoteInProgress", True],
+        ["lock", [1, None]],
+        ["lock", [2, 1]],
+    ]
+    session, output = simulated_session()
+    for m in messages:
+        receive(session, m)
+    assert not affects_state(messages[2])
+    assert affects_state(messages[3])
+
+    # Restoring from a checkpoint partway through should match replaying everything.
+    saved = json.loads(json.dumps(session_to_dict(replay(messages[:4]))))
+    restored = replay(messages[4:], saved)
+    assert session_to_dict(restored) == session_to_dict(session)
+    assert restored.votes == {3}
+    assert restored.players[1].is_dead
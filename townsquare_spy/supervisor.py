@@ -0,0 +1,261 @@
+"""
+This module keeps track of the sessions being monitored, limiting how many
+are monitored at once and restarting monitors which fail.
+
+It doesn't depend on how a session is monitored (see monitor.py), so that it
+can be tested without connecting to anything.
+"""
+
+import asyncio
+import functools
+import math
+import time
+
+from collections import OrderedDict, deque
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from .monitor import StageStats
+    from .spy import Session
+
+# Message rates are averaged over roughly this many seconds.
+RATE_WINDOW = 300
+
+# A game in which nothing has changed for this many seconds seems to be over.
+END_QUIET_AFTER = 1200
+
+
+@dataclass
+class MonitoredSessionState:
+    session: Optional["Session"] = None
+    session_id: Optional[int] = None
+    session_start: Optional[datetime] = None
+    task: Optional[asyncio.Task] = None
+    channel_id: Optional[int] = None
+    restarts: int = 0
+    # Health, as of the last message received (in time.monotonic() seconds).
+    messages: int = 0
+    last_message: Optional[float] = None
+    decayed_count: float = 0.0
+    last_error: Optional[BaseException] = None
+    # Whether the monitor is only checking on the session now and then.
+    hibernating: bool = False
+    # How each stage of the monitor is keeping up, by name.
+    stages: dict[str, "StageStats"] = field(default_factory=dict)
+    # When something last changed the session (in time.monotonic() seconds),
+    # and the most seats claimed at once, for telling when the game is over.
+    last_activity: Optional[float] = None
+    most_seated: int = 0
+
+    def record_message(self, now: Optional[float] = None):
+        if now is None:
+            now = time.monotonic()
+        if self.last_message is not None:
+            self.decayed_count *= math.exp(-(now - self.last_message) / RATE_WINDOW)
+        self.decayed_count += 1
+        self.last_message = now
+        self.messages += 1
+
+    def messages_per_minute(self, now: Optional[float] = None) -> float:
+        """
+        An exponentially weighted average of the recent message rate.
+        """
+        if self.last_message is None:
+            return 0.0
+        if now is None:
+            now = time.monotonic()
+        decayed = self.decayed_count * math.exp(-(now - self.last_message) / RATE_WINDOW)
+        return decayed * 60 / RATE_WINDOW
+
+    def record_activity(self, now: Optional[float] = None):
+        """
+        Records that something changed the session.
+        """
+        self.last_activity = time.monotonic() if now is None else now
+        seated = sum(1 for p in self.session.players if p.id)
+        self.most_seated = max(self.most_seated, seated)
+
+    def was_abandoned(self) -> bool:
+        """
+        Whether the monitor has stopped because the session was inactive for
+        too long (timing out), rather than failing or being cancelled.
+        """
+        task = self.task
+        return (task is not None and task.done() and not task.cancelled()
+                and isinstance(task.exception(), TimeoutError))
+
+    def end_signal(self, now: Optional[float] = None, quiet_after: float = END_QUIET_AFTER) -> Optional[str]:
+        """
+        Why the game seems to be over, if it does: the host revealed everyone's
+        roles, everyone who sat down has left their seat, or nothing has
+        changed for quiet_after seconds.
+        """
+        if self.session is None or self.last_activity is None:
+            return None
+        if now is None:
+            now = time.monotonic()
+        players = self.session.players
+        if players and all(p.known_role for p in players):
+            return "everyone's roles were revealed"
+        if self.most_seated and not any(p.id for p in players):
+            return "everyone left their seats"
+        if now - self.last_activity >= quiet_after:
+            return f"nothing has happened for {(now - self.last_activity) / 60:.0f} minutes"
+        return None
+
+
+Monitor = Callable[[MonitoredSessionState, str], Awaitable[None]]
+
+class MonitorSupervisor(object):
+    """
+    Runs up to max_concurrent monitors at once. URLs requested beyond that
+    wait in a queue, which is served fairly: one URL from each channel in
+    turn, so that a burst of links in one channel doesn't hold up the others.
+    At most max_queued URLs wait; any more are dropped, so that memory use
+    stays bounded however many links are posted.
+
+    A monitor which raises an exception (other than timing out, which is how
+    monitors give up on inactive sessions) is restarted after a delay, which
+    doubles each time, up to max_restarts times.
+    """
+    monitor: Monitor
+    max_concurrent: int
+    max_queued: int
+    max_restarts: int
+    restart_delay: float
+    sessions: dict[str, MonitoredSessionState]
+    queues: OrderedDict[Optional[int], deque[tuple[str, int]]]
+    queued_urls: set[str]
+    restarting: dict[str, asyncio.TimerHandle]
+    dropped: int
+    closed: bool
+
+    def __init__(self, monitor: Monitor, max_concurrent: int = 20, max_queued: int = 200,
+                 max_restarts: int = 3, restart_delay: float = 5.0):
+        self.monitor = monitor
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_restarts = max_restarts
+        self.restart_delay = restart_delay
+        self.sessions = dict()
+        self.queues = OrderedDict()
+        self.queued_urls = set()
+        self.restarting = dict()
+        self.dropped = 0
+        self.closed = False
+
+    def is_known(self, url: str) -> bool:
+        return url in self.sessions or url in self.queued_urls or url in self.restarting
+
+    def request(self, url: str, channel_id: Optional[int] = None) -> bool:
+        """
+        Starts monitoring a URL (or queues it, if at the limit).
+        Returns False if it was already being monitored or had to be dropped.
+        """
+        if self.closed or self.is_known(url):
+            return False
+        return self._enqueue(url, channel_id, 0)
+
+    def _enqueue(self, url: str, channel_id: Optional[int], restarts: int) -> bool:
+        if len(self.queued_urls) >= self.max_queued:
+            self.dropped += 1
+            return False
+        self.queues.setdefault(channel_id, deque()).append((url, restarts))
+        self.queued_urls.add(url)
+        self._fill()
+        return True
+
+    @property
+    def queued(self) -> int:
+        return len(self.queued_urls)
+
+    def _fill(self):
+        while self.queues and len(self.sessions) < self.max_concurrent:
+            channel_id, queue = next(iter(self.queues.items()))
+            url, restarts = queue.popleft()
+            # This channel goes to the back of the line.
+            del self.queues[channel_id]
+            if queue:
+                self.queues[channel_id] = queue
+            self.queued_urls.discard(url)
+            self._start(url, channel_id, restarts)
+
+    def _start(self, url: str, channel_id: Optional[int], restarts: int):
+        monitored = MonitoredSessionState(channel_id=channel_id, restarts=restarts)
+        monitored.task = asyncio.create_task(self.monitor(monitored, url))
+        monitored.task.add_done_callback(functools.partial(self._finished, url, monitored))
+        self.sessions[url] = monitored
+
+    def _finished(self, url: str, monitored: MonitoredSessionState, task: asyncio.Task):
+        if self.sessions.get(url) is monitored:
+            del self.sessions[url]
+        if not task.cancelled():
+            error = task.exception()
+            if error is not None and not isinstance(error, TimeoutError):
+                monitored.last_error = error
+                if not self.closed and monitored.restarts < self.max_restarts:
+                    delay = self.restart_delay * 2 ** monitored.restarts
+                    self.restarting[url] = asyncio.get_running_loop().call_later(
+                        delay, self._restart, url, monitored.channel_id, monitored.restarts + 1)
+        self._fill()
+
+    def _restart(self, url: str, channel_id: Optional[int], restarts: int):
+        del self.restarting[url]
+        if not self.closed and not self.is_known(url):
+            self._enqueue(url, channel_id, restarts)
+
+    async def shutdown(self, timeout: float = 5.0) -> int:
+        """
+        Stops all monitoring, waiting at most timeout seconds for the monitors
+        to finish. Returns how many were still running after that.
+        """
+        self.closed = True
+        self.queues.clear()
+        self.queued_urls.clear()
+        for handle in self.restarting.values():
+            handle.cancel()
+        self.restarting.clear()
+        tasks = [monitored.task for monitored in self.sessions.values()]
+        for task in tasks:
+            task.cancel()
+        if not tasks:
+            return 0
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        return len(pending)
+
+
+class GameEndWatcher(object):
+    """
+    Keeps particular games monitored (such as those storytellers are running),
+    and reports when each seems to be over (see MonitoredSessionState.end_signal).
+    A game whose monitor gave up on it after a long time without activity is
+    over too. One whose monitor failed is monitored again instead, so that our
+    own connection problems aren't mistaken for the game ending.
+    """
+    supervisor: MonitorSupervisor
+    # The last monitor seen for each game, until it stops.
+    last_seen: dict[str, MonitoredSessionState]
+
+    def __init__(self, supervisor: MonitorSupervisor):
+        self.supervisor = supervisor
+        self.last_seen = dict()
+
+    def game_end(self, url: str, channel_id: Optional[int] = None) -> Optional[str]:
+        """
+        Why the game at url seems to be over, if it does. The game is
+        monitored if it isn't already, so this can be called again and again.
+        """
+        monitored = self.supervisor.sessions.get(url)
+        if monitored is not None:
+            self.last_seen[url] = monitored
+            return monitored.end_signal()
+        if self.supervisor.is_known(url):
+            return None
+        last_seen = self.last_seen.pop(url, None)
+        if last_seen is not None and last_seen.was_abandoned():
+            return "the game stopped being monitored after a long time without activity"
+        self.supervisor.request(url, channel_id)
+        return None
@@ -0,0 +1,133 @@
+"""
+Unit tests for the monitor supervisor.
+
+These use stand-in monitors, so nothing is actually connected to.
+"""
+
+import asyncio
+import pytest
+
+from spy import Player, Session
+from supervisor import *
+
+def test_limit_and_fair_queue():
+    async def run():
+        started = []
+        finish = asyncio.Event()
+        async def monitor(monitored, url):
+            started.append(url)
+            await finish.wait()
+        supervisor = MonitorSupervisor(monitor, max_concurrent=2, max_queued=3)
+        for i in range(4):
+            supervisor.request(f"a{i}", channel_id=1)
+        supervisor.request("b0", channel_id=2)
+        assert not supervisor.request("a4", channel_id=1)
+        assert not supervisor.request("a0", channel_id=1)
+        await asyncio.sleep(0)
+        running = list(supervisor.sessions)
+        queued, dropped = supervisor.queued, supervisor.dropped
+        finish.set()
+        for i in range(5):
+            await asyncio.sleep(0)
+        return started, running, queued, dropped
+    started, running, queued, dropped = asyncio.run(run())
+    assert running == ["a0", "a1"]
+    assert (queued, dropped) == (3, 1)
+    # Channel 2 gets a turn between channel 1's remaining links.
+    assert started == ["a0", "a1", "a2", "b0", "a3"]
+
+def test_restart_on_failure():
+    async def run():
+        attempts = []
+        async def monitor(monitored, url):
+            attempts.append(monitored.restarts)
+            monitored.record_message()
+            if url == "failing":
+                raise ConnectionError()
+            raise TimeoutError()
+        supervisor = MonitorSupervisor(monitor, max_restarts=2, restart_delay=0.01)
+        supervisor.request("failing")
+        supervisor.request("abandoned")
+        await asyncio.sleep(0.2)
+        return attempts, supervisor
+    attempts, supervisor = asyncio.run(run())
+    assert attempts == [0, 0, 1, 2]
+    assert not supervisor.sessions and not supervisor.restarting
+
+def test_shutdown():
+    async def run():
+        async def monitor(monitored, url):
+            await asyncio.sleep(60)
+        async def slow_monitor(monitored, url):
+            try:
+                await asyncio.sleep(60)
+            finally:
+                # For example, finishing a write.
+                await asyncio.sleep(0.5)
+        supervisor = MonitorSupervisor(monitor)
+        supervisor.request("a")
+        supervisor.request("b")
+        await asyncio.sleep(0)
+        clean = await supervisor.shutdown(timeout=1)
+        slow = MonitorSupervisor(slow_monitor)
+        slow.request("c")
+        await asyncio.sleep(0)
+        remaining = await slow.shutdown(timeout=0.05)
+        assert not slow.request("d")
+        return clean, remaining
+    clean, remaining = asyncio.run(run())
+    assert clean == 0
+    assert remaining == 1
+
+def test_message_rate():
+    monitored = MonitoredSessionState()
+    assert monitored.messages_per_minute(0) == 0
+    for t in range(0, 600, 10):
+        monitored.record_message(t)
+    assert monitored.messages == 60
+    assert monitored.messages_per_minute(600) == pytest.approx(6, rel=0.2)
+    assert monitored.messages_per_minute(600 + RATE_WINDOW * 5) < 0.1
+
+def test_end_signal():
+    monitored = MonitoredSessionState(session=Session())
+    assert monitored.end_signal(0) is None
+    monitored.session.players = [Player(id="a", name="Alpha"), Player(id="b", name="Bravo")]
+    monitored.record_activity(0)
+    assert monitored.end_signal(60) is None
+    assert monitored.end_signal(END_QUIET_AFTER) == "nothing has happened for 20 minutes"
+    for p in monitored.session.players:
+        p.id = ""
+    monitored.record_activity(100)
+    assert monitored.most_seated == 2
+    assert monitored.end_signal(160) == "everyone left their seats"
+    monitored.session.players[0].known_role = "imp"
+    monitored.session.players[1].known_role = "washerwoman"
+    assert monitored.end_signal(160) == "everyone's roles were revealed"
+
+def test_game_end_watcher():
+    async def run():
+        attempts = []
+        finish = asyncio.Event()
+        async def monitor(monitored, url):
+            attempts.append(url)
+            monitored.session = Session(players=[Player(id="a", name="Alpha")])
+            monitored.record_activity()
+            await finish.wait()
+            # The monitor gives up on one game, and fails to connect to the other.
+            raise TimeoutError() if url == "abandoned" else ConnectionError()
+        supervisor = MonitorSupervisor(monitor, max_restarts=0)
+        watcher = GameEndWatcher(supervisor)
+        urls = ["abandoned", "failing"]
+        requested = [watcher.game_end(url) for url in urls]
+        await asyncio.sleep(0)
+        running = [watcher.game_end(url) for url in urls]
+        finish.set()
+        await asyncio.sleep(0.01)
+        stopped = [watcher.game_end(url) for url in urls]
+        await asyncio.sleep(0)
+        return requested, running, stopped, attempts
+    requested, running, stopped, attempts = asyncio.run(run())
+    assert requested == running == [None, None]
+    assert stopped == ["the game stopped being monitored after a long time without activity", None]
+    # A failed monitor isn't taken to mean the game is over; it's monitored again.
+    assert attempts == ["abandoned", "failing", "failing"]
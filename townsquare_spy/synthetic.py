@@ -0,0 +1,152 @@
+"""
+This module generates synthetic townsquare games: plausible sequences of
+the messages a spectator receives, for load testing (see loadtest.py).
+
+The games aren't meant to make sense as Blood on the Clocktower, only to
+exercise the spy with a realistic mix of messages which it accepts.
+"""
+
+import random
+
+from collections import deque
+from typing import Optional
+
+# Relative frequency of each kind of activity, besides pings.
+ACTIVITY_WEIGHTS = {
+    "death": 8,
+    "pronouns": 3,
+    "dead_vote": 2,
+    "nomination": 6,
+    "night": 2,
+    "fabled": 1,
+    "marked": 2,
+}
+
+FABLED = ["doomsayer", "angel", "buddhist", "revolutionary", "toymaker", "fibbin"]
+
+
+class SyntheticGame(object):
+    """
+    Generates the messages of one game. Activities which take several
+    messages (like a nomination and its vote) are queued, and the game's
+    own state is kept up to date as messages are generated, so that each
+    makes sense given the last. The state of any vote is only updated as
+    its messages are sent, so that the full state can be sent partway through.
+    """
+    rng: random.Random
+    players: list[dict]
+    is_night: bool
+    fabled: list[str]
+    marked_player: int
+    nomination: Optional[list[int]]
+    votes: set[int]
+    locked_vote: int
+    is_vote_in_progress: bool
+    queued: deque[list]
+
+    def __init__(self, rng: Optional[random.Random] = None, player_count: int = 10):
+        self.rng = rng or random.Random()
+        self.players = [
+            dict(name=f"Player {i + 1}", id=f"player{i + 1:02}", pronouns="", isDead=False, isVoteless=False)
+            for i in range(player_count)
+        ]
+        self.is_night = False
+        self.fabled = []
+        self.marked_player = -1
+        self.nomination = None
+        self.votes = set()
+        self.locked_vote = 0
+        self.is_vote_in_progress = False
+        self.queued = deque()
+
+    def edition(self) -> list:
+        return ["edition", {"edition": {"id": "tb"}}]
+
+    def game_state(self) -> list:
+        """
+        The full state, as sent by the host to a spectator who asks for it.
+        """
+        return ["gs", dict(
+            gamestate=[dict(p) for p in self.players],
+            isNight=self.is_night,
+            isVoteHistoryAllowed=True,
+            nomination=self.nomination or False,
+            votes=[i in self.votes for i in range(len(self.players))],
+            votingSpeed=1000,
+            lockedVote=self.locked_vote,
+            isVoteInProgress=self.is_vote_in_progress,
+            markedPlayer=self.marked_player,
+            fabled=[dict(id=f) for f in self.fabled],
+        )]
+
+    def ping(self, clients: int) -> list:
+        return ["ping", [clients, str(self.rng.randint(20, 200))]]
+
+    def next_message(self) -> list:
+        while not self.queued:
+            self.queue_activity()
+        m = self.queued.popleft()
+        if m[0] == "nomination":
+            self.nomination = m[1]
+            self.votes = set()
+            self.locked_vote = 0
+            self.is_vote_in_progress = False
+        elif m[0] == "vote":
+            self.votes.add(m[1][0])
+        elif m[0] == "isVoteInProgress":
+            self.is_vote_in_progress = m[1]
+        elif m[0] == "lock":
+            self.locked_vote = m[1][0]
+        return m
+
+    def queue_activity(self):
+        kinds = list(ACTIVITY_WEIGHTS)
+        kind = self.rng.choices(kinds, weights=[ACTIVITY_WEIGHTS[k] for k in kinds])[0]
+        index = self.rng.randrange(len(self.players))
+        player = self.players[index]
+        if kind == "death":
+            player["isDead"] = not player["isDead"]
+            self.queued.append(["player", dict(index=index, property="isDead", value=player["isDead"])])
+        elif kind == "pronouns":
+            player["pronouns"] = self.rng.choice(["", "she/her", "he/him", "they/them"])
+            self.queued.append(["pronouns", [index, player["pronouns"]]])
+        elif kind == "dead_vote" and player["isDead"]:
+            player["isVoteless"] = not player["isVoteless"]
+            self.queued.append(["player", dict(index=index, property="isVoteless", value=player["isVoteless"])])
+        elif kind == "nomination" and not self.is_night:
+            self.queue_nomination(index, self.rng.randrange(len(self.players)))
+        elif kind == "night":
+            self.is_night = not self.is_night
+            self.queued.append(["isNight", self.is_night])
+            if self.is_night and self.marked_player >= 0:
+                self.marked_player = -1
+                self.queued.append(["marked", -1])
+        elif kind == "fabled":
+            fabled = self.rng.choice(FABLED)
+            if fabled in self.fabled:
+                self.fabled.remove(fabled)
+            else:
+                self.fabled.append(fabled)
+            self.queued.append(["fabled", [dict(id=f) for f in self.fabled]])
+        elif kind == "marked" and not self.is_night:
+            self.marked_player = index
+            self.queued.append(["marked", index])
+
+    def queue_nomination(self, nominator: int, nominee: int):
+        """
+        Queues a nomination, with players raising hands and the vote being locked around the circle.
+        """
+        count = len(self.players)
+        voters = {i for i, p in enumerate(self.players)
+                  if not p["isVoteless"] and self.rng.random() < 0.4}
+        self.queued.append(["nomination", [nominator, nominee]])
+        for i in sorted(voters):
+            self.queued.append(["vote", [i, True, False]])
+        self.queued.append(["lock", [0, None]])
+        self.queued.append(["isVoteInProgress", True])
+        self.queued.append(["lock", [1, None]])
+        for relative in range(2, count + 2):
+            index = (nominee + relative - 1) % count
+            self.queued.append(["lock", [relative, 1 if index in voters else None]])
+        self.queued.append(["isVoteInProgress", False])
+        self.queued.append(["nomination", None])
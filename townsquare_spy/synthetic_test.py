@@ -0,0 +1,34 @@
+"""
+Unit tests for synthetic games, which should make sense to the spy.
+"""
+
+import collections
+import random
+
+from spy import Session, receive
+from synthetic import *
+
+def test_synthetic_game():
+    game = SyntheticGame(random.Random(1), player_count=7)
+    session = Session()
+    receive(session, game.edition())
+    receive(session, game.game_state())
+    kinds = collections.Counter()
+    for i in range(2000):
+        m = game.next_message()
+        kinds[m[0]] += 1
+        receive(session, m)
+        if i % 97 == 0:
+            # Joining partway through anything makes sense too.
+            joined = Session()
+            receive(joined, game.game_state())
+            assert (joined.nomination or None) == (session.nomination or None)
+            if session.nomination:
+                assert joined.votes == session.votes
+                assert joined.vote_count == session.vote_count
+    receive(session, game.ping(1))
+    assert {"player", "pronouns", "nomination", "vote", "lock", "isNight", "fabled", "marked"} <= set(kinds)
+    assert session.nomination_history
+    # The game's own idea of its state matches what the spy saw.
+    assert [p.is_dead for p in session.players] == [p["isDead"] for p in game.players]
+    assert session.fabled == game.fabled